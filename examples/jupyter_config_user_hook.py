@@ -1,46 +1,10 @@
 import os
-import shelve
+from jhub.uids import UIDAllocator
 
 # Configuration file for jupyterhub.
 user_start_id = 10000
 cur_path = os.path.join("/srv/jupyterhub/")
-db_path = os.path.join(cur_path, "user_uid.db")
-
-
-# Simple method to generate a uid for the user
-def simple_user_id(spawner):
-    user = spawner.user
-    if hasattr(spawner.user, "uid") and spawner.user.uid is not None:
-        spawner.log.info("Pre-Spawn, user {} already has id {}".format(user, user.uid))
-        return False
-    spawner.log.info("Pre-Spawn, creating id for {}".format(user))
-
-    user_id = None
-    with shelve.open(db_path) as db:
-        ids = list(db.keys())
-        if not ids:
-            # First user
-            new_id = str(user_start_id)
-            db[new_id] = user.name
-            user_id = new_id
-        else:
-            # check if user exists
-            usernames = list(db.values())
-            if user.name not in usernames:
-                new_id = str(int(ids[-1]) + 1)
-                db[new_id] = user.name
-                user_id = new_id
-            else:
-                # fetch existing id
-                for uid, username in db.items():
-                    if username == user.name:
-                        user_id = uid
-                        break
-
-    if not user_id:
-        spawner.log.error("Pre-Spawn, failed to aquire a uid for {}".format(user))
-        return False
-    spawner.user.uid = user_id
+db_path = os.path.join(cur_path, "uids.db")
 
 
 c = get_config()
@@ -63,7 +27,8 @@ c.SwarmSpawner.networks = ["jupyterhub_default"]
 
 c.SwarmSpawner.use_user_options = True
 
-c.SwarmSpawner.pre_spawn_hook = simple_user_id
+# Assigns each user a stable uid, which is available as {uid}
+c.SwarmSpawner.uid_allocator = UIDAllocator(path=db_path, start_uid=user_start_id)
 
 c.SwarmSpawner.images = [
     {
@@ -1,75 +1,699 @@
+import asyncio
+import heapq
+import itertools
+import time
+import weakref
+from contextlib import contextmanager
 from http.cookiejar import LoadError
-import os
-import random
-from jhub.defaults import default_base_path
-from jhub.io import acquire_lock, load, release_lock
+from jhub.io import load
+from jhub.ledger import AcceleratorLedger, default_ledger_path
+from prometheus_client import REGISTRY
+from jhub.metrics import (
+    ACCELERATOR_CLAIMS,
+    ACCELERATOR_CLAIM_DURATION,
+    AcceleratorPoolCollector,
+)
+
+
+class AcceleratorQueueFull(Exception):
+    """Raised when a claim can't wait since the queue of the pool is full"""
+
+
+# Node selection policies
+BEST_FIT = "best-fit"
+SPREAD = "spread"
+
+
+def slice_accelerator_ids(ids, slices):
+    """Partition each accelerator id into a number of <id>:<slice> ids"""
+    return ["{}:{}".format(_id, index) for _id in ids for index in range(slices)]
+
+
+def parse_accelerator_ids(content):
+    """Parse newline or comma separated accelerator ids"""
+    ids = []
+    for line in content.splitlines():
+        for _id in line.split(","):
+            _id = _id.strip()
+            if _id and _id not in ids:
+                ids.append(_id)
+    return ids
+
+
+class AcceleratorClaim:
+    """
+    The accelerators that an owner has claimed from a pool on a
+    particular node, along with the placement that the service
+    must be given to run on that node.
+    """
+
+    def __init__(
+        self, node, ids, node_attribute="node.id", generic_resource=None, owner=None
+    ):
+        self.owner = owner
+        self.node = node
+        self.ids = ids
+        self.node_attribute = node_attribute
+        self.generic_resource = generic_resource
+
+    @property
+    def constraints(self):
+        if not self.node:
+            return []
+        return ["{}=={}".format(self.node_attribute, self.node)]
+
+    @property
+    def generic_resources(self):
+        if not self.generic_resource:
+            return {}
+        return {self.generic_resource: len(self.ids)}
+
+
+class AcceleratorInventory:
+    """
+    In-memory index of the accelerators on each node, that tracks
+    how many of each accelerator's shares are claimed and by which owners.
+
+    The accelerators of each node with spare shares are kept in a heap
+    keyed on their current share count, such that the least loaded
+    accelerator is found in O(log n). Heap entries are invalidated
+    lazily, i.e. outdated entries are discarded when they are popped.
+    """
+
+    def __init__(self):
+        self._shares = {}
+        self._owners = {}
+        self._owned = {}
+        self._available = {}
+        self._heaps = {}
+
+    def load(self, devices, claims):
+        """Rebuild the index from (node, id, shares) devices and
+        (node, id, owner, claimed_at) claims"""
+        self._shares, self._owners, self._owned = {}, {}, {}
+        self._available, self._heaps = {}, {}
+        for node, _id, shares in devices:
+            self._shares[(node, _id)] = shares
+            self._owners[(node, _id)] = set()
+            self._available.setdefault(node, 0)
+            self._heaps.setdefault(node, [])
+        for node, _id, owner, _ in claims:
+            if (node, _id) not in self._shares:
+                continue
+            self._owners[(node, _id)].add(owner)
+            self._owned.setdefault(owner, set()).add((node, _id))
+        for (node, _id), owners in self._owners.items():
+            if len(owners) < self._shares[(node, _id)]:
+                self._available[node] += 1
+                self._heaps[node].append((len(owners), _id))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    @property
+    def nodes(self):
+        return list(self._available)
+
+    def load_of(self, device):
+        return len(self._owners[device])
+
+    def shares_of(self, device):
+        return self._shares[device]
+
+    def free(self, node=None):
+        """The number of accelerators with spare shares"""
+        if node is not None:
+            return self._available.get(node, 0)
+        return sum(self._available.values())
+
+    def claimed(self, node=None):
+        """The number of accelerators with at least one claimed share"""
+        return len(
+            [
+                device
+                for device, owners in self._owners.items()
+                if owners and (node is None or device[0] == node)
+            ]
+        )
+
+    def claims(self):
+        return {
+            device: sorted(owners) for device, owners in self._owners.items() if owners
+        }
+
+    def owned(self, owner):
+        return set(self._owned.get(owner, set()))
+
+    def _select_node(self, count, node, policy):
+        if node is not None:
+            return node if self.free(node) >= count else None
+        candidates = [
+            candidate for candidate in self._available if self.free(candidate) >= count
+        ]
+        if not candidates:
+            return None
+        if policy == SPREAD:
+            return max(candidates, key=lambda n: (self.free(n), n))
+        return min(candidates, key=lambda n: (self.free(n), n))
+
+    def _pop_least_loaded(self, node):
+        heap = self._heaps[node]
+        while heap:
+            load, _id = heapq.heappop(heap)
+            device = (node, _id)
+            # Discard outdated entries
+            if load == self.load_of(device) and load < self.shares_of(device):
+                return device
+        return None
+
+    def claim(self, owner, count=1, node=None, policy=BEST_FIT):
+        """Claim a share of count distinct accelerators that are located on the
+        same node and returns the claimed (node, id) devices.
+
+        With the best-fit policy, the node with the fewest free accelerators that
+        can still satisfy the request is selected, such that the nodes with
+        many free accelerators are kept whole for larger requests.
+        The spread policy selects the node with the most free accelerators.
+        Within the node, the least loaded accelerators are selected."""
+        selected_node = self._select_node(count, node, policy)
+        if selected_node is None:
+            return []
+
+        devices = []
+        while len(devices) < count:
+            device = self._pop_least_loaded(selected_node)
+            if device is None:
+                break
+            # Duplicate heap entries of an already selected accelerator
+            if device not in devices:
+                devices.append(device)
+        if len(devices) < count:
+            # Should not happen as the node has enough free accelerators
+            for device in devices:
+                heapq.heappush(
+                    self._heaps[selected_node], (self.load_of(device), device[1])
+                )
+            return []
+
+        for device in devices:
+            self._owners[device].add(owner)
+            self._owned.setdefault(owner, set()).add(device)
+            load = self.load_of(device)
+            if load < self.shares_of(device):
+                heapq.heappush(self._heaps[selected_node], (load, device[1]))
+            else:
+                self._available[selected_node] -= 1
+        return devices
+
+    def release(self, owner):
+        released = self._owned.pop(owner, set())
+        for device in released:
+            node, _id = device
+            if self.load_of(device) == self.shares_of(device):
+                self._available[node] += 1
+            self._owners[device].discard(owner)
+            heapq.heappush(self._heaps[node], (self.load_of(device), _id))
+        return released
+
+
+class AcceleratorUsage:
+    """
+    Time-weighted utilization of each accelerator, i.e. the fraction of
+    its shares that have been claimed on average since it was first observed.
+    """
+
+    def __init__(self):
+        self._observed = {}
+        self._changed = {}
+        self._busy = {}
+        self._ratio = {}
+
+    def __contains__(self, device):
+        return device in self._observed
+
+    def update(self, device, load, shares, now=None):
+        if now is None:
+            now = time.time()
+        if device in self._observed:
+            self._busy[device] += (now - self._changed[device]) * self._ratio[device]
+        else:
+            self._observed[device] = now
+            self._busy[device] = 0.0
+        self._changed[device] = now
+        self._ratio[device] = load / shares
+
+    def utilization(self, device, now=None):
+        if device not in self._observed:
+            return 0.0
+        if now is None:
+            now = time.time()
+        elapsed = now - self._observed[device]
+        if elapsed <= 0:
+            return self._ratio[device]
+        busy = self._busy[device] + (now - self._changed[device]) * self._ratio[device]
+        return busy / elapsed
 
 
 class AcceleratorPool:
     """
     Accelerator pool used to fetch the next available
     accelerator for the requesting user.
+
+    The accelerators can either be a list of ids that are available
+    on every node, or a dictionary of node ids and the accelerator ids
+    that are located on each node. When a claim is made, the pool
+    selects the node via the policy and returns the placement constraint
+    that ensures that the service is scheduled on that node.
+
+    If the pool is oversubscribed, each accelerator can be shared by
+    the number of users given by shares, either as a single count for
+    every accelerator or as a dictionary of accelerator ids and their
+    count. Accelerators can also be partitioned into MIG-style slices,
+    where each slice id is "<id>:<slice>".
+
+    The claims are kept in an in-memory inventory that is indexed by
+    both owner and device. Since every claim and release runs to completion
+    without yielding to the event loop, a single hub process doesn't
+    need any further locking. If the pool is shared, the claims are
+    additionally recorded in a persistent AcceleratorLedger, which is
+    shared between every hub process on the host and survives restarts
+    of the hub.
+
+    When no accelerators are available, claims can wait in a bounded
+    queue that is ordered by the priorities of the users' groups.
     """
 
-    _lock_path = os.path.join(default_base_path, "accelerator_pool_lock")
+    # Every instantiated pool, e.g. for the admin API and the metrics
+    _pools = weakref.WeakSet()
+    # Distinguishes the pools that share a type
+    _pool_numbers = itertools.count(1)
+
     _type = None
     _oversubscribe = False
-    # List or file path
     _ids = None
+    _nodes = None
+    _ledger = None
+    _generation = None
 
-    _free_pool = None
-    _claimed_pool = None
-
-    def __init__(self, type, oversubscribe, ids=None, ids_file_path=None):
+    def __init__(
+        self,
+        type,
+        oversubscribe,
+        ids=None,
+        ids_file_path=None,
+        ledger_path=default_ledger_path,
+        shared=False,
+        nodes=None,
+        policy=BEST_FIT,
+        node_attribute="node.id",
+        generic_resource=None,
+        shares=1,
+        slices=None,
+        priorities=None,
+        default_priority=0,
+        max_waiters=100,
+    ):
         self._type = type
         self._oversubscribe = oversubscribe
-        if not ids:
-            self._ids = []
+        self._ids = []
+        if ids:
+            self._ids = [str(_id) for _id in ids]
 
         if ids_file_path:
             loaded_ids = load(ids_file_path)
             if not loaded_ids:
                 raise LoadError("Failed to load accelerator ids")
-            self._ids = loaded_ids
-
-        if not self._free_pool:
-            self._free_pool = {}
-        if not self._claimed_pool:
-            self._claimed_pool = {}
-
-        if self._ids:
-            for _id in self.ids:
-                self._free_pool[_id] = True
-
-    def aquire(self, user):
-        """A user requests an accelerator"""
-        # We assume that the _ids is a dictionary
-        # TODO, add mutex
-        lock = acquire_lock(self._lock_path)
-        if not self._free_pool:
+            self._ids = parse_accelerator_ids(loaded_ids)
+
+        self._nodes = {}
+        if nodes:
+            self._nodes = {
+                str(node): [str(_id) for _id in node_ids]
+                for node, node_ids in nodes.items()
+            }
+
+        if slices:
+            self._ids = slice_accelerator_ids(self._ids, slices)
+            self._nodes = {
+                node: slice_accelerator_ids(node_ids, slices)
+                for node, node_ids in self._nodes.items()
+            }
+
+        if policy not in (BEST_FIT, SPREAD):
+            raise ValueError("Unknown accelerator policy: {}".format(policy))
+        self._policy = policy
+        self._node_attribute = node_attribute
+        self._generic_resource = generic_resource
+        self._shares = shares
+        self._priorities = priorities or {}
+        self._default_priority = default_priority
+        self._max_waiters = max_waiters
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._shared = shared
+        if shared:
+            self._ledger = AcceleratorLedger(ledger_path)
+        self._inventory = AcceleratorInventory()
+        self._usage = AcceleratorUsage()
+        self._name = "{}-{}".format(type, next(AcceleratorPool._pool_numbers))
+        AcceleratorPool._pools.add(self)
+
+    @classmethod
+    def pools(cls):
+        return list(cls._pools)
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def name(self):
+        """The unique name of the pool, e.g. gpu-1"""
+        return self._name
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def shares_of(self, _id):
+        """The number of users that can share the accelerator"""
+        if not self._oversubscribe:
+            return 1
+        if isinstance(self._shares, dict):
+            # Slices inherit the shares of their accelerator
+            return int(self._shares.get(_id, self._shares.get(_id.split(":")[0], 1)))
+        return int(self._shares)
+
+    @property
+    def devices(self):
+        """Every (node, id, shares) in the pool, node agnostic ids have an empty node"""
+        devices = [("", _id, self.shares_of(_id)) for _id in self._ids]
+        for node, node_ids in self._nodes.items():
+            devices.extend([(node, _id, self.shares_of(_id)) for _id in node_ids])
+        return devices
+
+    @property
+    def inventory(self):
+        return self._inventory
+
+    @property
+    def shared(self):
+        return self._shared
+
+    def _observe(self, devices=None):
+        """Update the usage of the devices, every device if None"""
+        if devices is None:
+            devices = [(node, _id) for node, _id, _ in self.devices]
+        for device in devices:
+            self._usage.update(
+                device,
+                self._inventory.load_of(device),
+                self._inventory.shares_of(device),
+            )
+
+    def utilization(self):
+        """The time-weighted utilization of every observed device"""
+        return {
+            (node, _id): self._usage.utilization((node, _id))
+            for node, _id, _ in self.devices
+            if (node, _id) in self._usage
+        }
+
+    def _sync(self, cursor):
+        """Reload the inventory if the ledger has been changed by another process"""
+        if cursor is None:
+            # Not shared, the inventory is the only record of the claims
+            if self._generation is None:
+                self._inventory.load(self.devices, [])
+                self._generation = 0
+                self._observe()
+            return
+        if self._generation is None:
+            self._generation = self._ledger.register(cursor, self._type, self.devices)
+        elif self._generation == self._ledger.generation(cursor, self._type):
+            return
+        self._inventory.load(*self._ledger.load(cursor, self._type))
+        self._generation = self._ledger.generation(cursor, self._type)
+        self._observe()
+
+    @contextmanager
+    def _transaction(self):
+        """Yields the ledger cursor of a synchronized inventory,
+        or None if the pool isn't shared"""
+        if not self._shared:
+            self._sync(None)
+            yield None
+            return
+        try:
+            with self._ledger.transaction() as cursor:
+                self._sync(cursor)
+                yield cursor
+        except Exception:
+            # Force a reload in case the inventory diverged from the ledger
+            self._generation = None
+            raise
+
+    def _claim(self, user, count=1, node=None):
+        with self._transaction() as cursor:
+            devices = self._inventory.claim(
+                user, count=count, node=node, policy=self._policy
+            )
+            if devices and cursor:
+                self._generation = self._ledger.claim(cursor, self._type, user, devices)
+
+        if not devices:
             return None
+        self._observe(devices)
+        return AcceleratorClaim(
+            devices[0][0],
+            [_id for _, _id in devices],
+            node_attribute=self._node_attribute,
+            generic_resource=self._generic_resource,
+            owner=user,
+        )
 
-        # Selected a random accelerator
-        free_list = list(self._free_pool)
-        random_accelerator = random.choice(free_list)
-        selected_accelerator = self._free_pool.pop(random_accelerator)
-        self._claimed_pool[selected_accelerator] = {"user": user}
+    def aquire(self, user, count=1, node=None):
+        """A user requests count accelerators, optionally on a particular node.
+        Returns an AcceleratorClaim or None if the request can't be satisfied"""
+        started = time.monotonic()
+        try:
+            claim = self._claim(user, count=count, node=node)
+        except Exception:
+            ACCELERATOR_CLAIMS.labels(self._type, "error").inc()
+            raise
+        finally:
+            ACCELERATOR_CLAIM_DURATION.labels(self._type).observe(
+                time.monotonic() - started
+            )
+        if claim is None:
+            ACCELERATOR_CLAIMS.labels(self._type, "unavailable").inc()
+        else:
+            ACCELERATOR_CLAIMS.labels(self._type, "claimed").inc()
+        return claim
 
-        release_lock(lock)
-        return selected_accelerator
+    def priority_of(self, groups=None):
+        """The queue priority of a user that is a member of the groups,
+        where a lower value is served first"""
+        if not groups:
+            return self._default_priority
+        return min(
+            self._priorities.get(group, self._default_priority) for group in groups
+        )
 
-    def release(self, user):
-        """A user releases an accelerator"""
-        lock = acquire_lock(self._lock_path)
+    @property
+    def waiting(self):
+        """The number of claims that are waiting in the queue"""
+        return len([entry for entry in self._waiters if not entry[-1].done()])
+
+    def queue_position(self, entry):
+        """The 1-indexed position of the queue entry"""
+        return 1 + len(
+            [
+                waiter
+                for waiter in self._waiters
+                if not waiter[-1].done() and waiter[:2] < entry[:2]
+            ]
+        )
+
+    def _wake(self):
+        """Claim accelerators for the waiting claims in priority order. The
+        first waiter blocks the ones behind it until its claim can be satisfied."""
+        while self._waiters:
+            _, _, user, count, node, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            claim = self._claim(user, count=count, node=node)
+            if claim is None:
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(claim)
+
+    async def claim(
+        self,
+        user,
+        count=1,
+        node=None,
+        groups=None,
+        timeout=None,
+        retry_interval=5,
+        on_wait=None,
+    ):
+        """Claim count accelerators, waiting up to timeout seconds in the queue
+        if none are available. The queue is ordered by the priority of the
+        user's groups and is first in, first out within the same priority.
+
+        The waiting claims are woken when the accelerators are released, and
+        are retried every retry_interval seconds to discover releases made by
+        other hub processes. on_wait is called with the position in the queue
+        while the claim is waiting.
 
-        user_accelerators = []
-        for accelerator, data in self._claimed_pool.items():
-            if user in data:
-                user_accelerators.append(accelerator)
+        Returns an AcceleratorClaim or None if the claim timed out or no
+        accelerators are available without waiting. Raises
+        AcceleratorQueueFull if the queue is full."""
+        started = time.monotonic()
+        priority = self.priority_of(groups)
+        result = "claimed"
+        try:
+            # Don't jump ahead of the claims that are already waiting
+            if not any(
+                not entry[-1].done() and entry[0] <= priority for entry in self._waiters
+            ):
+                claim = self._claim(user, count=count, node=node)
+                if claim is not None:
+                    return claim
 
-        for accelerator in user_accelerators:
-            self._claimed_pool.pop(accelerator)
-            self._free_pool[accelerator] = True
+            if not timeout or timeout <= 0:
+                result = "unavailable"
+                return None
 
-        release_lock(lock)
+            if self.waiting >= self._max_waiters:
+                result = "queue_full"
+                raise AcceleratorQueueFull(
+                    "The queue of {} claims is full with {} waiting claims".format(
+                        self._type, self.waiting
+                    )
+                )
+
+            future = asyncio.get_running_loop().create_future()
+            entry = [priority, next(self._sequence), user, count, node, future]
+            heapq.heappush(self._waiters, entry)
+            deadline = started + timeout
+            try:
+                while not future.done():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if on_wait:
+                        on_wait(self.queue_position(entry))
+                    try:
+                        await asyncio.wait_for(
+                            asyncio.shield(future), min(retry_interval, remaining)
+                        )
+                    except asyncio.TimeoutError:
+                        # Releases made by other processes don't wake the queue
+                        self._wake()
+            except BaseException:
+                # Don't leak a claim that was made while being cancelled
+                if future.done() and not future.cancelled():
+                    self.release(user)
+                raise
+            finally:
+                if not future.done():
+                    future.cancel()
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+
+            if future.cancelled():
+                result = "timeout"
+                return None
+            return future.result()
+        except AcceleratorQueueFull:
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            ACCELERATOR_CLAIMS.labels(self._type, result).inc()
+            ACCELERATOR_CLAIM_DURATION.labels(self._type).observe(
+                time.monotonic() - started
+            )
+
+    def release(self, user):
+        """A user releases every accelerator it has claimed"""
+        with self._transaction() as cursor:
+            if cursor:
+                self._generation = self._ledger.release(cursor, self._type, user)
+            released = self._inventory.release(user)
+        self._observe(released)
+        if released:
+            self._wake()
+        return True
+
+    def claims(self):
+        """Returns a dictionary of the claimed (node, id) accelerators
+        and the list of users that share them"""
+        with self._transaction():
+            pass
+        return self._inventory.claims()
+
+    def reconcile(self, claims, owners=None):
+        """Recover the claims after a restart from a dictionary of users and
+        the (node, id) accelerators that their running services actually use.
+        Only the claims of the users in claims and of the additional owners
+        are replaced, the claims of every other user are kept."""
+        owners = set(owners or ()) | set(claims)
+        with self._transaction() as cursor:
+            if cursor:
+                self._ledger.reconcile(cursor, self._type, claims, owners=owners)
+                self._inventory.load(*self._ledger.load(cursor, self._type))
+                self._generation = self._ledger.generation(cursor, self._type)
+            else:
+                kept_claims = [
+                    (node, _id, owner, None)
+                    for (node, _id), device_owners in self._inventory.claims().items()
+                    for owner in device_owners
+                    if owner not in owners
+                ]
+                # Devices that are not part of the pool are ignored by the inventory
+                self._inventory.load(
+                    self.devices,
+                    kept_claims
+                    + [
+                        (node, _id, owner, None)
+                        for owner, owner_devices in claims.items()
+                        for node, _id in owner_devices
+                    ],
+                )
+        self._observe()
         return True
+
+    def status(self):
+        """A JSON serializable summary of the pool, its nodes and claims"""
+        claims = self.claims()
+        nodes = {}
+        for node in self._inventory.nodes:
+            nodes[node] = {
+                "free": self._inventory.free(node),
+                "claimed": self._inventory.claimed(node),
+            }
+        return {
+            "type": self._type,
+            "oversubscribe": self._oversubscribe,
+            "policy": self._policy,
+            "shared": self._shared,
+            "nodes": nodes,
+            "accelerators": [
+                {
+                    "node": node,
+                    "id": _id,
+                    "shares": shares,
+                    "users": claims.get((node, _id), []),
+                    "utilization": self._usage.utilization((node, _id)),
+                }
+                for node, _id, shares in self.devices
+            ],
+        }
+
+
+REGISTRY.register(AcceleratorPoolCollector(AcceleratorPool.pools))
@@ -0,0 +1,634 @@
+"""
+Docker API clients of the Swarm managers that the SwarmSpawner talks to.
+
+Read-only calls are spread across the managers, since every manager can
+answer them from its copy of the raft store, whereas writes are sent to
+the leader, which would otherwise receive them forwarded from the manager.
+Volumes are local to a node and are always managed via the first endpoint.
+
+Each endpoint has a circuit breaker, which short-circuits the calls to the
+endpoint while it is failing, such that the spawners fail fast instead of
+piling up behind a manager that hangs.
+
+Concurrent identical reads share a single request, and the response of a
+read is reused for a short while, unless an object of the same kind has
+been written since.
+"""
+
+import copy
+import itertools
+import json
+import threading
+import time
+from asyncio import ensure_future, get_running_loop, shield
+from collections import deque
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import docker
+from docker.tls import TLSConfig
+from docker.utils import kwargs_from_env
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from jhub.metrics import (
+    DOCKER_CIRCUIT_OPEN,
+    DOCKER_CIRCUIT_TRANSITIONS,
+    DOCKER_COALESCED_REQUESTS,
+    DOCKER_HEDGED_REQUESTS,
+    DOCKER_REQUEST_DURATION,
+)
+from jhub.util import percentile
+
+ROUND_ROBIN = "round_robin"
+LEAST_LATENCY = "least_latency"
+READ_STRATEGIES = (ROUND_ROBIN, LEAST_LATENCY)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# The docker-py default number of seconds before a request times out
+default_timeout = 60
+
+# The kind of object that each read method reads, where the tasks are
+# changed by writing their service. The writes are of the kind in their name,
+# e.g. create_service.
+READ_KINDS = {
+    "configs": "config",
+    "inspect_config": "config",
+    "inspect_distribution": "image",
+    "inspect_node": "node",
+    "inspect_service": "service",
+    "inspect_task": "service",
+    "nodes": "node",
+    "services": "service",
+    "tasks": "service",
+}
+
+READ_METHODS = frozenset(READ_KINDS)
+
+LOCAL_METHODS = frozenset(
+    ["create_volume", "inspect_volume", "prune_volumes", "remove_volume", "volumes"]
+)
+
+_client_pool = None
+_client_pool_key = None
+_client_pool_lock = threading.Lock()
+
+
+def object_kind(method_name):
+    """The kind of object that the Docker API method reads or writes"""
+    if method_name in READ_KINDS:
+        return READ_KINDS[method_name]
+    return method_name.split("_")[-1]
+
+
+def create_docker_client(
+    base_url=None, api_client_kwargs=None, tls_kwargs=None, version="auto"
+):
+    """Create a client of the base_url, or of the DOCKER_HOST if None"""
+    kwargs = kwargs_from_env()
+    if api_client_kwargs:
+        kwargs.update(api_client_kwargs)
+    if tls_kwargs:
+        kwargs["tls"] = TLSConfig(**tls_kwargs)
+    if base_url:
+        kwargs["base_url"] = base_url
+    return docker.APIClient(version=version, **kwargs)
+
+
+class CircuitOpenError(docker.errors.DockerException):
+    """Raised instead of calling an endpoint whose circuit is open"""
+
+
+class ClientUnavailableError(docker.errors.DockerException):
+    """Raised when the client of an endpoint can't be created, e.g. because
+    its API version can't be negotiated with an unreachable daemon"""
+
+
+def is_unavailable(err):
+    """Whether the error means that the endpoint is failing, as opposed to
+    e.g. the requested object not being found"""
+    if isinstance(
+        err, (CircuitOpenError, ClientUnavailableError, ConnectionError, Timeout)
+    ):
+        return True
+    return isinstance(err, docker.errors.APIError) and err.is_server_error()
+
+
+class CircuitBreaker:
+    """
+    Opens the circuit after failure_threshold consecutive failures, after
+    which every call is short-circuited for recovery_timeout seconds.
+    Then a single probe call is let through, which closes the circuit if it
+    succeeds and otherwise opens it again.
+    A failure_threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+        DOCKER_CIRCUIT_OPEN.labels(self.name).set(0)
+
+    @property
+    def state(self):
+        return self._state
+
+    def _recovering(self):
+        return time.monotonic() - self._opened >= self._recovery_timeout
+
+    @property
+    def available(self):
+        """Whether a call would be let through"""
+        return self._state == CLOSED or (self._state == OPEN and self._recovering())
+
+    def allow(self):
+        """Whether the call should be made, which makes it the probe if the
+        circuit is recovering"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and self._recovering():
+                self._transition(HALF_OPEN)
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED
+                and self._failure_threshold
+                and self._failures >= self._failure_threshold
+            ):
+                self._opened = time.monotonic()
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        self._state = state
+        DOCKER_CIRCUIT_TRANSITIONS.labels(self.name, state).inc()
+        DOCKER_CIRCUIT_OPEN.labels(self.name).set(int(state != CLOSED))
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share the result of a single call,
+    which is reused by later calls for cache_ttl seconds.
+    Every caller is given its own copy of the result.
+
+    The first item of each key is the kind of object that the call reads,
+    such that the results of a kind can be invalidated when it is written.
+    Writes are made from the executor threads, so the state is guarded by
+    a lock.
+    """
+
+    def __init__(self, cache_ttl=0, max_cached=1024):
+        self._cache_ttl = cache_ttl
+        self._max_cached = max_cached
+        self._inflight = {}
+        self._cache = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, kind):
+        """Forget the results of the kind, including those of the current calls"""
+        with self._lock:
+            self._generations[kind] = self._generations.get(kind, 0) + 1
+            self._cache = {
+                key: cached for key, cached in self._cache.items() if key[0] != kind
+            }
+            self._inflight = {
+                inflight_key: future
+                for inflight_key, future in self._inflight.items()
+                if inflight_key[1][0] != kind
+            }
+
+    def _done(self, inflight_key, key, generation, future):
+        with self._lock:
+            if self._inflight.get(inflight_key) is future:
+                del self._inflight[inflight_key]
+            if not self._cache_ttl or future.cancelled() or future.exception():
+                return
+            if generation != self._generations.get(key[0], 0):
+                return
+            now = time.monotonic()
+            if len(self._cache) >= self._max_cached:
+                self._cache = {
+                    key: cached
+                    for key, cached in self._cache.items()
+                    if cached[0] > now
+                }
+            self._cache[key] = (now + self._cache_ttl, future.result())
+
+    async def call(self, key, function, metric_label=""):
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            DOCKER_COALESCED_REQUESTS.labels(metric_label, "cache").inc()
+            return copy.deepcopy(cached[1])
+
+        # Futures are bound to the event loop that created them
+        inflight_key = (id(get_running_loop()), key)
+        with self._lock:
+            future = self._inflight.get(inflight_key)
+            joined = future is not None
+            if not joined:
+                future = ensure_future(function())
+                self._inflight[inflight_key] = future
+                future.add_done_callback(
+                    partial(
+                        self._done,
+                        inflight_key,
+                        key,
+                        self._generations.get(key[0], 0),
+                    )
+                )
+        if joined:
+            DOCKER_COALESCED_REQUESTS.labels(metric_label, "inflight").inc()
+        # A cancelled caller doesn't cancel the call of the others
+        return copy.deepcopy(await shield(future))
+
+
+class DockerClientPool:
+    """
+    A client of each endpoint, which are created once and reused by every
+    call. If endpoints is empty, the DOCKER_HOST of the environment is used.
+
+    Reads are distributed either round robin, or to the endpoint with the
+    lowest recent latency. If hedge_reads is set, a read that hasn't
+    completed within the hedge_quantile of the recent latencies of the
+    same method is sent to a second endpoint as well, and the first
+    response is used.
+
+    Every request times out after the timeouts of its method, or after
+    timeout seconds. The circuit of an endpoint is opened after
+    failure_threshold consecutive failures, and is probed again after
+    recovery_timeout seconds. Reads and writes are sent to another endpoint
+    while the circuit of their endpoint is open.
+
+    When called from the event loop, concurrent identical reads share a
+    single request, whose response is reused for read_cache_ttl seconds
+    unless an object of the same kind is written in the meantime.
+    """
+
+    def __init__(
+        self,
+        endpoints=None,
+        api_client_kwargs=None,
+        tls_kwargs=None,
+        strategy=ROUND_ROBIN,
+        hedge_reads=False,
+        hedge_quantile=0.95,
+        hedge_min_samples=20,
+        leader_ttl=60,
+        latency_window=200,
+        timeout=default_timeout,
+        timeouts=None,
+        failure_threshold=5,
+        recovery_timeout=30,
+        read_cache_ttl=0.5,
+    ):
+        if strategy not in READ_STRATEGIES:
+            raise ValueError(
+                "Unknown read strategy: {}, must be one of: {}".format(
+                    strategy, ", ".join(READ_STRATEGIES)
+                )
+            )
+        self._endpoints = list(endpoints or [None])
+        self._api_client_kwargs = api_client_kwargs
+        self._tls_kwargs = tls_kwargs
+        self._strategy = strategy
+        self._hedge_reads = hedge_reads and len(self._endpoints) > 1
+        self._hedge_quantile = hedge_quantile
+        self._hedge_min_samples = hedge_min_samples
+        self._leader_ttl = leader_ttl
+        self._latency_window = latency_window
+        self._timeout = timeout
+        self._timeouts = timeouts or {}
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+
+        self._single_flight = SingleFlight(cache_ttl=read_cache_ttl)
+        self._clients = {}
+        self._versions = {}
+        self._breakers = {
+            endpoint: CircuitBreaker(
+                endpoint or "default",
+                failure_threshold=failure_threshold,
+                recovery_timeout=recovery_timeout,
+            )
+            for endpoint in self._endpoints
+        }
+        self._lock = threading.Lock()
+        # The calls in progress, a retired pool is closed once they are done
+        self._active_calls = 0
+        self._retired = False
+        self._readers = itertools.cycle(self._endpoints)
+        # The exponentially weighted moving latency of each endpoint
+        self._endpoint_latency = {endpoint: 0.0 for endpoint in self._endpoints}
+        self._method_latencies = {}
+        self._leader = None
+        self._leader_checked = None
+        self._executor = None
+        if self._hedge_reads:
+            self._executor = ThreadPoolExecutor(thread_name_prefix="docker-hedge")
+
+    @property
+    def endpoints(self):
+        return list(self._endpoints)
+
+    @property
+    def primary(self):
+        return self._endpoints[0]
+
+    def timeout(self, method_name):
+        return self._timeouts.get(method_name, self._timeout)
+
+    def breaker(self, endpoint):
+        return self._breakers[endpoint]
+
+    def client(self, endpoint=None, timeout=None):
+        """The client of the endpoint whose requests time out after timeout"""
+        if endpoint is None:
+            endpoint = self.primary
+        if timeout is None:
+            timeout = self._timeout
+        key = (endpoint, timeout)
+        with self._lock:
+            if key in self._clients:
+                return self._clients[key]
+            version = self._versions.get(endpoint, "auto")
+
+        # The version is negotiated outside of the lock, such that an endpoint
+        # that hangs doesn't hold up the calls to the other endpoints
+        api_client_kwargs = dict(self._api_client_kwargs or {})
+        api_client_kwargs["timeout"] = timeout
+        try:
+            client = create_docker_client(
+                base_url=endpoint,
+                api_client_kwargs=api_client_kwargs,
+                tls_kwargs=self._tls_kwargs,
+                version=version,
+            )
+        except (docker.errors.DockerException, RequestException) as err:
+            raise ClientUnavailableError(
+                "Failed to create a client of the Docker endpoint {}: {}".format(
+                    endpoint or "default", err
+                )
+            ) from err
+
+        with self._lock:
+            if key in self._clients:
+                # Created concurrently by another call
+                client.close()
+                return self._clients[key]
+            self._clients[key] = client
+            # Only the first client of the endpoint negotiates the version
+            self._versions.setdefault(endpoint, client.api_version)
+            return client
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def retire(self):
+        """Close the pool once the calls that are in progress are done"""
+        with self._lock:
+            self._retired = True
+            if self._active_calls:
+                return
+        self.close()
+
+    def reader(self, exclude=None):
+        """The endpoint that the next read should be sent to"""
+        candidates = [
+            endpoint
+            for endpoint in self._endpoints
+            if endpoint != exclude and self._breakers[endpoint].available
+        ] or self._endpoints
+        if self._strategy == LEAST_LATENCY:
+            return min(candidates, key=self._endpoint_latency.get)
+        with self._lock:
+            for endpoint in self._readers:
+                if endpoint in candidates:
+                    return endpoint
+
+    def find_leader(self):
+        """Ask each manager whether it is the leader"""
+        for endpoint in self._endpoints:
+            try:
+                client = self.client(endpoint)
+                node_id = client.info().get("Swarm", {}).get("NodeID")
+                if not node_id:
+                    continue
+                manager_status = client.inspect_node(node_id).get("ManagerStatus")
+            except (docker.errors.DockerException, RequestException):
+                continue
+            if manager_status and manager_status.get("Leader"):
+                return endpoint
+        return None
+
+    def leader(self):
+        """The endpoint of the leader, or the primary if it is unknown"""
+        if len(self._endpoints) == 1:
+            return self.primary
+        now = time.monotonic()
+        if self._leader_checked is None or now - self._leader_checked > (
+            self._leader_ttl
+        ):
+            self._leader = self.find_leader()
+            self._leader_checked = now
+        return self._leader or self.primary
+
+    def forget_leader(self):
+        self._leader_checked = None
+
+    def hedge_delay(self, method_name):
+        latencies = self._method_latencies.get(method_name)
+        if not latencies or len(latencies) < self._hedge_min_samples:
+            return None
+        return percentile(latencies, self._hedge_quantile)
+
+    def _record(self, method_name, endpoint, seconds):
+        DOCKER_REQUEST_DURATION.labels(method_name, endpoint or "default").observe(
+            seconds
+        )
+        self._endpoint_latency[endpoint] = (
+            0.8 * self._endpoint_latency[endpoint] + 0.2 * seconds
+        )
+        if method_name not in self._method_latencies:
+            self._method_latencies[method_name] = deque(maxlen=self._latency_window)
+        self._method_latencies[method_name].append(seconds)
+
+    def _call(self, endpoint, method_name, *args, **kwargs):
+        breaker = self._breakers[endpoint]
+        if not breaker.allow():
+            raise CircuitOpenError(
+                "The circuit of the Docker endpoint {} is open".format(breaker.name)
+            )
+        started = time.perf_counter()
+        try:
+            client = self.client(endpoint, timeout=self.timeout(method_name))
+            response = getattr(client, method_name)(*args, **kwargs)
+        except Exception as err:
+            if is_unavailable(err):
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        else:
+            breaker.success()
+            return response
+        finally:
+            self._record(method_name, endpoint, time.perf_counter() - started)
+
+    def _hedged_call(self, endpoint, method_name, *args, **kwargs):
+        delay = self.hedge_delay(method_name)
+        if delay is None:
+            return self._call(endpoint, method_name, *args, **kwargs)
+
+        first = self._executor.submit(
+            self._call, endpoint, method_name, *args, **kwargs
+        )
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        hedge = self._executor.submit(
+            self._call, self.reader(exclude=endpoint), method_name, *args, **kwargs
+        )
+        done, _ = wait([first, hedge], return_when=FIRST_COMPLETED)
+        response = first if first in done else hedge
+        DOCKER_HEDGED_REQUESTS.labels(
+            method_name, "primary" if response is first else "hedge"
+        ).inc()
+        return response.result()
+
+    def call(self, method_name, *args, **kwargs):
+        """Call the method_name of the client of the appropriate endpoint"""
+        with self._lock:
+            self._active_calls += 1
+        try:
+            return self._route(method_name, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._active_calls -= 1
+                closing = self._retired and not self._active_calls
+            if closing:
+                self.close()
+
+    def _route(self, method_name, *args, **kwargs):
+        if method_name in LOCAL_METHODS:
+            return self._call(self.primary, method_name, *args, **kwargs)
+
+        if method_name not in READ_METHODS:
+            endpoint = self.leader()
+            if not self._breakers[endpoint].available:
+                # The other managers forward the write to the leader
+                endpoint = self.reader()
+            try:
+                return self._call(endpoint, method_name, *args, **kwargs)
+            except (CircuitOpenError, ClientUnavailableError, ConnectionError):
+                # The leader might have changed
+                self.forget_leader()
+                raise
+            finally:
+                self._single_flight.invalidate(object_kind(method_name))
+
+        endpoint = self.reader()
+        try:
+            if self._hedge_reads:
+                return self._hedged_call(endpoint, method_name, *args, **kwargs)
+            return self._call(endpoint, method_name, *args, **kwargs)
+        except (CircuitOpenError, ClientUnavailableError, ConnectionError, Timeout):
+            if len(self._endpoints) == 1:
+                raise
+            # Reads are safe to retry on another manager
+            return self._call(
+                self.reader(exclude=endpoint), method_name, *args, **kwargs
+            )
+
+    def call_node(self, endpoint, method_name, *args, **kwargs):
+        """Call the method_name of the client of a node's own daemon, e.g. for
+        the volumes that are local to the node, or of the primary endpoint
+        if endpoint is None"""
+        if endpoint is None:
+            endpoint = self.primary
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    endpoint,
+                    failure_threshold=self._failure_threshold,
+                    recovery_timeout=self._recovery_timeout,
+                )
+                self._endpoint_latency[endpoint] = 0.0
+            self._active_calls += 1
+        try:
+            return self._call(endpoint, method_name, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._active_calls -= 1
+                closing = self._retired and not self._active_calls
+            if closing:
+                self.close()
+
+    async def call_node_async(self, endpoint, method_name, *args, **kwargs):
+        """Like call_node, but without blocking the event loop"""
+        return await get_running_loop().run_in_executor(
+            None, partial(self.call_node, endpoint, method_name, *args, **kwargs)
+        )
+
+    async def call_async(self, method_name, *args, **kwargs):
+        """Like call, but without blocking the event loop"""
+        function = partial(
+            get_running_loop().run_in_executor,
+            None,
+            partial(self.call, method_name, *args, **kwargs),
+        )
+        if method_name not in READ_METHODS:
+            return await function()
+        key = (
+            object_kind(method_name),
+            method_name,
+            json.dumps([args, kwargs], sort_keys=True, default=str),
+        )
+        return await self._single_flight.call(key, function, metric_label=method_name)
+
+
+def configure_client_pool(endpoints=None, **kwargs):
+    """Returns the shared client pool of the endpoints and kwargs,
+    which replaces the previous one if they have changed. The replaced pool
+    is closed once the calls that are in progress are done."""
+    global _client_pool, _client_pool_key
+    if not endpoints:
+        # The pool of the environment is replaced if the DOCKER_HOST changes
+        endpoints = [kwargs_from_env().get("base_url")]
+    key = json.dumps([list(endpoints), kwargs], sort_keys=True, default=str)
+    with _client_pool_lock:
+        if _client_pool is None or key != _client_pool_key:
+            replaced_pool = _client_pool
+            _client_pool = DockerClientPool(endpoints=endpoints, **kwargs)
+            _client_pool_key = key
+            if replaced_pool is not None:
+                replaced_pool.retire()
+        return _client_pool
+
+
+def get_client_pool():
+    """Returns the shared client pool, of the DOCKER_HOST if not configured"""
+    if _client_pool is None:
+        return configure_client_pool()
+    return _client_pool
@@ -0,0 +1,217 @@
+"""
+Build the service specs that the SwarmSpawner would submit to Docker
+for a number of synthetic users, without contacting Docker, and report
+the time and memory spent in each phase of building the spec.
+
+    jhub-swarmspawner-dryrun jupyterhub_config.py --users 10000
+
+Configs are referenced by their name instead of their id, and no
+accelerators are claimed, mounts provisioned or user install configs
+created. Assigned user ids are kept in memory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from traitlets.config import PyFileConfigLoader
+from jhub.swarmspawner import SwarmSpawner
+from jhub.uids import UIDAllocator
+from jhub.util import percentile
+
+
+class DryRunServer:
+    def __init__(self, base_url, cookie_name="jupyterhub-user"):
+        self.base_url = base_url
+        self.cookie_name = cookie_name
+
+
+class DryRunUser:
+    """The attributes of a JupyterHub user that the SwarmSpawner uses"""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.escaped_name = name
+        self.url = "/user/{}/".format(name)
+        self.server = DryRunServer(self.url)
+        self.groups = []
+        self.__dict__.update(attributes)
+
+    def __str__(self):
+        return self.name
+
+
+class DryRunHub:
+    """The attributes of the JupyterHub hub that the SwarmSpawner uses"""
+
+    def __init__(self, api_url="http://jupyterhub:8081/hub/api"):
+        self.api_url = api_url
+        self.base_url = "/hub/"
+        self.public_host = ""
+        self.server = DryRunServer(self.base_url, cookie_name="jupyterhub-hub")
+
+
+def load_config(path):
+    return PyFileConfigLoader(
+        os.path.basename(path), path=os.path.dirname(os.path.abspath(path))
+    ).load_config()
+
+
+def summarize(values):
+    return {
+        "mean": sum(values) / len(values) if values else 0,
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else 0,
+    }
+
+
+async def build_specs(
+    config, users, user_prefix="user", user_options=None, user_attributes=None
+):
+    """Returns the spec and the phase timings of each synthetic user"""
+    uid_allocator = None
+    if "uid_allocator" in config.SwarmSpawner:
+        uid_allocator = UIDAllocator(path=":memory:")
+
+    hub = DryRunHub()
+    results = []
+    for index in range(users):
+        name = "{}{}".format(user_prefix, index)
+        spawner = SwarmSpawner(
+            config=config,
+            user=DryRunUser(name, **(user_attributes or {})),
+            hub=hub,
+            user_options=user_options or {},
+        )
+        spawner.dry_run = True
+        if uid_allocator is not None:
+            spawner.uid_allocator = uid_allocator
+        spawn_options = {}
+        if spawner.use_user_options:
+            spawn_options = spawner.user_options
+        spec = await spawner.build_service_spec(spawn_options)
+        results.append((spec, spawner.spec_timings))
+    return results
+
+
+def dry_run(
+    config,
+    users=1,
+    user_prefix="user",
+    user_options=None,
+    user_attributes=None,
+    include_specs="first",
+    trace_memory=True,
+):
+    """Returns a JSON serializable report of the dry run"""
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        results = asyncio.run(
+            build_specs(
+                config,
+                users,
+                user_prefix=user_prefix,
+                user_options=user_options,
+                user_attributes=user_attributes,
+            )
+        )
+        total_seconds = time.perf_counter() - started
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    phases = {}
+    for _, timings in results:
+        for timing in timings:
+            phase = phases.setdefault(
+                timing["phase"], {"seconds": [], "allocated_bytes": []}
+            )
+            phase["seconds"].append(timing["seconds"])
+            phase["allocated_bytes"].append(timing["allocated_bytes"])
+
+    specs = [spec for spec, _ in results]
+    if include_specs == "first":
+        specs = specs[:1]
+    elif include_specs == "none":
+        specs = []
+
+    return {
+        "users": users,
+        "total_seconds": total_seconds,
+        "seconds_per_user": total_seconds / users if users else 0,
+        "peak_memory_bytes": peak_memory,
+        "phases": {
+            name: {
+                "seconds": summarize(phase["seconds"]),
+                "allocated_bytes": summarize(phase["allocated_bytes"]),
+            }
+            for name, phase in phases.items()
+        },
+        "specs": specs,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("config", help="Path to the jupyterhub_config.py file")
+    parser.add_argument(
+        "--users", type=int, default=1, help="Number of synthetic users"
+    )
+    parser.add_argument(
+        "--user-prefix", default="user", help="Name prefix of the synthetic users"
+    )
+    parser.add_argument(
+        "--user-options",
+        type=json.loads,
+        default={},
+        help="JSON user_options that every user spawns with",
+    )
+    parser.add_argument(
+        "--user-attributes",
+        type=json.loads,
+        default={},
+        help="JSON attributes of every user, e.g. the user_format_attributes",
+    )
+    parser.add_argument(
+        "--include-specs",
+        choices=["first", "all", "none"],
+        default="first",
+        help="Which of the built specs to include in the report",
+    )
+    parser.add_argument(
+        "--no-trace-memory",
+        dest="trace_memory",
+        action="store_false",
+        help="Don't trace the memory allocations, which slows the build down",
+    )
+    parser.add_argument("--output", help="Write the report to a file")
+    parsed_args = parser.parse_args(args)
+
+    report = dry_run(
+        load_config(parsed_args.config),
+        users=parsed_args.users,
+        user_prefix=parsed_args.user_prefix,
+        user_options=parsed_args.user_options,
+        user_attributes=parsed_args.user_attributes,
+        include_specs=parsed_args.include_specs,
+        trace_memory=parsed_args.trace_memory,
+    )
+    content = json.dumps(report, indent=4, default=str)
+    if parsed_args.output:
+        with open(parsed_args.output, "w") as _file:
+            _file.write(content)
+    else:
+        print(content)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
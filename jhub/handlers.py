@@ -0,0 +1,37 @@
+"""
+Additional JupyterHub API handlers for the SwarmSpawner.
+
+The handlers can be registered in the JupyterHub configuration file via:
+
+    from jhub.handlers import default_handlers
+    c.JupyterHub.extra_handlers = default_handlers
+"""
+
+import json
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from jhub.accelerators import AcceleratorPool
+from jhub.images import ImageDigests
+
+
+class AcceleratorPoolsAPIHandler(APIHandler):
+    """Read-only listing of the accelerator pools and their claims"""
+
+    @needs_scope("admin:servers")
+    def get(self):
+        pools = [pool.status() for pool in AcceleratorPool.pools()]
+        self.write(json.dumps(pools))
+
+
+class ImageDigestsAPIHandler(APIHandler):
+    """Read-only mapping of the image tags to their cached digests"""
+
+    @needs_scope("admin:servers")
+    def get(self):
+        self.write(json.dumps(ImageDigests.get().digests))
+
+
+default_handlers = [
+    (r"/api/swarmspawner/accelerators", AcceleratorPoolsAPIHandler),
+    (r"/api/swarmspawner/images", ImageDigestsAPIHandler),
+]
@@ -0,0 +1,165 @@
+"""
+Resolution of image tags to the digests that they currently refer to.
+
+When a service is created with an image tag, the Swarm manager queries the
+registry for the digest of the tag before the service is created, which
+adds a registry round trip to every spawn and fails the spawn while the
+registry is unavailable. Instead, the spawner can create the services with
+pinned image@sha256: references from a cache that is refreshed in the
+background.
+"""
+
+import time
+from asyncio import ensure_future, get_running_loop, sleep
+from collections import OrderedDict
+from jhub.clients import get_client_pool
+from jhub.metrics import IMAGE_DIGEST_RESOLUTIONS
+
+
+def is_pinned(image):
+    return "@" in image
+
+
+class ImageDigests:
+    """
+    Caches the digest that each image tag resolves to.
+
+    A digest that is older than ttl seconds is resolved again before it is
+    used, and the last known digest is used if the registry can't be
+    reached. The digests of the images that have been used within the last
+    ttl seconds are refreshed in the background every refresh_interval
+    seconds, such that spawns rarely wait on the registry. If
+    refresh_interval is 0, the digests are only resolved when they are used.
+    At most max_images digests are kept, the least recently used are
+    forgotten first.
+    """
+
+    _instance = None
+
+    def __init__(self, ttl=3600, refresh_interval=300, max_images=256):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.max_images = max_images
+        # image -> (digest, time.monotonic() when it was resolved), where the
+        # least recently used image is first
+        self._digests = OrderedDict()
+        # image -> time.monotonic() when it was last used
+        self._used = {}
+        self._refresher = None
+
+    @classmethod
+    def get(cls, ttl=None, refresh_interval=None, max_images=None):
+        """The digests of the hub process"""
+        if cls._instance is None:
+            cls._instance = cls()
+        instance = cls._instance
+        if ttl is not None:
+            instance.ttl = ttl
+        if refresh_interval is not None:
+            instance.refresh_interval = refresh_interval
+        if max_images is not None:
+            instance.max_images = max_images
+        return instance
+
+    @property
+    def digests(self):
+        """The last known digest of each image tag, e.g. for pre-pulling"""
+        return {image: digest for image, (digest, _) in self._digests.items()}
+
+    def digest(self, image):
+        if image not in self._digests:
+            return None
+        return self._digests[image][0]
+
+    def _use(self, image):
+        if image in self._digests:
+            self._digests.move_to_end(image)
+            self._used[image] = time.monotonic()
+
+    def _store(self, image, digest, resolved):
+        self._digests[image] = (digest, resolved)
+        self._digests.move_to_end(image)
+        while len(self._digests) > max(self.max_images, 1):
+            evicted, _ = self._digests.popitem(last=False)
+            self._used.pop(evicted, None)
+
+    def pin(self, image):
+        """The image@digest reference of the image if its digest is cached"""
+        digest = self.digest(image)
+        if is_pinned(image) or digest is None:
+            return image
+        self._use(image)
+        return "{}@{}".format(image, digest)
+
+    def remember(self, reference):
+        """Use the digest of an image@digest reference, e.g. of an existing
+        service, as the last known digest of its tag, unless it is cached.
+        The digest is resolved again when it is used."""
+        if not is_pinned(reference):
+            return
+        image, digest = reference.split("@", 1)
+        if image not in self._digests:
+            self._store(image, digest, float("-inf"))
+
+    def forget(self, image):
+        self._digests.pop(image, None)
+        self._used.pop(image, None)
+
+    async def resolve(self, image):
+        """The image@digest reference of the image, where the digest is resolved
+        if it isn't cached or is older than ttl seconds. Raises the error of the
+        Docker API if the digest can't be resolved and none is cached."""
+        if is_pinned(image):
+            return image
+        self._ensure_refresher()
+        if image in self._digests:
+            _, resolved = self._digests[image]
+            if time.monotonic() - resolved < self.ttl:
+                IMAGE_DIGEST_RESOLUTIONS.labels(result="cached").inc()
+                return self.pin(image)
+        try:
+            await self._resolve(image)
+        except Exception:
+            if image not in self._digests:
+                IMAGE_DIGEST_RESOLUTIONS.labels(result="failed").inc()
+                raise
+            IMAGE_DIGEST_RESOLUTIONS.labels(result="stale").inc()
+        else:
+            IMAGE_DIGEST_RESOLUTIONS.labels(result="resolved").inc()
+        return self.pin(image)
+
+    async def _resolve(self, image):
+        distribution = await get_client_pool().call_async("inspect_distribution", image)
+        self._store(image, distribution["Descriptor"]["Digest"], time.monotonic())
+
+    def _ensure_refresher(self):
+        if self.refresh_interval <= 0:
+            return
+        loop = get_running_loop()
+        if (
+            self._refresher is None
+            or self._refresher.done()
+            or self._refresher.get_loop() is not loop
+        ):
+            self._refresher = ensure_future(self._refresh())
+
+    def recently_used(self, now=None):
+        """The images that have been used within the last ttl seconds"""
+        if now is None:
+            now = time.monotonic()
+        return [
+            image
+            for image in self._digests
+            if now - self._used.get(image, float("-inf")) < self.ttl
+        ]
+
+    async def _refresh(self):
+        while self.refresh_interval > 0:
+            await sleep(self.refresh_interval)
+            # The images that aren't used are resolved again when they are
+            for image in self.recently_used():
+                try:
+                    await self._resolve(image)
+                except Exception:
+                    # The last known digest is used until the registry recovers
+                    IMAGE_DIGEST_RESOLUTIONS.labels(result="failed").inc()
@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from jhub.defaults import default_base_path
+from jhub.io import makedirs
+
+default_ledger_path = os.path.join(default_base_path, "accelerators.db")
+
+
+class AcceleratorLedger:
+    """
+    Durable ledger of which accelerators are claimed by which owner.
+    Every claim and release is an atomic transaction on a SQLite
+    database, such that the allocations survive a hub restart and can be
+    shared between multiple hub processes on the same host.
+
+    Each write bumps the generation of the pool, which allows a process
+    to detect whether another process has changed the pool since it last
+    loaded it.
+    """
+
+    def __init__(self, path=default_ledger_path, timeout=30):
+        self._path = path
+        self._timeout = timeout
+        self._connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            dir_path = os.path.dirname(self._path)
+            if dir_path and not os.path.exists(dir_path):
+                makedirs(dir_path)
+            # Transactions are controlled explicitly via BEGIN IMMEDIATE
+            self._connection = sqlite3.connect(
+                self._path,
+                timeout=self._timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS accelerators ("
+                "pool TEXT NOT NULL, "
+                "node TEXT NOT NULL, "
+                "id TEXT NOT NULL, "
+                "shares INTEGER NOT NULL DEFAULT 1, "
+                "PRIMARY KEY (pool, node, id))"
+            )
+            # An accelerator can be claimed by as many owners as it has shares
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS claims ("
+                "pool TEXT NOT NULL, "
+                "node TEXT NOT NULL, "
+                "id TEXT NOT NULL, "
+                "owner TEXT NOT NULL, "
+                "claimed_at REAL, "
+                "PRIMARY KEY (pool, node, id, owner))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS claims_owner ON claims (pool, owner)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "pool TEXT PRIMARY KEY, "
+                "generation INTEGER NOT NULL)"
+            )
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        """Exclusive write transaction across every process using the ledger"""
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        else:
+            cursor.execute("COMMIT")
+        finally:
+            cursor.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def generation(self, cursor, pool):
+        row = cursor.execute(
+            "SELECT generation FROM generations WHERE pool = ?", (pool,)
+        ).fetchone()
+        if not row:
+            return 0
+        return row[0]
+
+    def bump_generation(self, cursor, pool):
+        cursor.execute(
+            "INSERT INTO generations (pool, generation) VALUES (?, 1) "
+            "ON CONFLICT (pool) DO UPDATE SET generation = generation + 1",
+            (pool,),
+        )
+        return self.generation(cursor, pool)
+
+    def register(self, cursor, pool, devices):
+        """Ensure that the ledger contains exactly the (node, id, shares) devices
+        of the pool. Existing claims of devices that are still part of the pool
+        are kept."""
+        cursor.executemany(
+            "INSERT INTO accelerators (pool, node, id, shares) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (pool, node, id) DO UPDATE SET shares = excluded.shares",
+            [(pool, node, _id, shares) for node, _id, shares in devices],
+        )
+        current_devices = cursor.execute(
+            "SELECT node, id FROM accelerators WHERE pool = ?", (pool,)
+        ).fetchall()
+        removed_devices = set(current_devices) - set(
+            (node, _id) for node, _id, _ in devices
+        )
+        for statement in (
+            "DELETE FROM accelerators WHERE pool = ? AND node = ? AND id = ?",
+            "DELETE FROM claims WHERE pool = ? AND node = ? AND id = ?",
+        ):
+            cursor.executemany(
+                statement, [(pool, node, _id) for node, _id in removed_devices]
+            )
+        return self.bump_generation(cursor, pool)
+
+    def load(self, cursor, pool):
+        """Returns the (node, id, shares) devices and the
+        (node, id, owner, claimed_at) claims of the pool"""
+        devices = cursor.execute(
+            "SELECT node, id, shares FROM accelerators WHERE pool = ?", (pool,)
+        ).fetchall()
+        claims = cursor.execute(
+            "SELECT node, id, owner, claimed_at FROM claims WHERE pool = ?", (pool,)
+        ).fetchall()
+        return devices, claims
+
+    def claim(self, cursor, pool, owner, devices):
+        """Record that the owner has claimed the (node, id) devices"""
+        now = time.time()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO claims (pool, node, id, owner, claimed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(pool, node, _id, owner, now) for node, _id in devices],
+        )
+        return self.bump_generation(cursor, pool)
+
+    def release(self, cursor, pool, owner):
+        """Record that the owner has released every device that it had claimed"""
+        cursor.execute(
+            "DELETE FROM claims WHERE pool = ? AND owner = ?",
+            (pool, owner),
+        )
+        return self.bump_generation(cursor, pool)
+
+    def reconcile(self, cursor, pool, claims, owners=None):
+        """Merge the supplied dictionary of owners and the (node, id) devices
+        they actually use into the recorded claims of the pool. Only the claims
+        of the owners in claims and of the additional owners are replaced,
+        such that the claims of other hubs and processes are kept.
+        Devices that are not part of the pool are ignored."""
+        owners = set(owners or ()) | set(claims)
+        devices, current_claims = self.load(cursor, pool)
+        known_devices = set((node, _id) for node, _id, _ in devices)
+        expected_claims = set(
+            (node, _id, owner)
+            for owner, owner_devices in claims.items()
+            for node, _id in owner_devices
+            if (node, _id) in known_devices
+        )
+        existing_claims = set(
+            (node, _id, owner)
+            for node, _id, owner, _ in current_claims
+            if owner in owners
+        )
+        cursor.executemany(
+            "DELETE FROM claims WHERE pool = ? AND node = ? AND id = ? AND owner = ?",
+            [
+                (pool, node, _id, owner)
+                for node, _id, owner in existing_claims - expected_claims
+            ],
+        )
+        now = time.time()
+        cursor.executemany(
+            "INSERT INTO claims (pool, node, id, owner, claimed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (pool, node, _id, owner, now)
+                for node, _id, owner in expected_claims - existing_claims
+            ],
+        )
+        return self.bump_generation(cursor, pool)
@@ -0,0 +1,124 @@
+"""
+Prometheus metrics of the SwarmSpawner.
+
+The metrics are registered in the default prometheus_client registry,
+which JupyterHub exports via its /hub/metrics endpoint.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+
+ACCELERATOR_CLAIMS = Counter(
+    "swarmspawner_accelerator_claims_total",
+    "Number of accelerator claims by their result",
+    ["type", "result"],
+)
+
+ACCELERATOR_CLAIM_DURATION = Histogram(
+    "swarmspawner_accelerator_claim_duration_seconds",
+    "Time spent waiting for an accelerator claim to be resolved",
+    ["type"],
+)
+
+
+class AcceleratorPoolCollector:
+    """
+    Collects the gauges of the accelerator pools that are returned by pools
+    when the metrics are scraped, such that the collector doesn't keep the
+    pools alive. The gauges are labeled with the name of each pool, since
+    several pools can share a type.
+    """
+
+    def __init__(self, pools):
+        self._pools = pools
+
+    def collect(self):
+        free = GaugeMetricFamily(
+            "swarmspawner_accelerators_free",
+            "Number of accelerators with unclaimed shares",
+            labels=["pool", "type", "node"],
+        )
+        claimed = GaugeMetricFamily(
+            "swarmspawner_accelerators_claimed",
+            "Number of accelerators with at least one claimed share",
+            labels=["pool", "type", "node"],
+        )
+        utilization = GaugeMetricFamily(
+            "swarmspawner_accelerator_utilization_ratio",
+            "Time-weighted fraction of the accelerator's shares that "
+            "have been claimed",
+            labels=["pool", "type", "node", "id"],
+        )
+        for pool in self._pools():
+            for node in pool.inventory.nodes:
+                labels = [pool.name, pool.type, node]
+                free.add_metric(labels, pool.inventory.free(node))
+                claimed.add_metric(labels, pool.inventory.claimed(node))
+            for (node, _id), ratio in pool.utilization().items():
+                utilization.add_metric([pool.name, pool.type, node, _id], ratio)
+        yield free
+        yield claimed
+        yield utilization
+
+
+MOUNT_CREATE_DURATION = Histogram(
+    "swarmspawner_mount_create_duration_seconds",
+    "Time spent preparing a mount of a spawned service",
+    ["mounter", "result"],
+)
+
+DOCKER_REQUEST_DURATION = Histogram(
+    "swarmspawner_docker_request_duration_seconds",
+    "Time spent on a Docker API request",
+    ["method", "endpoint"],
+)
+
+DOCKER_HEDGED_REQUESTS = Counter(
+    "swarmspawner_docker_hedged_requests_total",
+    "Number of reads that were hedged to a second manager, by the response used",
+    ["method", "response"],
+)
+
+DOCKER_CIRCUIT_TRANSITIONS = Counter(
+    "swarmspawner_docker_circuit_transitions_total",
+    "Number of times the circuit of a Docker endpoint changed to the state",
+    ["endpoint", "state"],
+)
+
+DOCKER_CIRCUIT_OPEN = Gauge(
+    "swarmspawner_docker_circuit_open",
+    "Whether the circuit of a Docker endpoint is open or half open",
+    ["endpoint"],
+)
+
+DOCKER_COALESCED_REQUESTS = Counter(
+    "swarmspawner_docker_coalesced_requests_total",
+    "Number of Docker reads that reused the response of an identical read, "
+    "either in flight or cached",
+    ["method", "source"],
+)
+
+POLL_STALENESS = Histogram(
+    "swarmspawner_poll_staleness_seconds",
+    "Age of the server status that poll returned, 0 if it was just polled",
+    buckets=(0, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")),
+)
+
+POLLS_SCHEDULED = Gauge(
+    "swarmspawner_polls_scheduled",
+    "Number of servers whose polls are scheduled by the adaptive poll scheduler",
+)
+
+POLL_INTERVAL = Histogram(
+    "swarmspawner_poll_interval_seconds",
+    "Interval until the next poll of a server by the adaptive poll scheduler",
+    buckets=(1, 2.5, 5, 10, 15, 30, 60, 120, 300, 600, float("inf")),
+)
+
+IMAGE_DIGEST_RESOLUTIONS = Counter(
+    "swarmspawner_image_digest_resolutions_total",
+    "Number of image digest lookups, by whether the digest was cached, "
+    "resolved, stale or failed to resolve",
+    ["result"],
+)
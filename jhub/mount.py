@@ -1,11 +1,86 @@
 import copy
+import json
+from asyncio import ensure_future, shield
+from collections import OrderedDict
 from traitlets.config import LoggingConfigurable
 from docker.types import DriverConfig, Mount
 from jhub.util import recursive_format
+from jhub.volumes import WARM_POOL_LABEL
+
+# The number of formatted mounts that each mounter caches
+default_mount_cache_size = 128
+
+_volume_mounters = OrderedDict()
+
+
+def compile_templates(config, path=()):
+    """Returns the (path, template) of every string in the config that
+    can be changed by formatting, or None if the config contains
+    objects that recursive_format would have to traverse"""
+    if isinstance(config, dict):
+        items = config.items()
+    elif isinstance(config, list):
+        items = enumerate(config)
+    elif isinstance(config, str):
+        if "{" in config or "}" in config:
+            return [(path, config)]
+        return []
+    elif hasattr(config, "__dict__"):
+        return None
+    else:
+        return []
+
+    templates = []
+    for key, value in items:
+        value_templates = compile_templates(value, path + (key,))
+        if value_templates is None:
+            return None
+        templates.extend(value_templates)
+    return templates
+
+
+def format_template(template, values):
+    """Format the template with each of the values in turn,
+    like recursive_format does for every string in a config"""
+    for value in values:
+        try:
+            template = template.format(**value)
+        except KeyError:
+            continue
+    return template
+
+
+def get_volume_mounter(mount_config, cache_size=default_mount_cache_size):
+    """Returns a cached VolumeMounter of a dictionary mount config"""
+    key = json.dumps(mount_config, sort_keys=True, default=str)
+    mounter = _volume_mounters.get(key)
+    if mounter is None:
+        mounter = VolumeMounter(mount_config)
+        _volume_mounters[key] = mounter
+        if len(_volume_mounters) > cache_size:
+            _volume_mounters.popitem(last=False)
+    else:
+        _volume_mounters.move_to_end(key)
+    return mounter
 
 
 class Mounter(LoggingConfigurable):
-    def __init__(self, mount_config):
+    """
+    A mount of a spawned service with the following lifecycle:
+
+    - prepare, provisions the storage of the mount before the service
+      is created, e.g. a per-user directory or quota. Each distinct set
+      of formatted values is only prepared once per mounter.
+    - create, returns the Docker Mount that is attached to the service.
+    - cleanup, undoes any per-spawn state after the service is removed.
+
+    The mounts of a spawn are prepared, created and cleaned up concurrently.
+    """
+
+    # Keys that must be present in the mount config
+    required_config_keys = []
+
+    def __init__(self, mount_config, cache_size=default_mount_cache_size):
         LoggingConfigurable.__init__(self)
         if not isinstance(mount_config, dict):
             raise Exception("A dictionary typed config is expected")
@@ -14,7 +89,25 @@ class Mounter(LoggingConfigurable):
         # Ensure that we don't change the passed in config,
         # But only use it. Deep copy is allowed if it is of type Config
         self.log.debug("instantiating Mounter with config: {}".format(mount_config))
-        self._mount_config = mount_config
+        self._cache_size = cache_size
+        self._mounts = OrderedDict()
+        self._provisioned = OrderedDict()
+        self.mount_config = mount_config
+
+    def compile_config(self, mount_config):
+        """Validate the keys and extract the format templates of the config
+        once, rather than every time a mount is created"""
+        missing_keys = [
+            key for key in self.required_config_keys if key not in mount_config
+        ]
+        if missing_keys:
+            self.log.error("Missing configure keys {}".format(",".join(missing_keys)))
+            raise KeyError(
+                "A mount configuration error was encountered due to missing keys."
+            )
+        self._templates = compile_templates(mount_config)
+        self._mounts.clear()
+        self._provisioned.clear()
 
     @property
     def mount_config(self):
@@ -25,9 +118,10 @@ class Mounter(LoggingConfigurable):
     def mount_config(self, mount_config):
         self.log.debug(
             "Setting config: {} overwriting: {}".format(
-                self._mount_config, mount_config
+                getattr(self, "_mount_config", None), mount_config
             )
         )
+        self.compile_config(mount_config)
         self._mount_config = mount_config
 
     async def gen_config_copy(self):
@@ -42,30 +136,107 @@ class Mounter(LoggingConfigurable):
             recursive_format(mount_config, value)
         self.log.debug("new formatted config: {}".format(mount_config))
 
+    async def create_mount(self, mount_config):
+        raise NotImplementedError
+
+    async def validate_config(self, mount_config):
+        pass
+
+    def format_key(self, **format_mount_config_kwargs):
+        """The formatted values of the config, or None if the config
+        can't be compiled"""
+        if self._templates is None:
+            return None
+        values = list(format_mount_config_kwargs.values())
+        return tuple(
+            format_template(template, values) for _, template in self._templates
+        )
+
+    async def prepare(self, **format_mount_config_kwargs):
+        """Provision the storage of the mount, does nothing by default"""
+
+    async def cleanup(self, **format_mount_config_kwargs):
+        """Undo any per-spawn state of the mount, does nothing by default"""
+
+    async def provision(self, **format_mount_config_kwargs):
+        """Prepare the mount, unless it has already been provisioned
+        with the same formatted values"""
+        key = self.format_key(**format_mount_config_kwargs)
+        if key is None:
+            return await self.prepare(**format_mount_config_kwargs)
+
+        provisioned = self._provisioned.get(key)
+        if provisioned is None:
+            # Concurrent spawns with the same values share the preparation
+            provisioned = ensure_future(self.prepare(**format_mount_config_kwargs))
+            self._provisioned[key] = provisioned
+            if len(self._provisioned) > self._cache_size:
+                self._provisioned.popitem(last=False)
+        else:
+            self._provisioned.move_to_end(key)
+        try:
+            await shield(provisioned)
+        except Exception:
+            # Retry the preparation on the next spawn
+            if self._provisioned.get(key) is provisioned:
+                del self._provisioned[key]
+            raise
+
+    def forget_provisioned(self, **format_mount_config_kwargs):
+        """Prepare the mount again on the next spawn, e.g. if cleanup
+        removed the provisioned storage"""
+        self._provisioned.pop(self.format_key(**format_mount_config_kwargs), None)
+
+    async def create(self, **format_mount_config_kwargs):
+        """Returns the Mount of the config formatted with the kwargs.
+        The Mount of each distinct set of formatted values is cached"""
+        self.log.debug(
+            "Creating {} with options {}".format(
+                type(self).__name__, format_mount_config_kwargs
+            )
+        )
+        formatted = self.format_key(**format_mount_config_kwargs)
+        if formatted is None:
+            new_config = await self.gen_config_copy()
+            await self.format_config(new_config, **format_mount_config_kwargs)
+            await self.validate_config(new_config)
+            return await self.create_mount(new_config)
+
+        mount = self._mounts.get(formatted)
+        if mount is None:
+            new_config = await self.gen_config_copy()
+            for (path, _), value in zip(self._templates, formatted):
+                parent = new_config
+                for key in path[:-1]:
+                    parent = parent[key]
+                parent[path[-1]] = value
+            await self.validate_config(new_config)
+            mount = await self.create_mount(new_config)
+            self._mounts[formatted] = mount
+            if len(self._mounts) > self._cache_size:
+                self._mounts.popitem(last=False)
+        else:
+            self._mounts.move_to_end(formatted)
+        # The caller is free to modify the returned mount
+        return copy.deepcopy(mount)
+
 
 class VolumeMounter(Mounter):
-    def __init__(self, mount_config):
-        Mounter.__init__(self, mount_config)
+    required_config_keys = ["source", "target"]
+
+    def __init__(self, mount_config, cache_size=default_mount_cache_size):
+        Mounter.__init__(self, mount_config, cache_size=cache_size)
 
     async def create_mount(self, mount_config):
         mount_settings = {}
         mount_settings.update(mount_config)
         return Mount(**mount_settings)
 
-    async def create(self, **format_mount_config_kwargs):
-        self.log.debug(
-            "Creating VolumeMount with options {}".format(format_mount_config_kwargs)
-        )
-        new_mount_config = await self.gen_config_copy()
-        await self.format_config(new_mount_config, **format_mount_config_kwargs)
-        await self.validate_config(new_mount_config)
-        mount = await self.create_mount(new_mount_config)
-        return mount
-
     async def validate_config(self, mount_config):
         self.log.debug("validate_config")
-        required_config_keys = ["source", "target"]
-        missing_keys = [key for key in required_config_keys if key not in mount_config]
+        missing_keys = [
+            key for key in self.required_config_keys if key not in mount_config
+        ]
 
         if missing_keys:
             self.log.error("Missing configure keys {}".format(",".join(missing_keys)))
@@ -85,8 +256,18 @@ class VolumeMounter(Mounter):
 
 
 class SSHFSMounter(Mounter):
-    def __init__(self, mount_options):
-        Mounter.__init__(self, mount_options)
+    required_config_keys = ["source", "target", "type", "driver_config"]
+
+    def __init__(
+        self, mount_options, cache_size=default_mount_cache_size, warm_pool=None
+    ):
+        # The WarmVolumePool that keeps the volumes after their service is removed
+        self._warm_pool = warm_pool
+        Mounter.__init__(self, mount_options, cache_size=cache_size)
+
+    @property
+    def warm_pool(self):
+        return self._warm_pool
 
     async def create_mount(self, mount_config):
         self.log.debug("create_mount from config: {}".format(mount_config))
@@ -101,12 +282,24 @@ class SSHFSMounter(Mounter):
         # Override the DriverConfig to be the correct type
         # as expected by the Docker module.
         mount_settings["driver_config"] = driver_config
+        if self._warm_pool is not None:
+            # Keep the volume when the service is removed
+            driver_config["Options"] = {
+                key: value
+                for key, value in driver_config["Options"].items()
+                if key != "ephemeral"
+            }
+            labels = dict(mount_settings.get("labels") or {})
+            labels.pop("autoremove", None)
+            labels[WARM_POOL_LABEL] = self._warm_pool.name
+            mount_settings["labels"] = labels
         return Mount(**mount_settings)
 
     async def validate_config(self, mount_config):
         self.log.debug("validate_config")
-        required_config_keys = ["source", "target", "type", "driver_config"]
-        missing_keys = [key for key in required_config_keys if key not in mount_config]
+        missing_keys = [
+            key for key in self.required_config_keys if key not in mount_config
+        ]
 
         if missing_keys:
             self.log.error("Missing configure keys {}".format(",".join(missing_keys)))
@@ -123,10 +316,3 @@ class SSHFSMounter(Mounter):
             raise ValueError(
                 "A mount configuration error was encountered, due to missing values"
             )
-
-    async def create(self, **format_mount_config_kwargs):
-        new_config = await self.gen_config_copy()
-        await self.format_config(new_config, **format_mount_config_kwargs)
-        await self.validate_config(new_config)
-        mount = await self.create_mount(new_config)
-        return mount
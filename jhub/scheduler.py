@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import random
+import weakref
+from asyncio import (
+    Event,
+    TimeoutError,
+    ensure_future,
+    get_running_loop,
+    sleep,
+    wait_for,
+)
+from jhub.metrics import POLL_INTERVAL, POLLS_SCHEDULED
+
+
+class ScheduledPoll:
+    """
+    The poll of a server, which is repeated every interval seconds with
+    jitter. The interval is reset to min_interval when the poll reports
+    that the server's state changed, and is otherwise increased by the
+    backoff factor up to max_interval.
+    """
+
+    def __init__(
+        self, poll, interval, min_interval, max_interval, jitter=0.1, backoff=1.5
+    ):
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.jitter = jitter
+        self.backoff = backoff
+        self.key = None
+        self.due = None
+
+    def adapt(self, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def next_delay(self):
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class PollScheduler:
+    """
+    Runs the scheduled polls of every server from a single task, instead
+    of a periodic callback per server that fires in bursts.
+
+    The first poll of a server is placed uniformly at random within its
+    interval, such that the polls of the servers that are scheduled at the
+    same time, e.g. when the hub restarts, are spread out.
+    At most max_rate polls are started per second, if max_rate is positive.
+    """
+
+    _schedulers = weakref.WeakKeyDictionary()
+
+    def __init__(self, max_rate=0):
+        self._max_rate = max_rate
+        self._polls = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._wakeup = Event()
+        self._task = None
+        # The event loop only keeps weak references to the running polls
+        self._running = set()
+        self._last_started = None
+
+    @classmethod
+    def get(cls, max_rate=0):
+        """The scheduler of the running event loop"""
+        loop = get_running_loop()
+        if loop not in cls._schedulers:
+            cls._schedulers[loop] = cls()
+        scheduler = cls._schedulers[loop]
+        scheduler._max_rate = max_rate
+        return scheduler
+
+    @property
+    def scheduled(self):
+        return len(self._polls)
+
+    def is_scheduled(self, scheduled_poll):
+        return self._polls.get(scheduled_poll.key) is scheduled_poll
+
+    def schedule(self, key, scheduled_poll):
+        scheduled_poll.key = key
+        scheduled_poll.due = get_running_loop().time() + random.uniform(
+            0, scheduled_poll.interval
+        )
+        self._polls[key] = scheduled_poll
+        self._push(scheduled_poll)
+        POLLS_SCHEDULED.set(len(self._polls))
+        if self._task is None or self._task.done():
+            self._task = ensure_future(self._run())
+
+    def unschedule(self, key):
+        if self._polls.pop(key, None) is not None:
+            POLLS_SCHEDULED.set(len(self._polls))
+            self._wakeup.set()
+
+    def _push(self, scheduled_poll):
+        heapq.heappush(
+            self._heap, (scheduled_poll.due, next(self._sequence), scheduled_poll)
+        )
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = get_running_loop()
+        while self._heap:
+            due, _, scheduled_poll = self._heap[0]
+            if not self.is_scheduled(scheduled_poll) or scheduled_poll.due != due:
+                # The poll has been unscheduled or rescheduled
+                heapq.heappop(self._heap)
+                continue
+            delay = due - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await wait_for(self._wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+
+            if self._max_rate > 0 and self._last_started is not None:
+                delay = self._last_started + 1 / self._max_rate - loop.time()
+                if delay > 0:
+                    await sleep(delay)
+                if not self.is_scheduled(scheduled_poll):
+                    continue
+            self._last_started = loop.time()
+            running = ensure_future(self._poll(scheduled_poll))
+            self._running.add(running)
+            running.add_done_callback(self._running.discard)
+
+    async def _poll(self, scheduled_poll):
+        try:
+            changed = await scheduled_poll.poll()
+        except Exception:
+            # The poll is expected to handle its errors, retry it soon
+            changed = True
+        if not self.is_scheduled(scheduled_poll):
+            return
+        scheduled_poll.adapt(changed)
+        POLL_INTERVAL.observe(scheduled_poll.interval)
+        scheduled_poll.due = get_running_loop().time() + scheduled_poll.next_delay()
+        self._push(scheduled_poll)
+        if self._task is None or self._task.done():
+            self._task = ensure_future(self._run())
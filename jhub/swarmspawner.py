@@ -7,13 +7,23 @@ import ast
 import copy
 import docker
 import hashlib
+import json
 import os
-from asyncio import sleep
+import time
+import weakref
+from asyncio import (
+    ensure_future,
+    gather,
+    get_running_loop,
+    sleep,
+    wait_for,
+    Semaphore,
+    TimeoutError,
+)
 from textwrap import dedent
-from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
+from requests.exceptions import RequestException
 from docker.errors import APIError
-from docker.tls import TLSConfig
 from docker.types import (
     TaskTemplate,
     Resources,
@@ -22,19 +32,106 @@ from docker.types import (
     Placement,
     ConfigReference,
     EndpointSpec,
+    ServiceMode,
 )
-from docker.utils import kwargs_from_env
 from jupyterhub.spawner import Spawner
-from traitlets import default, Dict, Unicode, List, Bool, Int
-from jhub.mount import VolumeMounter
-from jhub.util import recursive_format
-
+from traitlets import default, Dict, Unicode, List, Bool, Int, Float, Instance
+from jhub._version import __version__
+from jhub.accelerators import AcceleratorQueueFull
+from jhub.clients import (
+    configure_client_pool,
+    create_docker_client,
+    default_timeout,
+    get_client_pool,
+    is_unavailable,
+)
+from jhub.images import ImageDigests
+from jhub.metrics import MOUNT_CREATE_DURATION, POLL_STALENESS
+from jhub.mount import get_volume_mounter
+from jhub.scheduler import PollScheduler, ScheduledPoll
+from jhub.tasks import TaskRecord
+from jhub.uids import UIDAllocator
+from jhub.util import PhaseTimer, recursive_format
+from jhub.volumes import (
+    WarmVolumePool,
+    WARM_POOL_LABEL,
+    WARM_VOLUME_LABEL,
+    get_keeper_name,
+)
 
-def get_user_uid_gid(dictionary, delimiter=":"):
+# Labels that are attached to every service spawned by the SwarmSpawner.
+# They identify which hub, user and server owns the service and allows
+# the services to be looked up and listed via label filters.
+LABEL_PREFIX = "jhub.swarmspawner"
+HUB_ID_LABEL = "{}.hub_id".format(LABEL_PREFIX)
+USER_LABEL = "{}.user".format(LABEL_PREFIX)
+SERVER_NAME_LABEL = "{}.server_name".format(LABEL_PREFIX)
+IMAGE_LABEL = "{}.image".format(LABEL_PREFIX)
+VERSION_LABEL = "{}.version".format(LABEL_PREFIX)
+ACCELERATOR_NODE_LABEL = "{}.accelerator_node".format(LABEL_PREFIX)
+# Followed by the type of the pool, e.g. jhub.swarmspawner.accelerators.gpu
+ACCELERATORS_LABEL = "{}.accelerators".format(LABEL_PREFIX)
+SPEC_HASH_LABEL = "{}.spec_hash".format(LABEL_PREFIX)
+SUSPENDED_LABEL = "{}.suspended_at".format(LABEL_PREFIX)
+
+# The environment variable that exposes the claimed accelerators to the service
+ACCELERATOR_ENV = "NVIDIA_VISIBLE_DEVICES"
+
+# The environment variables whose values change on every spawn of a server
+VOLATILE_ENV = ("JUPYTERHUB_API_TOKEN", "JPY_API_TOKEN")
+
+
+def format_label_filters(labels):
+    """Convert a dictionary of labels into a Docker label filter list"""
+    return ["{}={}".format(key, value) for key, value in labels.items()]
+
+
+def get_accelerators_label(pool_type):
+    """The service label of the accelerator ids claimed from the pool type"""
+    return "{}.{}".format(ACCELERATORS_LABEL, pool_type)
+
+
+def get_env_name(line):
+    return line.split("=", 1)[0]
+
+
+def spec_hash(task_template, ignored_env=(), ignored_configs=()):
+    """A stable hash of a TaskTemplate, which leaves out the values that
+    change between spawns of the same server, i.e. the API token, the
+    ids of the configs and the additional ignored env names and config names"""
+    spec = json.loads(json.dumps(task_template, default=str))
+    container_spec = spec.get("ContainerSpec") or {}
+    if container_spec.get("Env"):
+        container_spec["Env"] = [
+            line
+            for line in container_spec["Env"]
+            if get_env_name(line) not in VOLATILE_ENV
+            and get_env_name(line) not in ignored_env
+        ]
+    if container_spec.get("Configs"):
+        container_spec["Configs"] = [
+            config
+            for config in container_spec["Configs"]
+            if config.get("ConfigName") not in ignored_configs
+        ]
+    for config in container_spec.get("Configs") or []:
+        config.pop("ConfigID", None)
+    content = json.dumps(spec, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_user_uid_gid(dictionary, delimiter=":", format_values=None):
     uid_gid = dictionary.get("uid_gid", {})
     if not uid_gid:
         return None, None
 
+    # E.g. "{uid}:{gid}" with the ids assigned by the uid_allocator
+    if format_values and isinstance(uid_gid, str):
+        try:
+            uid_gid = uid_gid.format(**format_values)
+        except KeyError:
+            pass
+
     if delimiter not in uid_gid:
         return None, None
 
@@ -56,42 +153,41 @@ def prepare_user_config_reference(
 
 
 def get_docker_client(api_client_kwargs=None, tls_kwargs=None):
-    if not api_client_kwargs:
-        api_client_kwargs = {}
-    if not tls_kwargs:
-        tls_kwargs = {}
-
-    kwargs = {}
-    if api_client_kwargs:
-        kwargs.update(api_client_kwargs)
+    return create_docker_client(
+        api_client_kwargs=api_client_kwargs, tls_kwargs=tls_kwargs
+    )
 
-    if tls_kwargs:
-        kwargs["tls"] = TLSConfig(**tls_kwargs)
 
-    kwargs.update(kwargs_from_env())
-    return docker.APIClient(version="auto", **kwargs)
+async def run_docker_async(method_name, *args, **kwargs):
+    """Call the method_name of the Docker APIClient via the shared client pool,
+    without blocking the event loop"""
+    client_pool = get_client_pool()
+    if not get_instance_function(docker.APIClient, method_name):
+        return False
+    return await client_pool.call_async(method_name, *args, **kwargs)
 
 
-def run_docker(method_name, *args, **kwargs):
-    client = get_docker_client()
-    docker_method = get_instance_function(client, method_name)
-    if not docker_method:
+async def run_node_docker_async(endpoint, method_name, *args, **kwargs):
+    """Call the method_name of the Docker APIClient of a node's own daemon,
+    or of the primary endpoint if endpoint is None"""
+    client_pool = get_client_pool()
+    if not get_instance_function(docker.APIClient, method_name):
         return False
-    return run_with_executor(docker_method, *args, **kwargs).result()
+    return await client_pool.call_node_async(endpoint, method_name, *args, **kwargs)
 
 
-def get_config(config_name_or_id):
+async def get_config(config_name_or_id):
     try:
-        found = run_docker("inspect_config", config_name_or_id)
+        found = await run_docker_async("inspect_config", config_name_or_id)
         return True, found
     except docker.errors.NotFound:
         return False, "Docker config: {} does not exist".format(config_name_or_id)
     return False, "Unknown error for finding the config"
 
 
-def prune_config(config_name_or_id):
+async def prune_config(config_name_or_id):
     try:
-        removed = run_docker("remove_config", config_name_or_id)
+        removed = await run_docker_async("remove_config", config_name_or_id)
         return True, removed
     except docker.errors.NotFound:
         return False, "Can't remove config: {} because it does not exist".format(
@@ -100,20 +196,64 @@ def prune_config(config_name_or_id):
     return False, "Failed to remove config: {}, unknown error".format(config_name_or_id)
 
 
-def remove_volume(name):
+async def remove_volume(name, endpoint=None):
     try:
-        run_docker("remove_volume", name=name)
+        if endpoint is None:
+            await run_docker_async("remove_volume", name=name)
+        else:
+            await run_node_docker_async(endpoint, "remove_volume", name=name)
         return True, "removed volume: {}".format(name)
+    except docker.errors.NotFound:
+        return True, "volume: {} was already removed".format(name)
     except APIError as err:
         if err.response.status_code == 409:
             return False, "Failed to remove volume: {}".format(name)
     return False, "Unknown error occured while removing volume: {}".format(name)
 
 
-def run_with_executor(func, *args, **kwargs):
-    """Run a function in a thread pool executor"""
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        return executor.submit(func, *args, **kwargs)
+def get_service_owner_key(user_name):
+    """The unique identifier of the user that names the Docker objects that
+    are owned by the user.
+
+    Usernames that are longer than the 32 characters that fit into a
+    service name are suffixed with a digest of the complete username,
+    such that users who share the same 32 last characters don't collide.
+    """
+    if len(user_name) <= 32:
+        return user_name
+    digest = hashlib.md5(user_name.encode("utf-8")).hexdigest()[:8]
+    return "{}-{}".format(user_name[-23:], digest)
+
+
+def is_update_conflict(err):
+    """Whether the APIError of a service update means that the service was
+    updated concurrently, i.e. the version of the update is out of date"""
+    if err.status_code == 409:
+        return True
+    return "update out of sequence" in str(err.explanation or err)
+
+
+def get_warm_volumes(mounts):
+    """Returns the (WarmVolumePool, mount) of every mount
+    whose volume is kept warm by a pool"""
+    warm_volumes = []
+    for mount in mounts:
+        labels = (mount.get("VolumeOptions") or {}).get("Labels") or {}
+        pool = WarmVolumePool.get(labels.get(WARM_POOL_LABEL))
+        if pool is not None and mount.get("Source"):
+            warm_volumes.append((pool, mount))
+    return warm_volumes
+
+
+async def get_hub_services(hub_id, labels=None):
+    """List every service spawned by the hub with the given hub_id.
+    Additional labels can be supplied to further narrow the selection."""
+    filter_labels = {HUB_ID_LABEL: hub_id}
+    if labels:
+        filter_labels.update(labels)
+    return await run_docker_async(
+        "services", filters={"label": format_label_filters(filter_labels)}
+    )
 
 
 def get_instance_function(instance, func_name):
@@ -348,21 +488,20 @@ class SwarmSpawner(Spawner):
         self.log.debug("Options from form {}".format(options))
         return options
 
-    _client = None
-
     @property
     def client(self):
         """single global client instance"""
-        cls = self.__class__
-
-        if cls._client is None:
-            cls._client = get_docker_client()
-        return cls._client
+        return self.client_pool.client()
 
     _tasks = None
 
     service_id = Unicode()
 
+    # The current task of the service and the node that it is placed on
+    task_id = Unicode()
+
+    node_id = Unicode()
+
     service_port = Int(
         8888,
         min=1,
@@ -420,6 +559,17 @@ class SwarmSpawner(Spawner):
         ),
     ).tag(config=True)
 
+    accelerator_claim_timeout = Int(
+        0,
+        help=dedent(
+            """
+            Number of seconds that a spawn waits in the queue for a free accelerator
+            before failing. If 0, the spawn fails immediately when no accelerators
+            are available.
+            """
+        ),
+    ).tag(config=True)
+
     placement = Dict(
         {},
         help=dedent(
@@ -466,6 +616,20 @@ class SwarmSpawner(Spawner):
         ),
     ).tag(config=True)
 
+    hub_id = Unicode(
+        help=dedent(
+            """
+            Identifier of the JupyterHub that spawns the services. It is attached
+            as a label to every spawned service, such that multiple hubs can share
+            the same Docker Swarm. Defaults to the jupyterhub_service_name.
+            """
+        ),
+    ).tag(config=True)
+
+    @default("hub_id")
+    def _hub_id_default(self):
+        return self.jupyterhub_service_name
+
     user_format_attributes = List(
         default_value=[],
         traits=[Unicode()],
@@ -478,6 +642,321 @@ class SwarmSpawner(Spawner):
         ),
     ).tag(config=True)
 
+    uid_allocator = Instance(
+        UIDAllocator,
+        allow_none=True,
+        help=dedent(
+            """
+            Assigns each user a stable uid and gid when its server is spawned,
+            which are available as the {uid} and {gid} format values, e.g. in
+            the uid_gid option as "{uid}:{gid}" or in the env of an image.
+            """
+        ),
+    ).tag(config=True)
+
+    pin_image_digests = Bool(
+        False,
+        help=dedent(
+            """
+            Whether the services are created with image@sha256: references, where
+            the digests of the image tags are cached by the hub. Otherwise, the
+            Swarm manager queries the registry for the digest of the image tag
+            whenever a service is created.
+            """
+        ),
+    ).tag(config=True)
+
+    image_digest_ttl = Int(
+        3600,
+        help=dedent(
+            """
+            Number of seconds that a cached image digest is used for, after which
+            it is resolved again before a service is created. The last digest is
+            used if it can't be resolved.
+            """
+        ),
+    ).tag(config=True)
+
+    image_digest_refresh_interval = Int(
+        300,
+        help=dedent(
+            """
+            Number of seconds between the background refreshes of the cached image
+            digests. Only the digests of the images that have been used within the
+            image_digest_ttl are refreshed. If 0, the digests are only resolved
+            when they are used.
+            """
+        ),
+    ).tag(config=True)
+
+    image_digest_cache_size = Int(
+        256,
+        help=dedent(
+            """
+            Maximum number of image digests that are cached by the hub, where the
+            digests of the least recently used images are forgotten first.
+            """
+        ),
+    ).tag(config=True)
+
+    suspend_on_stop = Bool(
+        False,
+        help=dedent(
+            """
+            Whether a stopped server's service is scaled to 0 replicas instead of
+            being removed. The service is scaled back to 1 replica when the server
+            is started again, if the spec of the service is unchanged.
+            Otherwise, the service is replaced. Services that claimed accelerators
+            are always removed, such that the accelerators are released.
+            """
+        ),
+    ).tag(config=True)
+
+    suspend_ttl = Int(
+        86400,
+        help=dedent(
+            """
+            Number of seconds that a service is kept suspended before it is
+            removed along with its volumes that aren't kept.
+            If 0, suspended services are never removed.
+            """
+        ),
+    ).tag(config=True)
+
+    suspend_reap_interval = Int(
+        600,
+        help=dedent(
+            """
+            Number of seconds between the checks for services that have been
+            suspended for longer than suspend_ttl, which are also checked
+            when a server is stopped. If 0, they are only checked on stop.
+            """
+        ),
+    ).tag(config=True)
+
+    # Build the service spec without contacting Docker, see jhub/dryrun.py
+    dry_run = False
+
+    mount_concurrency = Int(
+        4,
+        help=dedent(
+            """
+            Maximum number of mounts that are prepared concurrently for a spawn.
+            """
+        ),
+    ).tag(config=True)
+
+    mount_timeout = Int(
+        0,
+        help=dedent(
+            """
+            Number of seconds that each mount is given to be prepared before
+            the spawn fails. If 0, the mounts are given an unlimited amount of time.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_endpoints = List(
+        trait=Unicode(),
+        default_value=[],
+        help=dedent(
+            """
+            Base URLs of the Swarm managers, e.g. tcp://manager1:2376.
+            Reads are distributed across them and writes are sent to the leader.
+            If empty, the DOCKER_HOST of the environment is used.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_tls_kwargs = Dict(
+        default_value={},
+        help=dedent(
+            """
+            Arguments of the docker.tls.TLSConfig of the docker_endpoints,
+            e.g. {'client_cert': (cert_path, key_path), 'ca_cert': ca_path}
+            """
+        ),
+    ).tag(config=True)
+
+    docker_read_strategy = Unicode(
+        "round_robin",
+        help=dedent(
+            """
+            How reads are distributed across the docker_endpoints, either
+            round_robin, or least_latency to the endpoint with the lowest
+            recent latency.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_hedge_reads = Bool(
+        False,
+        help=dedent(
+            """
+            Whether a read that is slower than the docker_hedge_quantile of
+            the recent reads is sent to a second endpoint as well, where the
+            first response is used.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_hedge_quantile = Float(
+        0.95,
+        help=dedent(
+            """
+            The quantile of the recent latencies of a read after which it is hedged.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_timeout = Int(
+        default_timeout,
+        help=dedent(
+            """
+            Number of seconds before a Docker API request times out.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_timeouts = Dict(
+        default_value={},
+        help=dedent(
+            """
+            Number of seconds before a request of each Docker API method times out,
+            e.g. {'tasks': 5, 'inspect_service': 5, 'create_service': 30},
+            the other methods time out after the docker_timeout.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_circuit_failure_threshold = Int(
+        5,
+        help=dedent(
+            """
+            Number of consecutive failed requests, e.g. timeouts, connection errors
+            and server errors, after which the circuit of a Docker endpoint is opened,
+            i.e. its requests fail immediately. If 0, the circuit is never opened.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_circuit_recovery_timeout = Int(
+        30,
+        help=dedent(
+            """
+            Number of seconds that the circuit of a Docker endpoint is open before
+            a single request is let through to probe whether it has recovered.
+            """
+        ),
+    ).tag(config=True)
+
+    docker_read_cache_ttl = Float(
+        0.5,
+        help=dedent(
+            """
+            Number of seconds that the response of a Docker read, e.g. inspecting
+            a service or listing its tasks, is reused by identical reads, unless
+            the hub makes a write in the meantime. Concurrent identical reads
+            always share a single request. If 0, the responses aren't reused.
+            """
+        ),
+    ).tag(config=True)
+
+    poll_max_staleness = Float(
+        0,
+        help=dedent(
+            """
+            Number of seconds that poll returns the last polled status of the server
+            immediately, without waiting on Docker, while it is refreshed in the
+            background. Older statuses are refreshed before poll returns.
+            If 0, every poll waits on Docker.
+            """
+        ),
+    ).tag(config=True)
+
+    poll_refresh_after = Float(
+        1,
+        help=dedent(
+            """
+            Number of seconds after which a status that poll returns is refreshed in the
+            background, when the poll_max_staleness is enabled. Younger statuses are
+            returned without a refresh.
+            """
+        ),
+    ).tag(config=True)
+
+    adaptive_polling = Bool(
+        False,
+        help=dedent(
+            """
+            Whether the servers are polled by a single scheduler of the hub, which
+            spreads the polls uniformly with poll_jitter, instead of every
+            poll_interval per server. A server that was just started, or whose tasks
+            changed since its last poll, is polled every poll_min_interval seconds.
+            The interval of a stable server is increased by half after each poll,
+            up to poll_max_interval seconds.
+            """
+        ),
+    ).tag(config=True)
+
+    poll_min_interval = Float(
+        5,
+        help=dedent(
+            """
+            Number of seconds between the polls of a recently started or changed server,
+            when adaptive_polling is enabled.
+            """
+        ),
+    ).tag(config=True)
+
+    poll_max_interval = Float(
+        120,
+        help=dedent(
+            """
+            Number of seconds between the polls of a long-stable server,
+            when adaptive_polling is enabled.
+            """
+        ),
+    ).tag(config=True)
+
+    poll_max_rate = Float(
+        0,
+        help=dedent(
+            """
+            Maximum number of polls that are started per second across every server,
+            when adaptive_polling is enabled. If 0, the rate isn't limited.
+            """
+        ),
+    ).tag(config=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every spawner of the hub shares the clients of the endpoints
+        configure_client_pool(
+            self.docker_endpoints,
+            tls_kwargs=self.docker_tls_kwargs,
+            strategy=self.docker_read_strategy,
+            hedge_reads=self.docker_hedge_reads,
+            hedge_quantile=self.docker_hedge_quantile,
+            timeout=self.docker_timeout,
+            timeouts=self.docker_timeouts,
+            failure_threshold=self.docker_circuit_failure_threshold,
+            recovery_timeout=self.docker_circuit_recovery_timeout,
+            read_cache_ttl=self.docker_read_cache_ttl,
+        )
+
+    @property
+    def client_pool(self):
+        return get_client_pool()
+
+    @property
+    def image_digests(self):
+        return ImageDigests.get(
+            ttl=self.image_digest_ttl,
+            refresh_interval=self.image_digest_refresh_interval,
+            max_images=self.image_digest_cache_size,
+        )
+
     _service_owner = None
 
     @property
@@ -494,32 +973,76 @@ class SwarmSpawner(Spawner):
                 self._service_owner = m.hexdigest()
         return self._service_owner
 
+    @property
+    def service_owner_key(self):
+        """
+        Unique owner identifier that is used when naming the Docker objects
+        owned by the user, see get_service_owner_key.
+        """
+        return get_service_owner_key(self.user.name)
+
+    @property
+    def service_suffix(self):
+        """
+        The server name of the spawner, '1' for the default server
+        """
+        if hasattr(self, "server_name") and self.server_name:
+            return self.server_name
+        if self.name:
+            return self.name
+        return "1"
+
     @property
     def service_name(self):
         """
         Service name inside the Docker Swarm
 
         service_suffix should be a numerical value unique for user
-        {service_prefix}-{service_owner}-{service_suffix}
+        {service_prefix}-{service_owner_key}-{service_suffix}
         """
-        if hasattr(self, "server_name") and self.server_name:
-            server_name = self.server_name
-        else:
-            server_name = 1
+        return "{}-{}-{}".format(
+            self.service_prefix, self.service_owner_key, self.service_suffix
+        )
 
-        return "{}-{}-{}".format(self.service_prefix, self.service_owner, server_name)
+    @property
+    def service_owner_labels(self):
+        """
+        Labels that identify the hub, user and server that owns the service
+        """
+        return {
+            HUB_ID_LABEL: self.hub_id,
+            USER_LABEL: self.user.name,
+            SERVER_NAME_LABEL: self.service_suffix,
+        }
+
+    def get_service_labels(self, selected_image):
+        """
+        Labels that are attached to the created service
+        """
+        labels = dict(self.service_owner_labels)
+        labels.update(
+            {
+                IMAGE_LABEL: selected_image["name"],
+                VERSION_LABEL: __version__,
+            }
+        )
+        return labels
 
     @property
     def user_config_name_base(self):
         """
         Base config name for any configs that the service_owner uploads
         """
+        return self.get_user_config_name_base(self.user.name)
+
+    def get_user_config_name_base(self, user_name):
+        """Base config name for any configs that the user uploads"""
         if hasattr(self, "user_upload_name") and self.user_upload_name:
             user_upload_name = self.user_upload_name
         else:
             user_upload_name = "upload"
         return "{}-{}-{}".format(
-            self.service_prefix, self.service_owner, user_upload_name
+            self.service_prefix, get_service_owner_key(user_name), user_upload_name
         )
 
     @property
@@ -533,17 +1056,63 @@ class SwarmSpawner(Spawner):
     def load_state(self, state):
         super().load_state(state)
         self.service_id = state.get("service_id", "")
+        self.task_id = state.get("task_id", "")
+        self.node_id = state.get("node_id", "")
 
     def get_state(self):
-        state = super().get_state()
         state = super().get_state()
         if self.service_id:
             state["service_id"] = self.service_id
+        if self.task_id:
+            state["task_id"] = self.task_id
+        if self.node_id:
+            state["node_id"] = self.node_id
         return state
 
     def clear_state(self):
         super().clear_state()
         self.service_id = ""
+        self.task_id = ""
+        self.node_id = ""
+
+    _progress_events = None
+
+    def add_progress_event(self, message, progress=None):
+        """Report a progress event to the user while the service is spawned"""
+        if self._progress_events is None:
+            self._progress_events = []
+        event = {"message": message}
+        if progress is not None:
+            event["progress"] = progress
+        self._progress_events.append(event)
+
+    async def progress(self):
+        """Yield the progress events that are reported while the service is spawned"""
+        reported = 0
+        while True:
+            events = self._progress_events or []
+            while reported < len(events):
+                yield events[reported]
+                reported += 1
+            if not self._spawn_pending:
+                break
+            await sleep(1)
+
+    def _accelerator_wait_reporter(self, accelerator):
+        """Reports the queue position while waiting for an accelerator"""
+        last_position = None
+
+        def report(position):
+            nonlocal last_position
+            if position == last_position:
+                return
+            last_position = position
+            self.add_progress_event(
+                "Waiting for a free accelerator of type: {}, "
+                "position {} in the queue".format(accelerator.type, position)
+            )
+
+        return report
 
     @staticmethod
     def _env_keep_default(param):
@@ -580,9 +1149,37 @@ class SwarmSpawner(Spawner):
             )
         )
         try:
-            service = run_docker("inspect_service", self.service_name)
+            services = await run_docker_async(
+                "services",
+                filters={"label": format_label_filters(self.service_owner_labels)},
+            )
+            if services:
+                if len(services) > 1:
+                    self.log.warning(
+                        "Found multiple Docker services owned by: {}, using: {}".format(
+                            self.service_owner_labels, services[0]["ID"]
+                        )
+                    )
+                service = services[0]
+            else:
+                # Services that were created before the owner labels
+                # were introduced can only be found by their id or name
+                service = await run_docker_async(
+                    "inspect_service", self.service_id or self.service_name
+                )
+                service_labels = service["Spec"].get("Labels", {}) or {}
+                if service_labels.get(HUB_ID_LABEL, self.hub_id) != self.hub_id:
+                    self.log.info(
+                        "Docker service '{}' is owned by another hub: {}".format(
+                            self.service_name, service_labels[HUB_ID_LABEL]
+                        )
+                    )
+                    service = None
             self.log.debug("Inspect service response: {}".format(service))
-            self.service_id = service["ID"]
+            if service:
+                self.service_id = service["ID"]
+            else:
+                self.service_id = ""
         except APIError as err:
             if err.response.status_code == 404:
                 self.log.info("Docker service '{}' is gone".format(self.service_name))
@@ -598,33 +1195,136 @@ class SwarmSpawner(Spawner):
                 raise
         return service
 
+    # The result of the last poll that reached Docker
+    _poll_status = None
+    # When the _poll_status was polled, None if it isn't known
+    _poll_time = None
+    _poll_refresh = None
+    # Changed when the server is started or stopped, which outdates the polls
+    _poll_generation = 0
+
+    def forget_poll_status(self):
+        self._poll_time = None
+        self._poll_generation += 1
+
     async def poll(self):
-        """Check for a task state like `docker service ps id`"""
+        """Check for a task state like `docker service ps id`.
+        With poll_max_staleness, a recent status is returned immediately
+        while it is refreshed in the background."""
+        if self.poll_max_staleness > 0 and self._poll_time is not None:
+            age = time.monotonic() - self._poll_time
+            if age < self.poll_max_staleness:
+                POLL_STALENESS.observe(age)
+                if age >= self.poll_refresh_after and (
+                    self._poll_refresh is None or self._poll_refresh.done()
+                ):
+                    self._poll_refresh = ensure_future(self.refresh_poll_status())
+                return self._poll_status
+        return await self.refresh_poll_status(background=False)
+
+    async def refresh_poll_status(self, background=True):
+        """Poll the status of the service.
+        While Docker is unavailable, the status of the last poll is reused."""
+        generation = self._poll_generation
+        try:
+            status = await self.poll_service()
+        except Exception as err:
+            if not is_unavailable(err):
+                if not background:
+                    raise
+                self.log.error("Failed to refresh the poll status: {}".format(err))
+                return self._poll_status
+            self.log.warning(
+                "Docker is unavailable, reusing the last poll status: {} - {}".format(
+                    self._poll_status, err
+                )
+            )
+            if not background and self._poll_time is not None:
+                POLL_STALENESS.observe(time.monotonic() - self._poll_time)
+            return self._poll_status
+        if generation == self._poll_generation:
+            self._poll_status = status
+            self._poll_time = time.monotonic()
+        if not background:
+            POLL_STALENESS.observe(0)
+        return status
+
+    # The tasks and their states of the last poll
+    _task_fingerprint = None
+    # Whether the server was started by this hub process
+    _started = False
+    _poll_scheduler = None
+
+    def start_polling(self):
+        """Schedule the polls of the server with the adaptive poll scheduler,
+        or poll every poll_interval if adaptive_polling is disabled"""
+        if not self.adaptive_polling:
+            return super().start_polling()
+        if self.poll_interval <= 0:
+            self.log.debug("Not polling Docker service")
+            return
+        self.stop_polling()
+        # Recently started servers are polled more often
+        interval = self.poll_interval
+        if self._started:
+            interval = self.poll_min_interval
+        self._poll_scheduler = PollScheduler.get(max_rate=self.poll_max_rate)
+        self._poll_scheduler.schedule(
+            self,
+            ScheduledPoll(
+                self.adaptive_poll,
+                interval,
+                min_interval=self.poll_min_interval,
+                max_interval=self.poll_max_interval,
+                jitter=self.poll_jitter,
+            ),
+        )
+
+    def stop_polling(self):
+        super().stop_polling()
+        if self._poll_scheduler is not None:
+            self._poll_scheduler.unschedule(self)
+            self._poll_scheduler = None
+
+    async def adaptive_poll(self):
+        """Poll and notify JupyterHub if the server has stopped.
+        Returns whether the tasks of the service changed since the last poll."""
+        fingerprint = self._task_fingerprint
+        try:
+            await self.poll_and_notify()
+        except Exception:
+            self.log.exception(
+                "Failed to poll Docker service {}".format(self.service_name)
+            )
+            return True
+        return self._task_fingerprint != fingerprint
+
+    async def poll_service(self):
         service = await self.get_service()
         if service is None:
             self.log.warn("Docker service not found")
             return 0
 
-        task_filter = {"service": service["Spec"]["Name"]}
-        self.tasks = run_docker("tasks", task_filter)
+        self.tasks = await self.get_tasks(service)
+        self._task_fingerprint = sorted((task.id, task.state) for task in self.tasks)
 
         running_task = None
         for task in self.tasks:
-            task_state = task["Status"]["State"]
+            task_state = task.state
             if task_state == "running":
                 self.log.debug(
                     "Task {} of Docker service {} status: {}".format(
-                        task["ID"][:7], self.service_id[:7], pformat(task_state)
+                        task.id[:7], self.service_id[:7], pformat(task_state)
                     ),
                 )
                 # there should be at most one running task
                 running_task = task
             if task_state == "rejected":
-                task_err = task["Status"]["Err"]
+                task_err = task.error
                 self.log.error(
                     "Task {} of Docker service {} status {} "
                     "message {}".format(
-                        task["ID"][:7],
+                        task.id[:7],
                         self.service_id[:7],
                         pformat(task_state),
                         pformat(task_err),
@@ -637,7 +1337,45 @@ class SwarmSpawner(Spawner):
             return None
         return 0
 
-    async def attempt_volume_remove(self, name, max_attempts=15):
+    async def get_tasks(self, service):
+        """The TaskRecords of the service's tasks.
+
+        The current task is inspected directly while it is still desired to
+        run, which is much cheaper for the manager than listing the task
+        history of the service. The tasks are only listed when the current
+        task is unknown or has been replaced, after which the newest task
+        becomes the current task.
+        """
+        if self.task_id:
+            try:
+                task = await run_docker_async("inspect_task", self.task_id)
+            except docker.errors.NotFound:
+                task = None
+            if (
+                task
+                and task.get("ServiceID") == service["ID"]
+                and task.get("DesiredState") == "running"
+            ):
+                self.node_id = task.get("NodeID") or ""
+                return [TaskRecord.from_task(task)]
+
+        task_filter = {"service": service["Spec"]["Name"]}
+        tasks = [
+            TaskRecord.from_task(task)
+            for task in await run_docker_async("tasks", task_filter) or []
+        ]
+        current_tasks = [
+            task for task in tasks if task.desired_state == "running"
+        ] or tasks
+        if current_tasks:
+            task = max(current_tasks, key=lambda task: task.created_at or "")
+            self.task_id = task.id
+            self.node_id = task.node_id or ""
+        else:
+            self.task_id, self.node_id = "", ""
+        return tasks
+
+    async def attempt_volume_remove(self, name, max_attempts=15, endpoint=None):
         attempt = 0
         removed = False
         # Volumes can only be removed after the service is gone
@@ -646,7 +1384,7 @@ class SwarmSpawner(Spawner):
                 self.log.info("Failed to remove volume {}".format(name))
                 break
             self.log.info("Removing volume {}".format(name))
-            removed, remove_response = remove_volume(name)
+            removed, remove_response = await remove_volume(name, endpoint=endpoint)
             if not removed:
                 self.log.info(
                     "User: {} remove volume response: {}".format(
@@ -657,12 +1395,769 @@ class SwarmSpawner(Spawner):
             attempt += 1
         return removed
 
+    def get_service_mounts(self, service):
+        """The configured mounts of an existing service, based on its image label"""
+        image_name = (service["Spec"].get("Labels") or {}).get(IMAGE_LABEL)
+        selected_image = None
+        for image in self.images:
+            if image["name"] == image_name:
+                selected_image = image
+        container_spec = self.container_spec
+        if self.use_user_options:
+            container_spec = dict(container_spec)
+            container_spec.update(self.user_options.get("container_spec", {}))
+        return self.get_mounts(container_spec, selected_image)
+
+    async def node_is_ready(self, node_id):
+        """Whether the Swarm node can be scheduled on"""
+        try:
+            node = await run_docker_async("inspect_node", node_id)
+        except APIError as err:
+            self.log.info("Failed to inspect node: {} - {}".format(node_id, err))
+            return False
+        return (node.get("Status") or {}).get("State") == "ready" and (
+            node.get("Spec") or {}
+        ).get("Availability") == "active"
+
+    _restored_warm_pools = weakref.WeakSet()
+
+    async def restore_warm_volumes(self):
+        """Recover the warm volumes from their labels on each node, the first
+        time that the warm volume pools are used by the hub process"""
+        cls = self.__class__
+        pools = [
+            pool
+            for pool in WarmVolumePool.pools()
+            if pool not in cls._restored_warm_pools
+        ]
+        if not pools:
+            return
+        in_use = set()
+        for service in await get_hub_services(self.hub_id) or []:
+            container_spec = service["Spec"]["TaskTemplate"]["ContainerSpec"]
+            for mount in container_spec.get("Mounts") or []:
+                in_use.add(mount.get("Source"))
+
+        primary_node = None
+        for pool in pools:
+            node_endpoints = pool.node_endpoints
+            endpoints = list(node_endpoints.items())
+            if get_client_pool().primary not in node_endpoints.values():
+                if primary_node is None:
+                    info = await run_docker_async("info")
+                    primary_node = (info.get("Swarm") or {}).get("NodeID")
+                endpoints.append((primary_node, None))
+            for node, endpoint in endpoints:
+                try:
+                    response = await run_node_docker_async(
+                        endpoint,
+                        "volumes",
+                        filters={"label": "{}={}".format(WARM_POOL_LABEL, pool.name)},
+                    )
+                except (APIError, RequestException) as err:
+                    self.log.info(
+                        "Failed to list the warm volumes of node: {} - {}".format(
+                            node, err
+                        )
+                    )
+                    continue
+                for volume in (response or {}).get("Volumes") or []:
+                    labels = volume.get("Labels") or {}
+                    if labels.get(WARM_POOL_LABEL) != pool.name:
+                        continue
+                    pool.restore(
+                        volume["Name"], node=node, in_use=volume["Name"] in in_use
+                    )
+            cls._restored_warm_pools.add(pool)
+
+    async def checkin_warm_volumes(self, service, volumes):
+        """Record the node and health of the service's warm volumes, and keep
+        the volumes mounted on the node if their pool is set to"""
+        warm_volumes = get_warm_volumes(volumes)
+        if not warm_volumes:
+            return
+        # The service isn't necessarily the spawner's own, e.g. when it is reaped
+        tasks = [
+            TaskRecord.from_task(task)
+            for task in await run_docker_async(
+                "tasks", {"service": service["Spec"]["Name"]}
+            )
+            or []
+        ]
+        node, healthy = None, True
+        if tasks:
+            task = max(tasks, key=lambda task: task.updated_at or "")
+            node = task.node_id
+            healthy = task.state not in ("failed", "rejected")
+        image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+        for pool, mount in warm_volumes:
+            pool.checkin(mount["Source"], node=node, healthy=healthy)
+            if pool.keep_mounted and node and healthy:
+                await self.create_warm_keeper(pool, mount, node, image)
+
+    async def create_warm_keeper(self, pool, mount, node, image):
+        """Create the service that holds the volume of the mount on its node,
+        such that the volume plugin doesn't unmount it while it is idle"""
+        task_template = {
+            "ContainerSpec": {
+                "Image": image,
+                "Command": pool.keeper_command,
+                "Mounts": [mount],
+            },
+            "Placement": {"Constraints": ["node.id=={}".format(node)]},
+        }
+        labels = {WARM_POOL_LABEL: pool.name, WARM_VOLUME_LABEL: mount["Source"]}
+        try:
+            await run_docker_async(
+                "create_service",
+                task_template,
+                name=get_keeper_name(mount["Source"]),
+                labels=labels,
+            )
+        except APIError as err:
+            self.log.info(
+                "Failed to keep the volume: {} mounted on node: {} - {}".format(
+                    mount["Source"], node, err
+                )
+            )
+
+    async def remove_warm_keeper(self, volume_name):
+        """Remove the service that holds the volume on its node, if any"""
+        try:
+            await run_docker_async("remove_service", get_keeper_name(volume_name))
+        except docker.errors.NotFound:
+            return False
+        return True
+
+    async def release_warm_volumes(self, warm_volumes):
+        """Hand the warm volumes over from their keepers to the service that
+        is running, and remove the volumes that were left behind on
+        another node"""
+        for pool, volume_name, node in warm_volumes:
+            await self.remove_warm_keeper(volume_name)
+            if node and self.node_id and node != self.node_id:
+                self.log.info(
+                    "Removing the warm volume: {} that was left on node: {}".format(
+                        volume_name, node
+                    )
+                )
+                await self.attempt_volume_remove(
+                    volume_name, endpoint=pool.endpoint(node)
+                )
+
+    async def reap_warm_volumes(self):
+        """Remove the warm volumes that have been idle for too long,
+        on the node that they are kept on"""
+        await self.restore_warm_volumes()
+        for pool in WarmVolumePool.pools():
+            for volume_name in pool.expired():
+                await self.remove_warm_keeper(volume_name)
+                removed, response = await remove_volume(
+                    volume_name, endpoint=pool.endpoint(pool.node(volume_name))
+                )
+                self.log.info(response)
+                if removed:
+                    pool.forget(volume_name)
+
+    async def create_user_install_configs(self, user_options, uid, gid):
+        """Create a Docker config for each of the user_install_files
+        in the user_options, and return their config references"""
+        user_install_configs = []
+        for idx, user_install_file in enumerate(
+            user_options.get("user_install_files") or []
+        ):
+            file_name = user_install_file["name"]
+            file_extension = user_install_file["extension"]
+
+            config_name = "{}-{}".format(self.user_config_name_base, idx)
+            # If an existing config_name already exists, remove
+            # the old one before creating a new one
+            if (await get_config(config_name))[0]:
+                pruned, pruned_response = await prune_config(config_name)
+                if not pruned:
+                    self.log.error(pruned_response)
+                    raise Exception(pruned_response)
+
+            user_config_result = await run_docker_async(
+                "create_config", config_name, user_install_file["data"]
+            )
+            if isinstance(user_config_result, dict) and "ID" in user_config_result:
+                user_config_id = user_config_result.get("ID")
+                config_mount_path = os.path.join(
+                    self.user_upload_destination_directory,
+                    file_name + file_extension,
+                )
+                user_install_config = prepare_user_config_reference(
+                    user_config_id,
+                    config_name,
+                    filename=config_mount_path,
+                    uid=uid,
+                    gid=gid,
+                )
+                user_install_configs.append(user_install_config)
+        return user_install_configs
+
+    def get_mounts(self, container_spec, selected_image):
+        """The global and image mounts of a service"""
+        mounts = []
+        # Global mounts
+        if "mounts" in container_spec:
+            mounts.extend(container_spec["mounts"])
+
+        # Image mounts
+        if selected_image and "mounts" in selected_image:
+            mounts.extend(selected_image["mounts"])
+        return mounts
+
+    def get_format_mount_kwargs(self):
+        """Prepare the dictionary that can be used
+        to format the container_spec"""
+        format_mount_kwargs = {}
+        if self.user_format_attributes:
+            for attr in self.user_format_attributes:
+                if hasattr(self.user, attr):
+                    value = getattr(self.user, attr)
+                    if not isinstance(value, dict):
+                        value = {attr: value}
+                    format_mount_kwargs[attr] = value
+        return format_mount_kwargs
+
+    def get_mounter(self, mount):
+        # Mounts can be declared as regular dictionaries
+        # or as special Mountable objects (see mount.py)
+        if isinstance(mount, dict):
+            return get_volume_mounter(mount)
+        # Custom type mount defined
+        # Is instantiated in the config
+        return mount
+
+    async def _create_mount(self, mounter, **format_mount_kwargs):
+        if hasattr(mounter, "provision") and not self.dry_run:
+            await mounter.provision(**format_mount_kwargs)
+        return await mounter.create(**format_mount_kwargs)
+
+    async def create_mount(self, mount, semaphore, **format_mount_kwargs):
+        """Prepare and create the Docker Mount of a single mount config"""
+        mounter = self.get_mounter(mount)
+        mounter_type = type(mounter).__name__
+
+        async with semaphore:
+            started = time.monotonic()
+            result = "created"
+            try:
+                if self.mount_timeout > 0:
+                    return await wait_for(
+                        self._create_mount(mounter, **format_mount_kwargs),
+                        self.mount_timeout,
+                    )
+                return await self._create_mount(mounter, **format_mount_kwargs)
+            except TimeoutError:
+                result = "timeout"
+                raise TimeoutError(
+                    "The {} mount wasn't prepared within {} seconds".format(
+                        mounter_type, self.mount_timeout
+                    )
+                )
+            except BaseException:
+                result = "error"
+                raise
+            finally:
+                MOUNT_CREATE_DURATION.labels(mounter_type, result).observe(
+                    time.monotonic() - started
+                )
+
+    async def prepare_mounts(self, mounts, **format_mount_kwargs):
+        """Create the Docker Mounts of the mount configs concurrently,
+        at most mount_concurrency at a time"""
+        semaphore = Semaphore(max(self.mount_concurrency, 1))
+        created = [
+            ensure_future(self.create_mount(mount, semaphore, **format_mount_kwargs))
+            for mount in mounts
+        ]
+        try:
+            return list(await gather(*created))
+        except BaseException:
+            # Don't leave the remaining mounts running after a failure
+            for future in created:
+                future.cancel()
+            raise
+
+    async def cleanup_mounts(self, mounts, **format_mount_kwargs):
+        """Clean up the mounts of a removed service concurrently"""
+        mounters = [self.get_mounter(mount) for mount in mounts]
+        results = await gather(
+            *[
+                mounter.cleanup(**format_mount_kwargs)
+                for mounter in mounters
+                if hasattr(mounter, "cleanup")
+            ],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.error("Failed to clean up a mount: {}".format(result))
+
+    def select_image(self, user_options):
+        """The configured image that the user_options select"""
+        if (
+            "user_selected_image" in user_options
+            and "user_selected_name" in user_options
+        ):
+            self.log.debug("User options received: {}".format(user_options))
+            image_name = user_options["user_selected_name"]
+            image_value = user_options["user_selected_image"]
+            selected_image = None
+            for di in self.images:
+                if image_name == di["name"] and image_value == di["image"]:
+                    selected_image = copy.deepcopy(di)
+            if selected_image is None:
+                err_msg = "User selected image: {} couldn't be found".format(
+                    image_value
+                )
+                self.log.error(err_msg)
+                raise Exception(err_msg)
+            self.log.info("Using the user selected image: {}".format(selected_image))
+        else:
+            # Default image
+            selected_image = self.images[0]
+            self.log.info("Using the default image: {}".format(selected_image))
+        return selected_image
+
+    async def pin_image(self, image):
+        """The image@sha256: reference of the image if pin_image_digests is set,
+        or the image itself if its digest can't be resolved. Dry runs only use
+        the digests that are already cached."""
+        if not self.pin_image_digests:
+            return image
+        if self.dry_run:
+            return self.image_digests.pin(image)
+        try:
+            return await self.image_digests.resolve(image)
+        except Exception as err:
+            self.log.warning(
+                "Failed to resolve the digest of image {}, using its tag: {}".format(
+                    image, err
+                )
+            )
+            return image
+
+    # The seconds spent in each phase of the last build_service_spec
+    spec_timings = None
+
+    async def build_service_spec(self, user_options):
+        """Build the arguments of the Docker create_service call.
+        If dry_run is set, Docker isn't contacted and the spec is built
+        without any configs, accelerator claims or provisioned mounts
+        being created."""
+        timer = PhaseTimer()
+        container_spec = copy.deepcopy(self.container_spec)
+
+        if isinstance(container_spec, dict) and container_spec:
+            container_spec.update(user_options.get("container_spec", {}))
+
+        # Which image to spawn
+        selected_image = self.select_image(user_options)
+        timer.lap("image")
+
+        # Assign the user a UID and GID, before the mounts are formatted with it
+        uid_gid_values = None
+        if self.uid_allocator is not None:
+            allocated_uid, allocated_gid = self.uid_allocator.allocate(self.user.name)
+            self.user.uid = str(allocated_uid)
+            self.user.gid = str(allocated_gid)
+            uid_gid_values = {"uid": self.user.uid, "gid": self.user.gid}
+
+        # Setup mounts
+        mounts = self.get_mounts(container_spec, selected_image)
+        container_spec["mounts"] = []
+        format_mount_kwargs = self.get_format_mount_kwargs()
+
+        # Prepare the mounts while the rest of the spec is created
+        prepare_mounts = ensure_future(
+            self.prepare_mounts(mounts, **format_mount_kwargs)
+        )
+
+        # Extract the UID and GID to use inside the container
+        uid, gid = get_user_uid_gid(container_spec, format_values=uid_gid_values)
+        if "uid_gid" in selected_image:
+            uid, gid = get_user_uid_gid(selected_image, format_values=uid_gid_values)
+            # uid_gid is not a supported option in the container_spec
+        if "uid_gid" in container_spec:
+            container_spec.pop("uid_gid")
+
+        if uid:
+            container_spec.update({"user": "{}".format(uid)})
+        if uid and gid:
+            container_spec.update({"user": "{}:{}".format(uid, gid)})
+        timer.lap("uid_gid")
+
+        configs = copy.deepcopy(self.configs)
+        user_install_configs = []
+        try:
+            # Check if the user supplied a user_install_files to create
+            # a ConfigReference from that can be used to install into
+            # the user's container upon spawning.
+            if not self.dry_run:
+                user_install_configs = await self.create_user_install_configs(
+                    user_options, uid, gid
+                )
+                configs.extend(user_install_configs)
+            container_spec["mounts"] = await prepare_mounts
+        except BaseException:
+            prepare_mounts.cancel()
+            raise
+        timer.lap("mounts")
+
+        # The node where the warm volumes were last mounted
+        warm_node = None
+        # The (pool, volume name, last node) of each warm volume
+        warm_volumes = []
+        if not self.dry_run:
+            await self.restore_warm_volumes()
+            for pool, mount in get_warm_volumes(container_spec["mounts"]):
+                volume_name = mount["Source"]
+                warm_volumes.append((pool, volume_name, pool.node(volume_name)))
+                warm_node = pool.checkout(volume_name) or warm_node
+
+        # Assign the image name as a label
+        container_spec["labels"] = {"image_name": selected_image["name"]}
+
+        # Some envs are required by the single-user-image
+        if "env" in container_spec:
+            container_spec["env"].update(self.get_env())
+        else:
+            container_spec["env"] = self.get_env()
+
+        # Env of image
+        if "env" in selected_image and isinstance(selected_image["env"], dict):
+            container_spec["env"].update(selected_image["env"])
+
+        # Dynamic update of env values
+        for env_key, env_value in container_spec["env"].items():
+            stripped_value = env_value.lstrip("{").rstrip("}")
+            if hasattr(self, stripped_value) and isinstance(
+                getattr(self, stripped_value), str
+            ):
+                container_spec["env"][env_key] = getattr(self, stripped_value)
+            if hasattr(self.user, stripped_value) and isinstance(
+                getattr(self.user, stripped_value), str
+            ):
+                container_spec["env"][env_key] = getattr(self.user, stripped_value)
+            if (
+                hasattr(self.user, "data")
+                and hasattr(self.user.data, stripped_value)
+                and isinstance(getattr(self.user.data, stripped_value), str)
+            ):
+                container_spec["env"][env_key] = getattr(self.user.data, stripped_value)
+
+        # Args of image
+        if "args" in selected_image and isinstance(selected_image["args"], list):
+            container_spec.update({"args": selected_image["args"]})
+
+        if (
+            "command" in selected_image
+            and isinstance(selected_image["command"], list)
+            or "command" in selected_image
+            and isinstance(selected_image["command"], str)
+        ):
+            container_spec.update({"command": selected_image["command"]})
+        timer.lap("env")
+
+        # Log mounts config
+        self.log.debug(
+            "User: {} container_spec mounts: {}".format(
+                self.user, container_spec["mounts"]
+            )
+        )
+
+        # Global resource_spec
+        resource_spec = {}
+        if hasattr(self, "resource_spec"):
+            resource_spec = dict(self.resource_spec)
+        resource_spec.update(user_options.get("resource_spec", {}))
+
+        networks = None
+        if hasattr(self, "networks"):
+            networks = self.networks
+        if user_options.get("networks") is not None:
+            networks = user_options.get("networks")
+
+        # Global Log driver
+        log_driver = None
+        if hasattr(self, "log_driver"):
+            log_driver = self.log_driver
+        if user_options.get("log_driver") is not None:
+            log_driver = user_options.get("log_driver")
+
+        accelerators = []
+        if hasattr(self, "accelerators"):
+            accelerators = self.accelerators
+        if user_options.get("accelerators") is not None:
+            accelerators = user_options.get("accelerators")
+
+        # Global placement
+        placement = None
+        if hasattr(self, "placement"):
+            placement = self.placement
+        if user_options.get("placement") is not None:
+            placement = user_options.get("placement")
+
+        # Image resources
+        if "resource_spec" in selected_image:
+            resource_spec = selected_image["resource_spec"]
+
+        # Accelerators attached to the image
+        if "accelerators" in selected_image:
+            accelerators = selected_image["accelerators"]
+
+        # Placement of image
+        if "placement" in selected_image:
+            placement = selected_image["placement"]
+
+        # Logdriver of image
+        if "log_driver" in selected_image:
+            log_driver = selected_image["log_driver"]
+
+        # Configs attached to image
+        if "configs" in selected_image and isinstance(selected_image["configs"], list):
+            for c in selected_image["configs"]:
+                if isinstance(c, dict):
+                    configs.append(copy.deepcopy(c))
+
+        endpoint_spec = {}
+        if "endpoint_spec" in selected_image:
+            endpoint_spec = selected_image["endpoint_spec"]
+
+        if configs:
+            # Check that the supplied configs already exists
+            current_configs = []
+            if not self.dry_run:
+                current_configs = await run_docker_async("configs")
+            config_error_msg = (
+                "The server has a misconfigured config, "
+                "please contact an administrator to resolve this"
+            )
+
+            for c in configs:
+                if "config_name" not in c:
+                    self.log.error(
+                        "Config: {} does not have a "
+                        "required config_name key".format(c)
+                    )
+                    raise Exception(config_error_msg)
+                if "config_id" not in c and self.dry_run:
+                    c["config_id"] = c["config_name"]
+                if "config_id" not in c:
+                    # Find the id from the supplied name
+                    config_ids = [
+                        cc["ID"]
+                        for cc in current_configs
+                        if cc["Spec"]["Name"] == c["config_name"]
+                    ]
+                    if not config_ids:
+                        self.log.error(
+                            "A config with name {} could not be found".format(
+                                c["config_name"]
+                            )
+                        )
+                        raise Exception(config_error_msg)
+                    c["config_id"] = config_ids[0]
+
+            container_spec.update({"configs": [ConfigReference(**c) for c in configs]})
+        timer.lap("configs")
+
+        # The spec hash leaves out the accelerator claims and the warm volume
+        # placement, which depend on the state of the pools at the time
+        configured_placement, configured_resource_spec = placement, resource_spec
+
+        # Prepare the accelerators and attach it to the environment
+        accelerator_node = None
+        # The claimed ids of each pool type
+        pool_claims = {}
+        if accelerators and not self.dry_run:
+            await self.reconcile_accelerators(accelerators)
+            accelerator_ids = []
+            placement = copy.deepcopy(placement)
+            resource_spec = copy.deepcopy(resource_spec)
+            groups = [group.name for group in getattr(self.user, "groups", [])]
+            for accelerator in accelerators:
+                # Every accelerator must be claimed on the same node
+                try:
+                    claim = await accelerator.claim(
+                        self.service_name,
+                        node=accelerator_node or None,
+                        groups=groups,
+                        timeout=self.accelerator_claim_timeout,
+                        on_wait=self._accelerator_wait_reporter(accelerator),
+                    )
+                except AcceleratorQueueFull:
+                    self.release_accelerators(self.service_name)
+                    err_msg = (
+                        "Too many servers are waiting for an accelerator of "
+                        "type: {}, please try again later".format(accelerator.type)
+                    )
+                    self.log.error(err_msg)
+                    self.add_progress_event(err_msg)
+                    raise Exception(err_msg)
+                except BaseException:
+                    self.release_accelerators(self.service_name)
+                    raise
+                if claim is None:
+                    self.release_accelerators(self.service_name)
+                    if self.accelerator_claim_timeout > 0:
+                        err_msg = (
+                            "Timed out after {} seconds waiting for a free "
+                            "accelerator of type: {}".format(
+                                self.accelerator_claim_timeout, accelerator.type
+                            )
+                        )
+                    else:
+                        err_msg = (
+                            "No free accelerators of type: {} are available".format(
+                                accelerator.type
+                            )
+                        )
+                    self.log.error(err_msg)
+                    self.add_progress_event(err_msg)
+                    raise Exception(err_msg)
+                accelerator_node = claim.node or accelerator_node
+                accelerator_ids.extend(claim.ids)
+                pool_claims.setdefault(accelerator.type, []).extend(claim.ids)
+                # Ensure that the service is placed on the claimed node
+                for constraint in claim.constraints:
+                    constraints = placement.setdefault("constraints", [])
+                    if constraint not in constraints:
+                        constraints.append(constraint)
+                if claim.generic_resources:
+                    generic_resources = resource_spec.setdefault(
+                        "generic_resources", {}
+                    )
+                    for kind, value in claim.generic_resources.items():
+                        generic_resources[kind] = generic_resources.get(kind, 0) + value
+            # NVIDIA_VISIBLE_DEVICES=0,1
+            container_spec["env"][ACCELERATOR_ENV] = ",".join(accelerator_ids)
+
+        timer.lap("accelerators")
+
+        # Reuse the warm volumes unless the accelerators dictate the node.
+        # Swarm has no preference for a particular node, so the constraint
+        # is dropped if the service can't be placed on it, see
+        # wait_for_warm_placement
+        if not warm_node or accelerator_node or not await self.node_is_ready(warm_node):
+            warm_node = None
+        else:
+            placement = copy.deepcopy(placement)
+            constraints = placement.setdefault("constraints", [])
+            constraint = "node.id=={}".format(warm_node)
+            if constraint not in constraints:
+                constraints.append(constraint)
+
+        # Global container user
+        if "user" in container_spec:
+            container_spec["user"] = str(container_spec["user"])
+
+        # Image user
+        if "user" in selected_image:
+            container_spec.update({"user": str(selected_image["user"])})
+
+        # Global container workdir
+        if "workdir" in container_spec:
+            container_spec["workdir"] = str(container_spec["workdir"])
+
+        # Image workdir
+        if "workdir" in selected_image:
+            container_spec.update({"workdir": str(selected_image["workdir"])})
+
+        dynamic_value_owners = [Spawner, self, self.user]
+        # Format container_spec with data from the
+        # potential dynamic owners
+        for dynamic_owner in dynamic_value_owners:
+            try:
+                if not hasattr(dynamic_owner, "__dict__"):
+                    continue
+                recursive_format(container_spec, dynamic_owner.__dict__)
+            except TypeError:
+                pass
+        timer.lap("format")
+
+        # Log driver
+        log_driver_name, log_driver_options = None, None
+        if log_driver and isinstance(log_driver, dict):
+            if "name" in log_driver:
+                log_driver_name = log_driver["name"]
+            if "options" in log_driver:
+                log_driver_options = log_driver["options"]
+
+        # Create the service
+        # Image to spawn
+        image = await self.pin_image(selected_image["image"])
+        timer.lap("digest")
+        container_spec = ContainerSpec(image, **container_spec)
+        resources = Resources(**resource_spec)
+        placement = Placement(**placement)
+
+        task_log_driver = None
+        if log_driver_name:
+            task_log_driver = DriverConfig(log_driver_name, options=log_driver_options)
+
+        task_spec = {
+            "container_spec": container_spec,
+            "resources": resources,
+            "placement": placement,
+            "networks": networks,
+        }
+
+        if task_log_driver:
+            task_spec.update({"log_driver": task_log_driver})
+
+        task_tmpl = TaskTemplate(**task_spec)
+        self.log.debug("task temp: {}".format(task_tmpl))
+        hashed_task_tmpl = TaskTemplate(
+            **dict(
+                task_spec,
+                resources=Resources(**configured_resource_spec),
+                placement=Placement(**configured_placement),
+            )
+        )
+        # Set endpoint spec
+        if endpoint_spec:
+            endpoint_spec = EndpointSpec(**endpoint_spec)
+        else:
+            endpoint_spec = None
+
+        service_labels = self.get_service_labels(selected_image)
+        if accelerator_node:
+            service_labels[ACCELERATOR_NODE_LABEL] = accelerator_node
+        for pool_type, ids in pool_claims.items():
+            service_labels[get_accelerators_label(pool_type)] = ",".join(ids)
+        service_labels[SPEC_HASH_LABEL] = spec_hash(
+            hashed_task_tmpl,
+            ignored_env=(ACCELERATOR_ENV,),
+            ignored_configs=[config["config_name"] for config in user_install_configs],
+        )
+
+        timer.lap("service")
+        self.spec_timings = timer.phases
+        return {
+            "task_template": task_tmpl,
+            "name": self.service_name,
+            "labels": service_labels,
+            "endpoint_spec": endpoint_spec,
+            "warm_node": warm_node,
+            "warm_volumes": warm_volumes,
+        }
+
     async def start(self):
         """Start the single-user server in a docker service.
         You can specify the params for the service through
         jupyterhub_config.py or using the user_options
         """
         self.log.debug("User: {}, start spawn".format(self.user.__dict__))
+        self._progress_events = []
+        self.add_progress_event("Spawning server...", progress=50)
+        self.forget_poll_status()
+        self._started = True
+        self.ensure_suspend_reaper()
 
         # https://github.com/jupyterhub/jupyterhub
         # /blob/master/jupyterhub/user.py#L202
@@ -673,7 +2168,46 @@ class SwarmSpawner(Spawner):
             user_options = {}
 
         service = await self.get_service()
+        current = False
         if service:
+            labels = service["Spec"].get("Labels") or {}
+            # The uploaded files are only known once their configs are created
+            current = not user_options.get("user_install_files")
+            # The spec of a service without a hash, e.g. one that was created
+            # by a previous version of the spawner, is unknown and is reused
+            if current and SPEC_HASH_LABEL in labels:
+                if self.pin_image_digests:
+                    # The digest of the existing service is the last known digest
+                    # of its tag, such that an unreachable registry doesn't
+                    # change the hash
+                    self.image_digests.remember(
+                        service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+                    )
+                desired_hash = await self.build_spec_hash(user_options)
+                current = labels[SPEC_HASH_LABEL] == desired_hash
+
+        if service and not current and self.can_update(service, user_options):
+            try:
+                spec = await self.update_service(service, user_options)
+            except BaseException:
+                # The accelerators aren't held by a service that wasn't updated
+                self.release_accelerators(self.service_name)
+                raise
+            service_name = service["Spec"]["Name"]
+            await self.wait_for_warm_placement(spec)
+        elif service and not current:
+            self.log.info(
+                "Replacing Docker service {} whose spec has changed".format(
+                    self.service_name
+                )
+            )
+            await self.delete_service(service)
+            service = None
+        elif service and self.is_suspended(service):
+            await self.resume_service(service)
+            service_name = service["Spec"]["Name"]
+            await self.wait_for_running_tasks()
+        elif service:
             self.log.info(
                 "Found existing Docker service '{}' (id: {})".format(
                     self.service_name, self.service_id[:7]
@@ -687,458 +2221,452 @@ class SwarmSpawner(Spawner):
                 if line.startswith("JPY_API_TOKEN="):
                     self.api_token = line.split("=", 1)[1]
                     break
-        else:
+            # The existing service might have been named by
+            # a previous naming scheme
+            service_name = service["Spec"]["Name"]
+
+        if not service:
             # Create a new service
             self.log.info(
                 "Creating a new Docker service for user: {}".format(self.user.name)
             )
-            container_spec = copy.deepcopy(self.container_spec)
-
-            if isinstance(container_spec, dict) and container_spec:
-                container_spec.update(user_options.get("container_spec", {}))
-
-            # Which image to spawn
-            if (
-                "user_selected_image" in user_options
-                and "user_selected_name" in user_options
-            ):
-                self.log.debug("User options received: {}".format(user_options))
-                image_name = user_options["user_selected_name"]
-                image_value = user_options["user_selected_image"]
-                selected_image = None
-                for di in self.images:
-                    if image_name == di["name"] and image_value == di["image"]:
-                        selected_image = copy.deepcopy(di)
-                if selected_image is None:
-                    err_msg = "User selected image: {} couldn't be found".format(
-                        image_value
-                    )
-                    self.log.error(err_msg)
-                    raise Exception(err_msg)
-                self.log.info(
-                    "Using the user selected image: {}".format(selected_image)
+            try:
+                spec = await self.build_service_spec(user_options)
+                resp = await run_docker_async(
+                    "create_service",
+                    spec["task_template"],
+                    name=spec["name"],
+                    labels=spec["labels"],
+                    endpoint_spec=spec["endpoint_spec"],
                 )
-            else:
-                # Default image
-                selected_image = self.images[0]
-                self.log.info("Using the default image: {}".format(selected_image))
-
-            # Extract the UID and GID to use inside the container
-            uid, gid = get_user_uid_gid(container_spec)
-            if "uid_gid" in selected_image:
-                uid, gid = get_user_uid_gid(selected_image["uid_gid"])
-                # uid_gid is not a supported option in the container_spec
-            if "uid_gid" in container_spec:
-                container_spec.pop("uid_gid")
-
-            if uid:
-                container_spec.update({"user": "{}".format(uid)})
-            if uid and gid:
-                container_spec.update({"user": "{}:{}".format(uid, gid)})
-
-            # Check if the user supplied a user_install_files to create a ConfigReference from
-            # that can be used to install into the user's container upon spawning.
-            if (
-                "user_install_files" in user_options
-                and user_options["user_install_files"]
-            ):
-                for idx, user_install_file in enumerate(
-                    user_options.get("user_install_files", [])
-                ):
-                    file_name = user_install_file["name"]
-                    file_extension = user_install_file["extension"]
-
-                    config_name = "{}-{}".format(self.user_config_name_base, idx)
-                    # If an existing config_name already exists, remove
-                    # the old one before creating a new one
-                    if get_config(config_name)[0]:
-                        pruned, pruned_response = prune_config(config_name)
-                        if not pruned:
-                            self.log.error(pruned_response)
-                            raise Exception(pruned_response)
-
-                    user_config_result = run_docker(
-                        "create_config", config_name, user_install_file["data"]
-                    )
-                    if (
-                        isinstance(user_config_result, dict)
-                        and "ID" in user_config_result
-                    ):
-                        user_config_id = user_config_result.get("ID")
-                        config_mount_path = os.path.join(
-                            self.user_upload_destination_directory,
-                            file_name + file_extension,
-                        )
-                        user_install_config = prepare_user_config_reference(
-                            user_config_id,
-                            config_name,
-                            filename=config_mount_path,
-                            uid=uid,
-                            gid=gid,
-                        )
-                        self.configs.append(user_install_config)
-
-            # Assign the image name as a label
-            container_spec["labels"] = {"image_name": selected_image["name"]}
-
-            # Setup mounts
-            mounts = []
-            # Global mounts
-            if "mounts" in container_spec:
-                mounts.extend(container_spec["mounts"])
-            container_spec["mounts"] = []
-
-            # Image mounts
-            if "mounts" in selected_image:
-                mounts.extend(selected_image["mounts"])
-
-            # Prepare the dictionary that can be used
-            # to format the container_spec
-            format_mount_kwargs = {}
-            if self.user_format_attributes:
-                for attr in self.user_format_attributes:
-                    if hasattr(self.user, attr):
-                        value = getattr(self.user, attr)
-                        if not isinstance(value, dict):
-                            value = {attr: value}
-                        format_mount_kwargs[attr] = value
-
-            # Mounts can be declared as regular dictionaries
-            # or as special Mountable objects (see mount.py)
-            for mount in mounts:
-                if isinstance(mount, dict):
-                    m = VolumeMounter(mount)
-                    m = await m.create(**format_mount_kwargs)
-                else:
-                    # Custom type mount defined
-                    # Is instantiated in the config
-                    m = await mount.create(**format_mount_kwargs)
-                container_spec["mounts"].append(m)
-
-            # Some envs are required by the single-user-image
-            if "env" in container_spec:
-                container_spec["env"].update(self.get_env())
-            else:
-                container_spec["env"] = self.get_env()
-
-            # Env of image
-            if "env" in selected_image and isinstance(selected_image["env"], dict):
-                container_spec["env"].update(selected_image["env"])
+            except BaseException:
+                # The accelerators aren't held by a service that wasn't created
+                self.release_accelerators(self.service_name)
+                raise
+            image = spec["task_template"]["ContainerSpec"]["Image"]
+            self.service_id = resp["ID"]
+            self.task_id, self.node_id = "", ""
+            self.log.info(
+                "Created Docker service {} (id: {}) from image {}"
+                " for user {}".format(
+                    self.service_name, self.service_id[:7], image, self.user
+                )
+            )
+            service_name = self.service_name
+            await self.wait_for_warm_placement(spec)
 
-            # Dynamic update of env values
-            for env_key, env_value in container_spec["env"].items():
-                stripped_value = env_value.lstrip("{").rstrip("}")
-                if hasattr(self, stripped_value) and isinstance(
-                    getattr(self, stripped_value), str
-                ):
-                    container_spec["env"][env_key] = getattr(self, stripped_value)
-                if hasattr(self.user, stripped_value) and isinstance(
-                    getattr(self.user, stripped_value), str
-                ):
-                    container_spec["env"][env_key] = getattr(self.user, stripped_value)
-                if (
-                    hasattr(self.user, "data")
-                    and hasattr(self.user.data, stripped_value)
-                    and isinstance(getattr(self.user.data, stripped_value), str)
-                ):
-                    container_spec["env"][env_key] = getattr(
-                        self.user.data, stripped_value
-                    )
+        ip = service_name
+        port = self.service_port
+        self.log.debug(
+            "Active service: '{}' with user '{}'".format(service_name, self.user.name)
+        )
 
-            # Args of image
-            if "args" in selected_image and isinstance(selected_image["args"], list):
-                container_spec.update({"args": selected_image["args"]})
+        # we use service_name instead of ip
+        # https://docs.docker.com/engine/swarm/networking/#use-swarm-mode-service-discovery
+        # service_port is actually equal to 8888
+        return ip, port
 
-            if (
-                "command" in selected_image
-                and isinstance(selected_image["command"], list)
-                or "command" in selected_image
-                and isinstance(selected_image["command"], str)
-            ):
-                container_spec.update({"command": selected_image["command"]})
+    @property
+    def accelerator_pools(self):
+        """Every accelerator pool that is configured either
+        globally or for one of the images"""
+        pools = []
+        for accelerator in self.accelerators:
+            if accelerator not in pools:
+                pools.append(accelerator)
+        for image in self.images:
+            for accelerator in image.get("accelerators", []):
+                if accelerator not in pools:
+                    pools.append(accelerator)
+        return pools
+
+    _reconciled_accelerators = weakref.WeakSet()
+
+    async def reconcile_accelerators(self, accelerators):
+        """Recover the accelerator claims from the services that are running,
+        the first time that the accelerator pools are used by the hub process"""
+        cls = self.__class__
+        pools = [
+            accelerator
+            for accelerator in accelerators
+            if accelerator not in cls._reconciled_accelerators
+        ]
+        if not pools:
+            return
 
-            # Log mounts config
-            self.log.debug(
-                "User: {} container_spec mounts: {}".format(
-                    self.user, container_spec["mounts"]
+        services = await get_hub_services(self.hub_id) or []
+        for pool in pools:
+            claims = {}
+            for service in services:
+                owner_ids = self.get_claimed_ids(service, pool)
+                if owner_ids:
+                    labels = service["Spec"].get("Labels") or {}
+                    node = labels.get(ACCELERATOR_NODE_LABEL, "")
+                    claims[service["Spec"]["Name"]] = [
+                        (node, accelerator_id) for accelerator_id in owner_ids
+                    ]
+            self.log.info(
+                "Reconciling accelerator pool: {} with the claims: {}".format(
+                    pool.type, claims
                 )
             )
+            # The claims of the owners that this hub doesn't know are kept
+            pool.reconcile(
+                claims, owners=[service["Spec"]["Name"] for service in services]
+            )
+            cls._reconciled_accelerators.add(pool)
+
+    def get_claimed_ids(self, service, pool):
+        """The ids that the service claimed from the pool"""
+        labels = service["Spec"].get("Labels") or {}
+        if get_accelerators_label(pool.type) in labels:
+            return labels[get_accelerators_label(pool.type)].split(",")
+        if any(label.startswith(ACCELERATORS_LABEL + ".") for label in labels):
+            return []
+        # Services that were created before the claims were labeled with their
+        # pool only expose the combined ids, which are unambiguous with one pool
+        if len(self.accelerator_pools) != 1:
+            return []
+        envs = service["Spec"]["TaskTemplate"]["ContainerSpec"].get("Env") or []
+        for line in envs:
+            if get_env_name(line) == ACCELERATOR_ENV:
+                return line.split("=", 1)[1].split(",")
+        return []
 
-            # Global resource_spec
-            resource_spec = {}
-            if hasattr(self, "resource_spec"):
-                resource_spec = self.resource_spec
-            resource_spec.update(user_options.get("resource_spec", {}))
-
-            networks = None
-            if hasattr(self, "networks"):
-                networks = self.networks
-            if user_options.get("networks") is not None:
-                networks = user_options.get("networks")
-
-            # Global Log driver
-            log_driver = None
-            if hasattr(self, "log_driver"):
-                log_driver = self.log_driver
-            if user_options.get("log_driver") is not None:
-                log_driver = user_options.get("log_driver")
-
-            accelerators = []
-            if hasattr(self, "accelerators"):
-                accelerators = self.accelerators
-            if user_options.get("accelerators") is not None:
-                accelerators = user_options.get("accelerators")
-
-            # Global placement
-            placement = None
-            if hasattr(self, "placement"):
-                placement = self.placement
-            if user_options.get("placement") is not None:
-                placement = user_options.get("placement")
-
-            # Image resources
-            if "resource_spec" in selected_image:
-                resource_spec = selected_image["resource_spec"]
-
-            # Accelerators attached to the image
-            if "accelerators" in selected_image:
-                accelerators = selected_image["accelerators"]
-
-            # Placement of image
-            if "placement" in selected_image:
-                placement = selected_image["placement"]
-
-            # Logdriver of image
-            if "log_driver" in selected_image:
-                log_driver = selected_image["log_driver"]
-
-            # Configs attached to image
-            if "configs" in selected_image and isinstance(
-                selected_image["configs"], list
-            ):
-                for c in selected_image["configs"]:
-                    if isinstance(c, dict):
-                        self.configs.append(c)
-
-            endpoint_spec = {}
-            if "endpoint_spec" in selected_image:
-                endpoint_spec = selected_image["endpoint_spec"]
-
-            if self.configs:
-                # Check that the supplied configs already exists
-                current_configs = run_docker("configs")
-                config_error_msg = (
-                    "The server has a misconfigured config, "
-                    "please contact an administrator to resolve this"
-                )
+    def release_accelerators(self, owner):
+        """Release the accelerators claimed by the owner"""
+        for pool in self.accelerator_pools:
+            pool.release(owner)
+
+    async def build_spec_hash(self, user_options):
+        """The spec hash of the service that the user_options result in, to
+        compare with the hash of an existing service. The spec is built as a
+        dry run, such that no configs are created, accelerators claimed or
+        mounts provisioned, which the spec hash leaves out."""
+        if self.pin_image_digests:
+            # The digest of the image is part of the spec
+            await self.pin_image(self.select_image(user_options)["image"])
+        dry_run, spec_timings = self.dry_run, self.spec_timings
+        self.dry_run = True
+        try:
+            spec = await self.build_service_spec(user_options)
+        finally:
+            self.dry_run, self.spec_timings = dry_run, spec_timings
+        return spec["labels"][SPEC_HASH_LABEL]
+
+    def is_suspended(self, service):
+        return SUSPENDED_LABEL in (service["Spec"].get("Labels") or {})
+
+    def can_suspend(self, service):
+        """Whether the service can be scaled to 0 replicas, rather than being
+        removed. Services that claimed accelerators are removed, such that
+        the accelerators are released."""
+        # Services are replicated unless another mode is given
+        mode = service["Spec"].get("Mode") or {"Replicated": {}}
+        if "Replicated" not in mode:
+            return False
+        return not self.holds_accelerators(service)
+
+    def holds_accelerators(self, service):
+        """Whether the service was labeled with the accelerators that it
+        claimed. The ACCELERATOR_ENV can also be set statically by the
+        image or the environment config, e.g. to all."""
+        labels = service["Spec"].get("Labels") or {}
+        return ACCELERATOR_NODE_LABEL in labels or any(
+            label.startswith(ACCELERATORS_LABEL + ".") for label in labels
+        )
 
-                for c in self.configs:
-                    if "config_name" not in c:
-                        self.log.error(
-                            "Config: {} does not have a "
-                            "required config_name key".format(c)
-                        )
-                        raise Exception(config_error_msg)
-                    if "config_id" not in c:
-                        # Find the id from the supplied name
-                        config_ids = [
-                            cc["ID"]
-                            for cc in current_configs
-                            if cc["Spec"]["Name"] == c["config_name"]
-                        ]
-                        if not config_ids:
-                            self.log.error(
-                                "A config with name {} could not be found".format(
-                                    c["config_name"]
-                                )
-                            )
-                            raise Exception(config_error_msg)
-                        c["config_id"] = config_ids[0]
+    async def suspend_service(self, service):
+        """Scale the service to 0 replicas"""
+        labels = dict(service["Spec"].get("Labels") or {})
+        labels[SUSPENDED_LABEL] = str(int(time.time()))
+        await run_docker_async(
+            "update_service",
+            service["ID"],
+            service["Version"]["Index"],
+            labels=labels,
+            mode=ServiceMode("replicated", replicas=0),
+            fetch_current_spec=True,
+        )
+        self.task_id, self.node_id = "", ""
+        self.log.info(
+            "Docker service {} (id: {}) suspended".format(
+                self.service_name, self.service_id[:7]
+            )
+        )
 
-                container_spec.update(
-                    {"configs": [ConfigReference(**c) for c in self.configs]}
-                )
+    async def resume_service(self, service):
+        """Scale the suspended service back to 1 replica with the current
+        API token"""
+        labels = dict(service["Spec"].get("Labels") or {})
+        labels.pop(SUSPENDED_LABEL, None)
+        task_template = copy.deepcopy(service["Spec"]["TaskTemplate"])
+        container_spec = task_template["ContainerSpec"]
+        env = self.get_env()
+        container_spec["Env"] = [
+            line
+            for line in container_spec.get("Env") or []
+            if get_env_name(line) not in VOLATILE_ENV
+        ] + ["{}={}".format(name, env[name]) for name in VOLATILE_ENV if name in env]
+        await run_docker_async(
+            "update_service",
+            service["ID"],
+            service["Version"]["Index"],
+            task_template=task_template,
+            labels=labels,
+            mode=ServiceMode("replicated", replicas=1),
+            fetch_current_spec=True,
+        )
+        self.task_id, self.node_id = "", ""
+        self.log.info(
+            "Resumed suspended Docker service {} (id: {})".format(
+                self.service_name, self.service_id[:7]
+            )
+        )
 
-            # Prepare the accelerators and attach it to the environment
-            if accelerators:
-                for accelerator in accelerators:
-                    accelerator_id = accelerator.aquire(self.user.name)
-                    # NVIDIA_VISIBLE_DEVICES=0:0
-                    container_spec["env"]["NVIDIA_VISIBLE_DEVICES"] = "{}".format(
-                        accelerator_id
+    def can_update(self, service, user_options):
+        """Whether the service can be updated in place to a new spec.
+        The configs of uploaded files can't be replaced while they are in
+        use, and services that claimed accelerators must release them
+        before they are claimed again."""
+        if user_options.get("user_install_files"):
+            return False
+        return not self.holds_accelerators(service)
+
+    async def update_service(self, service, user_options):
+        """Update the service in place to the spec that the user_options
+        result in, which is retried once if the service was updated
+        concurrently"""
+        self.log.info(
+            "Updating Docker service {} (id: {}) whose spec has changed".format(
+                self.service_name, self.service_id[:7]
+            )
+        )
+        spec = await self.build_service_spec(user_options)
+        for attempt in range(2):
+            try:
+                await run_docker_async(
+                    "update_service",
+                    service["ID"],
+                    service["Version"]["Index"],
+                    task_template=spec["task_template"],
+                    labels=spec["labels"],
+                    mode=ServiceMode("replicated", replicas=1),
+                    endpoint_spec=spec["endpoint_spec"],
+                    fetch_current_spec=True,
+                )
+                break
+            except APIError as err:
+                if attempt > 0 or not is_update_conflict(err):
+                    raise
+                self.log.info(
+                    "Docker service {} was updated concurrently, retrying".format(
+                        self.service_name
                     )
-
-            # Global container user
-            if "user" in container_spec:
-                container_spec["user"] = str(container_spec["user"])
-
-            # Image user
-            if "user" in selected_image:
-                container_spec.update({"user": str(selected_image["user"])})
-
-            # Global container workdir
-            if "workdir" in container_spec:
-                container_spec["workdir"] = str(container_spec["workdir"])
-
-            # Image workdir
-            if "workdir" in selected_image:
-                container_spec.update({"workdir": str(selected_image["workdir"])})
-
-            dynamic_value_owners = [Spawner, self, self.user]
-            # Format container_spec with data from the
-            # potential dynamic owners
-            for dynamic_owner in dynamic_value_owners:
-                try:
-                    if not hasattr(dynamic_owner, "__dict__"):
-                        continue
-                    recursive_format(container_spec, dynamic_owner.__dict__)
-                except TypeError:
-                    pass
-
-            # Log driver
-            log_driver_name, log_driver_options = None, None
-            if log_driver and isinstance(log_driver, dict):
-                if "name" in log_driver:
-                    log_driver_name = log_driver["name"]
-                if "options" in log_driver:
-                    log_driver_options = log_driver["options"]
-
-            # Create the service
-            # Image to spawn
-            image = selected_image["image"]
-            container_spec = ContainerSpec(image, **container_spec)
-            resources = Resources(**resource_spec)
-            placement = Placement(**placement)
-
-            task_log_driver = None
-            if log_driver_name:
-                task_log_driver = DriverConfig(
-                    log_driver_name, options=log_driver_options
                 )
+                service = await run_docker_async("inspect_service", service["ID"])
+        self.task_id, self.node_id = "", ""
+        return spec
 
-            task_spec = {
-                "container_spec": container_spec,
-                "resources": resources,
-                "placement": placement,
-                "networks": networks,
-            }
+    _suspend_reaper = None
 
-            if task_log_driver:
-                task_spec.update({"log_driver": task_log_driver})
-
-            task_tmpl = TaskTemplate(**task_spec)
-            self.log.debug("task temp: {}".format(task_tmpl))
-            # Set endpoint spec
-            if endpoint_spec:
-                endpoint_spec = EndpointSpec(**endpoint_spec)
-            else:
-                endpoint_spec = None
-
-            resp = run_docker(
-                "create_service",
-                task_tmpl,
-                name=self.service_name,
-                endpoint_spec=endpoint_spec,
-            )
-            self.service_id = resp["ID"]
+    def ensure_suspend_reaper(self):
+        """Reap the suspended services every suspend_reap_interval seconds in
+        the background, such that they are reaped without servers stopping"""
+        if not self.suspend_on_stop or self.suspend_ttl <= 0:
+            return
+        if self.suspend_reap_interval <= 0:
+            return
+        cls, loop = SwarmSpawner, get_running_loop()
+        reaper = cls._suspend_reaper
+        if reaper is None or reaper.done() or reaper.get_loop() is not loop:
+            cls._suspend_reaper = ensure_future(self._reap_suspended_periodically())
+
+    async def _reap_suspended_periodically(self):
+        while self.suspend_reap_interval > 0:
+            await sleep(self.suspend_reap_interval)
+            try:
+                await self.reap_suspended_services()
+            except Exception as err:
+                self.log.warning("Failed to reap suspended services: {}".format(err))
+
+    async def reap_suspended_services(self):
+        """Remove the services of the hub that have been suspended for
+        longer than suspend_ttl seconds, along with their volumes that
+        aren't kept and their uploaded configs"""
+        if self.suspend_ttl <= 0:
+            return
+        label_filters = format_label_filters({HUB_ID_LABEL: self.hub_id})
+        services = await run_docker_async(
+            "services", filters={"label": label_filters + [SUSPENDED_LABEL]}
+        )
+        now = time.time()
+        for service in services or []:
+            labels = service["Spec"].get("Labels") or {}
+            try:
+                suspended_at = float(labels[SUSPENDED_LABEL])
+            except (KeyError, ValueError):
+                continue
+            if now - suspended_at < self.suspend_ttl:
+                continue
             self.log.info(
-                "Created Docker service {} (id: {}) from image {}"
-                " for user {}".format(
-                    self.service_name, self.service_id[:7], image, self.user
+                "Removing Docker service {} that has been suspended since {}".format(
+                    service["Spec"]["Name"], suspended_at
                 )
             )
-            await self.wait_for_running_tasks()
-
-        ip = self.service_name
-        port = self.service_port
-        self.log.debug(
-            "Active service: '{}' with user '{}'".format(
-                self.service_name, self.user.name
-            )
-        )
-
-        # we use service_name instead of ip
-        # https://docs.docker.com/engine/swarm/networking/#use-swarm-mode-service-discovery
-        # service_port is actually equal to 8888
-        return ip, port
+            try:
+                await self.remove_service(service)
+            except docker.errors.NotFound:
+                continue
+
+    async def remove_service_volumes(self, volumes):
+        """Remove the volumes of a removed service that aren't kept"""
+        for volume in volumes:
+            labels = (volume.get("VolumeOptions") or {}).get("Labels") or {}
+            # Whether the volume should be kept
+            if "autoremove" in labels and labels["autoremove"] != "False":
+                self.log.debug("Volume {} is not kept".format(volume))
+                if "Source" in volume:
+                    # Validate the volume exists
+                    try:
+                        await run_docker_async("inspect_volume", volume["Source"])
+                    except docker.errors.NotFound:
+                        self.log.info("No volume named: " + volume["Source"])
+                    else:
+                        await self.attempt_volume_remove(volume["Source"])
+                else:
+                    self.log.error(
+                        "Volume {} didn't have a 'Source' key so it "
+                        "can't be removed".format(volume)
+                    )
 
     async def stop(self, now=False):
-        """Stop and remove the service
-        Consider using stop/start when Docker adds support
+        """Stop and remove the service, or scale it to 0 replicas
+        if suspend_on_stop is set
         """
+        self.forget_poll_status()
+        try:
+            service = await self.get_service()
+            if not service:
+                self.log.warn("Docker service not found")
+                return
+
+            if self.suspend_on_stop and self.can_suspend(service):
+                await self.suspend_service(service)
+            else:
+                await self.delete_service(service)
+        finally:
+            # The claims are released even if the service is already gone
+            # or couldn't be removed
+            self.release_accelerators(self.service_name)
+        await self.reap_suspended_services()
+
+    async def delete_service(self, service):
+        """Remove the service along with its volumes that aren't kept,
+        its uploaded configs and its mounts"""
         self.log.info(
             "Stopping and removing Docker service {} (id: {}) owned by: {}".format(
                 self.service_name, self.service_id[:7], self.user.name
             )
         )
-
-        service = await self.get_service()
-        if not service:
-            self.log.warn("Docker service not found")
-            return
-
         self.log.debug("Docker service {}".format(service["Spec"]))
+        if await self.remove_service(service):
+            self.log.info(
+                "Docker service {} (id: {}) removed".format(
+                    self.service_name, self.service_id[:7]
+                )
+            )
+            self.task_id, self.node_id = "", ""
+            await self.cleanup_mounts(
+                self.get_service_mounts(service), **self.get_format_mount_kwargs()
+            )
+
+    async def remove_service(self, service):
+        """Remove a service of the hub, which isn't necessarily the spawner's
+        own, along with its volumes that aren't kept and its uploaded configs"""
+        container_spec = service["Spec"]["TaskTemplate"]["ContainerSpec"]
         # lookup mounts before removing the service
-        volumes = []
-        if "Mounts" in service["Spec"]["TaskTemplate"]["ContainerSpec"]:
-            volumes = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Mounts"]
+        volumes = container_spec.get("Mounts") or []
 
         # lookup user configs before removing the service
+        labels = service["Spec"].get("Labels") or {}
         user_upload_configs = []
-        service_configs = service["Spec"]["TaskTemplate"]["ContainerSpec"].get(
-            "Configs", []
-        )
-        for config in service_configs:
-            config_name = config.get("ConfigName", None)
-            if config_name and self.user_config_name_base in config_name:
-                user_upload_configs.append(config)
+        if USER_LABEL in labels:
+            config_name_base = self.get_user_config_name_base(labels[USER_LABEL])
+            for config in container_spec.get("Configs") or []:
+                config_name = config.get("ConfigName", None)
+                if config_name and config_name_base in config_name:
+                    user_upload_configs.append(config)
+
+        # The tasks are gone once the service is removed
+        await self.checkin_warm_volumes(service, volumes)
 
         # Even though it returns the service is gone
         # the underlying containers are still being removed
-        removed_service = run_docker("remove_service", service["ID"])
+        removed_service = await run_docker_async("remove_service", service["ID"])
         if removed_service:
-            self.log.info(
-                "Docker service {} (id: {}) removed".format(
-                    self.service_name, self.service_id[:7]
-                )
-            )
-            for volume in volumes:
-                labels = volume.get("VolumeOptions", {}).get("Labels", {})
-                # Whether the volume should be kept
-                if "autoremove" in labels and labels["autoremove"] != "False":
-                    self.log.debug("Volume {} is not kept".format(volume))
-                    if "Source" in volume:
-                        # Validate the volume exists
-                        try:
-                            run_docker("inspect_volume", volume["Source"])
-                        except docker.errors.NotFound:
-                            self.log.info("No volume named: " + volume["Source"])
-                        else:
-                            await self.attempt_volume_remove(volume["Source"])
-                    else:
-                        self.log.error(
-                            "Volume {} didn't have a 'Source' key so it "
-                            "can't be removed".format(volume)
-                        )
+            self.release_accelerators(service["Spec"]["Name"])
+            await self.remove_service_volumes(volumes)
+            await self.reap_warm_volumes()
             for config in user_upload_configs:
                 self.log.info("Removing config: {}".format(config))
-                if not prune_config(config["ConfigName"], logger=self.log):
-                    self.log.error(
-                        "Can't remove config: {} because it does not exist".format(
-                            config["ConfigName"]
-                        )
+                pruned, pruned_response = await prune_config(config["ConfigName"])
+                if not pruned:
+                    self.log.error(pruned_response)
+        return removed_service
+
+    async def wait_for_warm_placement(self, spec):
+        """Wait for the tasks of the service, which is placed on another node
+        if it isn't running on the node of its warm volumes within the
+        placement_timeout of their pools"""
+        warm_node, warm_volumes = spec.get("warm_node"), spec.get("warm_volumes")
+        if not warm_node:
+            await self.wait_for_running_tasks()
+        else:
+            placement_timeout = min(
+                pool.placement_timeout for pool, _, _ in warm_volumes
+            )
+            if not await self.wait_for_running_tasks(max_attempts=placement_timeout):
+                self.log.info(
+                    "Docker service {} couldn't be placed on node {} of its warm"
+                    " volumes, placing it on another node".format(
+                        self.service_name, warm_node
                     )
+                )
+                await self.drop_node_constraint(warm_node)
+                await self.wait_for_running_tasks()
+        if warm_volumes:
+            await self.release_warm_volumes(warm_volumes)
+
+    async def drop_node_constraint(self, node):
+        """Update the service such that its tasks can run on any node"""
+        service = copy.deepcopy(await self.get_service())
+        task_template = service["Spec"]["TaskTemplate"]
+        placement = task_template.get("Placement") or {}
+        placement["Constraints"] = [
+            constraint
+            for constraint in placement.get("Constraints") or []
+            if constraint != "node.id=={}".format(node)
+        ]
+        task_template["Placement"] = placement
+        await run_docker_async(
+            "update_service",
+            service["ID"],
+            service["Version"]["Index"],
+            task_template=task_template,
+            fetch_current_spec=True,
+        )
+        self.task_id, self.node_id = "", ""
 
     async def wait_for_running_tasks(self, max_attempts=20, max_preparing=30):
         running = False
         num_preparing, attempt = 0, 0
         while not running:
             service = await self.get_service()
-            task_filter = {"service": service["Spec"]["Name"]}
-            self.tasks = run_docker("tasks", task_filter)
+            self.tasks = await self.get_tasks(service)
             preparing = False
             for task in self.tasks:
-                task_state = task["Status"]["State"]
+                task_state = task.state
                 self.log.info(
                     "Waiting for service: {} current task status: {}".format(
                         service["ID"], task_state
@@ -1157,3 +2685,4 @@ class SwarmSpawner(Spawner):
             if num_preparing > max_preparing:
                 return False
             await sleep(1)
+        return True
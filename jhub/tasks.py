@@ -0,0 +1,74 @@
+import sys
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class TaskRecord:
+    """
+    The parts of a Docker task that the spawner keeps between polls.
+
+    The task payloads of the Docker API include the full spec of the
+    service, its mounts, environment and status details, which adds up
+    when a hub keeps the tasks of thousands of servers. The states and
+    node ids are interned, since they are shared by most of the tasks.
+    """
+
+    __slots__ = (
+        "id",
+        "service_id",
+        "node_id",
+        "state",
+        "desired_state",
+        "error",
+        "created_at",
+        "updated_at",
+    )
+
+    def __init__(
+        self,
+        id,
+        service_id=None,
+        node_id=None,
+        state=None,
+        desired_state=None,
+        error=None,
+        created_at=None,
+        updated_at=None,
+    ):
+        self.id = id
+        self.service_id = service_id
+        self.node_id = _intern(node_id)
+        self.state = _intern(state)
+        self.desired_state = _intern(desired_state)
+        self.error = error
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_task(cls, task):
+        """Extract the record of a task payload of the Docker API"""
+        status = task.get("Status") or {}
+        return cls(
+            task["ID"],
+            service_id=task.get("ServiceID"),
+            node_id=task.get("NodeID"),
+            state=status.get("State"),
+            desired_state=task.get("DesiredState"),
+            error=status.get("Err"),
+            created_at=task.get("CreatedAt"),
+            updated_at=task.get("UpdatedAt"),
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, TaskRecord):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return "TaskRecord(id={!r}, state={!r}, node_id={!r})".format(
+            self.id, self.state, self.node_id
+        )
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+from jhub.defaults import default_base_path
+from jhub.io import makedirs
+
+default_uid_path = os.path.join(default_base_path, "uids.db")
+
+
+class UIDAllocator:
+    """
+    Assigns each user a stable UID, starting from start_uid.
+    The assignments are stored in a SQLite database with an index on
+    both the user name and the UID, and a new UID is allocated in a single
+    transaction, such that concurrent spawns of the same or different
+    users never receive the same UID, even across hub processes.
+
+    Once assigned, a UID never changes, which allows every assignment
+    to be cached in memory.
+
+    If gid is None, each user is given a group with the same id as its UID.
+    """
+
+    def __init__(self, path=default_uid_path, start_uid=10000, gid=None, timeout=30):
+        self._path = path
+        self._start_uid = start_uid
+        self._gid = gid
+        self._timeout = timeout
+        self._connection = None
+        self._uids = {}
+        # The connection is shared by the threads of the process
+        self._lock = threading.RLock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def connection(self):
+        with self._lock:
+            return self._connect()
+
+    def _connect(self):
+        if self._connection is None:
+            dir_path = os.path.dirname(self._path)
+            if dir_path and not os.path.exists(dir_path):
+                makedirs(dir_path)
+            # Transactions are controlled explicitly via BEGIN IMMEDIATE
+            self._connection = sqlite3.connect(
+                self._path,
+                timeout=self._timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS uids ("
+                "name TEXT PRIMARY KEY, "
+                "uid INTEGER NOT NULL UNIQUE)"
+            )
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def preload(self):
+        """Cache every existing assignment, e.g. when the hub starts"""
+        with self._lock:
+            rows = self.connection.execute("SELECT name, uid FROM uids").fetchall()
+        self._uids.update(rows)
+        return len(rows)
+
+    def get_uid(self, name):
+        """Returns the UID of the user, or None if it hasn't been assigned"""
+        if name in self._uids:
+            return self._uids[name]
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT uid FROM uids WHERE name = ?", (name,)
+            ).fetchone()
+        if not row:
+            return None
+        self._uids[name] = row[0]
+        return row[0]
+
+    def allocate_uid(self, name):
+        """Returns the UID of the user, which is assigned if the user has none"""
+        uid = self.get_uid(name)
+        if uid is not None:
+            return uid
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # The user might have been assigned by another process
+                cursor.execute(
+                    "INSERT OR IGNORE INTO uids (name, uid) "
+                    "SELECT ?, COALESCE(MAX(uid) + 1, ?) FROM uids",
+                    (name, self._start_uid),
+                )
+                uid = cursor.execute(
+                    "SELECT uid FROM uids WHERE name = ?", (name,)
+                ).fetchone()[0]
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            else:
+                cursor.execute("COMMIT")
+            finally:
+                cursor.close()
+        self._uids[name] = uid
+        return uid
+
+    def allocate(self, name):
+        """Returns the (uid, gid) of the user"""
+        uid = self.allocate_uid(name)
+        if self._gid is None:
+            return uid, uid
+        return uid, self._gid
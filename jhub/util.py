@@ -1,3 +1,7 @@
+import time
+import tracemalloc
+
+
 def recursive_format(input, value):
     if isinstance(input, list):
         for item_index, item_value in enumerate(input):
@@ -17,3 +21,37 @@ def recursive_format(input, value):
             recursive_format(input_value, value)
     if hasattr(input, "__dict__"):
         recursive_format(input.__dict__, value)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class PhaseTimer:
+    """Records the duration of consecutive phases, and the memory that they
+    allocated while tracemalloc is tracing"""
+
+    def __init__(self):
+        self.phases = []
+        self._started = time.perf_counter()
+        self._allocated = self.allocated()
+
+    @staticmethod
+    def allocated():
+        if not tracemalloc.is_tracing():
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def lap(self, phase):
+        now, allocated = time.perf_counter(), self.allocated()
+        self.phases.append(
+            {
+                "phase": phase,
+                "seconds": now - self._started,
+                "allocated_bytes": allocated - self._allocated,
+            }
+        )
+        self._started, self._allocated = now, allocated
@@ -0,0 +1,183 @@
+import re
+import time
+import weakref
+
+# The label that marks a volume as being kept warm by the named pool
+WARM_POOL_LABEL = "jhub.swarmspawner.warm_pool"
+# The label that marks a keeper service with the name of the volume it holds
+WARM_VOLUME_LABEL = "jhub.swarmspawner.warm_volume"
+
+
+def get_keeper_name(volume_name):
+    """The name of the service that keeps the volume mounted on its node"""
+    return "warm-{}".format(re.sub("[^a-zA-Z0-9-]", "-", volume_name))[:63]
+
+
+class WarmVolume:
+    """The last known state of a volume in a WarmVolumePool"""
+
+    def __init__(self, name):
+        self.name = name
+        self.node = None
+        self.last_used = None
+        self.in_use = False
+        self.failures = 0
+
+    @property
+    def healthy(self):
+        return self.failures == 0
+
+
+class WarmVolumePool:
+    """
+    Tracks the per-user volumes that are kept after their service has
+    been removed, such that a repeated spawn of the same user's server
+    can reuse the volume on the node where it was last mounted.
+
+    A volume that hasn't been used for idle_timeout seconds is expired
+    and should be removed. A volume whose service failed to start is
+    marked as unhealthy, and after max_failures consecutive failures
+    the node affinity of the volume is dropped.
+
+    If keep_mounted is set, an idle volume is held by a keeper service
+    on its node that runs the keeper_command, such that the volume plugin
+    doesn't unmount it and the next spawn skips the remote mount. A spawn
+    that isn't running on the node of its volumes within placement_timeout
+    seconds is placed on another node instead.
+
+    The volumes are local to their node, and are listed and removed via
+    the Docker endpoint of the node in node_endpoints, or the primary
+    endpoint of the spawner if the node has none.
+    """
+
+    _pools = weakref.WeakValueDictionary()
+
+    def __init__(
+        self,
+        name="sshfs",
+        idle_timeout=3600,
+        node_affinity=True,
+        max_failures=1,
+        keep_mounted=True,
+        keeper_command=("sleep", "infinity"),
+        placement_timeout=20,
+        node_endpoints=None,
+    ):
+        self._name = name
+        self._idle_timeout = idle_timeout
+        self._node_affinity = node_affinity
+        self._max_failures = max_failures
+        self._keep_mounted = keep_mounted
+        self._keeper_command = list(keeper_command)
+        self._placement_timeout = placement_timeout
+        self._node_endpoints = dict(node_endpoints or {})
+        self._volumes = {}
+        WarmVolumePool._pools[name] = self
+
+    @classmethod
+    def get(cls, name):
+        return cls._pools.get(name)
+
+    @classmethod
+    def pools(cls):
+        return list(cls._pools.values())
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def volumes(self):
+        return self._volumes
+
+    @property
+    def keep_mounted(self):
+        return self._keep_mounted
+
+    @property
+    def keeper_command(self):
+        return list(self._keeper_command)
+
+    @property
+    def placement_timeout(self):
+        return self._placement_timeout
+
+    @property
+    def node_endpoints(self):
+        return dict(self._node_endpoints)
+
+    def endpoint(self, node):
+        """The Docker endpoint of the node, or None for the primary endpoint"""
+        return self._node_endpoints.get(node)
+
+    def node(self, name):
+        """The node where the volume was last mounted"""
+        volume = self._volumes.get(name)
+        return volume.node if volume is not None else None
+
+    def _volume(self, name):
+        if name not in self._volumes:
+            self._volumes[name] = WarmVolume(name)
+        return self._volumes[name]
+
+    def checkout(self, name):
+        """Mark the volume as used by a spawn, returns the node that the
+        spawn should be placed on or None if the volume has no affinity"""
+        volume = self._volume(name)
+        volume.in_use = True
+        if not self._node_affinity or volume.failures >= self._max_failures:
+            return None
+        return volume.node
+
+    def checkin(self, name, node=None, healthy=True, now=None):
+        """Mark the volume as idle after its service was removed, on the node
+        where it was last mounted"""
+        if now is None:
+            now = time.time()
+        volume = self._volume(name)
+        volume.in_use = False
+        volume.last_used = now
+        if healthy:
+            volume.failures = 0
+        else:
+            volume.failures += 1
+        if node:
+            volume.node = node
+
+    def restore(self, name, node=None, in_use=False, now=None):
+        """Track a volume that was found on the node, e.g. after a restart of
+        the hub. Its idle time is counted from now, since the time that it
+        was last used isn't known."""
+        if now is None:
+            now = time.time()
+        volume = self._volume(name)
+        volume.node = node or volume.node
+        volume.in_use = volume.in_use or in_use
+        if not volume.in_use and volume.last_used is None:
+            volume.last_used = now
+
+    def expired(self, now=None):
+        """The names of the idle volumes that have passed the idle_timeout"""
+        if now is None:
+            now = time.time()
+        return [
+            volume.name
+            for volume in self._volumes.values()
+            if not volume.in_use
+            and volume.last_used is not None
+            and now - volume.last_used > self._idle_timeout
+        ]
+
+    def forget(self, name):
+        self._volumes.pop(name, None)
+
+    def status(self):
+        return {
+            volume.name: {
+                "node": volume.node,
+                "in_use": volume.in_use,
+                "last_used": volume.last_used,
+                "healthy": volume.healthy,
+            }
+            for volume in self._volumes.values()
+        }
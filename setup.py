@@ -34,6 +34,9 @@ setup(
     license="BSD",
     keywords=["Interactive", "Interpreter", "Shell", "Web"],
     install_requires=read_req("requirements.txt"),
+    entry_points={
+        "console_scripts": ["jhub-swarmspawner-dryrun=jhub.dryrun:main"],
+    },
     extras_require={
         "dev": read_req("requirements-dev.txt"),
         "test": read_req(os.path.join("tests", "requirements.txt")),
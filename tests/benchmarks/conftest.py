@@ -0,0 +1,52 @@
+"""Define fixtures for the SwarmSpawner benchmarks."""
+
+import asyncio
+import os
+import pytest
+from traitlets.config import Config
+from fakeswarm import FakeSwarm
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.swarmspawner import SwarmSpawner
+
+
+@pytest.fixture(scope="module")
+def fake_swarm():
+    """A FakeSwarm that the docker clients of the spawners are pointed at"""
+    previous_host = os.environ.get("DOCKER_HOST")
+    with FakeSwarm(seed=0) as swarm:
+        os.environ["DOCKER_HOST"] = swarm.url
+        yield swarm
+    if previous_host is None:
+        os.environ.pop("DOCKER_HOST", None)
+    else:
+        os.environ["DOCKER_HOST"] = previous_host
+
+
+@pytest.fixture(scope="module")
+def loop():
+    _loop = asyncio.new_event_loop()
+    yield _loop
+    _loop.close()
+
+
+@pytest.fixture
+def spawner_config():
+    config = Config()
+    config.SwarmSpawner.jupyterhub_service_name = "jupyterhub"
+    config.SwarmSpawner.networks = ["jupyterhub_default"]
+    config.SwarmSpawner.images = [
+        {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"}
+    ]
+    return config
+
+
+@pytest.fixture
+def make_spawner(spawner_config):
+    hub = DryRunHub()
+
+    def _make_spawner(name, **kwargs):
+        return SwarmSpawner(
+            config=spawner_config, user=DryRunUser(name), hub=hub, **kwargs
+        )
+
+    return _make_spawner
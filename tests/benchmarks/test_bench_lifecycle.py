@@ -0,0 +1,39 @@
+import asyncio
+import pytest
+
+
+@pytest.mark.parametrize("users", [10, 100])
+def test_poll(benchmark, fake_swarm, loop, make_spawner, users):
+    spawners = [
+        make_spawner("poll-{}-{}".format(users, index)) for index in range(users)
+    ]
+    for spawner in spawners:
+        loop.run_until_complete(spawner.start())
+
+    async def poll_all():
+        return await asyncio.gather(*[spawner.poll() for spawner in spawners])
+
+    states = benchmark(lambda: loop.run_until_complete(poll_all()))
+    assert states == [None] * users
+
+    for spawner in spawners:
+        loop.run_until_complete(spawner.stop())
+
+
+def test_stop(benchmark, fake_swarm, loop, make_spawner):
+    names = ("stop-{}".format(index) for index in range(1000))
+
+    def start():
+        spawner = make_spawner(next(names))
+        loop.run_until_complete(spawner.start())
+        return (spawner,), {}
+
+    def stop(spawner):
+        loop.run_until_complete(spawner.stop())
+
+    benchmark.pedantic(stop, setup=start, rounds=20)
+    assert not [
+        service
+        for service in fake_swarm.services.values()
+        if service["Spec"]["Name"].startswith("jupyter-stop")
+    ]
@@ -0,0 +1,48 @@
+"""Benchmark the memory that the hub keeps for the tasks of its servers."""
+
+import json
+import tracemalloc
+import pytest
+from jhub.tasks import TaskRecord
+
+SERVERS = 5000
+
+
+@pytest.fixture
+def task_payload(fake_swarm, loop, make_spawner):
+    """The JSON of a task of a spawned server, as returned by the Docker API"""
+    spawner = make_spawner("memory-user")
+    loop.run_until_complete(spawner.start())
+    with fake_swarm.lock:
+        task = fake_swarm.render_task(fake_swarm.tasks[spawner.task_id])
+    loop.run_until_complete(spawner.stop())
+    return json.dumps(task)
+
+
+def allocated(build):
+    """The objects that build returns and the bytes that they take up"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = build()
+        return objects, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def test_task_footprint(benchmark, task_payload):
+    payloads, payload_bytes = allocated(
+        lambda: [[json.loads(task_payload)] for _ in range(SERVERS)]
+    )
+    records, record_bytes = allocated(
+        lambda: [
+            [TaskRecord.from_task(json.loads(task_payload))] for _ in range(SERVERS)
+        ]
+    )
+    benchmark.extra_info["servers"] = SERVERS
+    benchmark.extra_info["payload_bytes_per_server"] = payload_bytes // SERVERS
+    benchmark.extra_info["record_bytes_per_server"] = record_bytes // SERVERS
+    assert record_bytes * 5 < payload_bytes
+
+    task = payloads[0][0]
+    assert benchmark(TaskRecord.from_task, task) == records[0][0]
@@ -0,0 +1,45 @@
+import os
+import pytest
+from jhub.accelerators import AcceleratorPool
+from jhub.mount import VolumeMounter
+
+volume_config = {
+    "type": "volume",
+    "source": "volume-{name}",
+    "target": "/home/jovyan/work",
+    "labels": {"autoremove": "True", "owner": "{name}"},
+}
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_accelerator_claim_release(benchmark, tmp_path, shared):
+    pool = AcceleratorPool(
+        "gpu",
+        False,
+        ids=[str(index) for index in range(64)],
+        ledger_path=os.path.join(tmp_path, "accelerators.db"),
+        shared=shared,
+    )
+    # Claim half of the devices such that the claims are ranked among the rest
+    for index in range(32):
+        pool.aquire("jupyter-owner{}-1".format(index))
+
+    def claim_release():
+        claim = pool.aquire("jupyter-user1-1")
+        pool.release("jupyter-user1-1")
+        return claim
+
+    assert benchmark(claim_release) is not None
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_volume_mounter_create(benchmark, loop, cached):
+    mounter = VolumeMounter(volume_config)
+    names = iter(range(10**7))
+
+    def create():
+        name = "user1" if cached else "user{}".format(next(names))
+        return loop.run_until_complete(mounter.create(name={"name": name}))
+
+    mount = benchmark(create)
+    assert mount["Target"] == "/home/jovyan/work"
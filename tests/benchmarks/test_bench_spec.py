@@ -0,0 +1,69 @@
+import copy
+from jhub.util import recursive_format
+
+format_values = {
+    "name": "user1",
+    "service_owner": "user1",
+    "uid": 10000,
+    "gid": 10000,
+    "mount_data": {"username": "mountuser", "targetHost": "mount_target"},
+}
+
+
+def large_spec(size):
+    """A service spec with size environment variables, mounts and labels"""
+    return {
+        "ContainerSpec": {
+            "Image": "ucphhpc/base-notebook:latest",
+            "Command": ["/bin/bash", "-c", "mkdir -p /home/{service_owner}"],
+            "Env": {
+                "VARIABLE_{}".format(index): "{name}-{uid}-" + str(index)
+                for index in range(size)
+            },
+            "Mounts": [
+                {
+                    "type": "volume",
+                    "source": "volume-{name}-" + str(index),
+                    "target": "/home/{service_owner}/data" + str(index),
+                    "driver_config": {
+                        "name": "ucphhpc/sshfs:latest",
+                        "options": {"sshcmd": "{mount_data}@host", "port": "22"},
+                    },
+                    "labels": {"owner": "{name}", "missing": "{unknown}"},
+                }
+                for index in range(size)
+            ],
+        },
+        "Labels": {"label-{}".format(index): "{gid}" for index in range(size)},
+    }
+
+
+def test_recursive_format_large_spec(benchmark):
+    spec = large_spec(500)
+    formatted = benchmark.pedantic(
+        recursive_format,
+        setup=lambda: ((copy.deepcopy(spec), format_values), {}),
+        rounds=20,
+    )
+    assert formatted is None
+
+
+def test_options_from_form_large_catalog(benchmark, spawner_config, make_spawner):
+    spawner_config.SwarmSpawner.use_user_options = True
+    spawner_config.SwarmSpawner.images = [
+        {"name": "Notebook {}".format(index), "image": "notebook:{}".format(index)}
+        for index in range(2000)
+    ]
+    spawner = make_spawner("user1")
+    # The last image of the catalog is the slowest to validate
+    form_data = {
+        "select_image": [repr({"name": "Notebook 1999", "image": "notebook:1999"})]
+    }
+    options = benchmark(spawner.options_from_form, form_data)
+    assert options["user_selected_image"] == "notebook:1999"
+
+
+def test_build_service_spec(benchmark, fake_swarm, loop, make_spawner):
+    spawner = make_spawner("user1")
+    spec = benchmark(lambda: loop.run_until_complete(spawner.build_service_spec({})))
+    assert spec["task_template"]["ContainerSpec"]["Image"]
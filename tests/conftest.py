@@ -4,6 +4,9 @@ import time
 import docker
 import pytest
 from docker.errors import NotFound
+from traitlets.config import Config
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.swarmspawner import SwarmSpawner
 
 
 HUB_IMAGE_TAG = "hub:test"
@@ -151,3 +154,21 @@ def make_volume_():
                 client.volumes.get(_id)
             except NotFound:
                 removed = True
+
+
+@pytest.fixture(name="make_spawner")
+def make_spawner_():
+    """Create a SwarmSpawner of the base notebook image, whose Docker reads
+    aren't cached, with additional SwarmSpawner config options"""
+
+    def make_spawner(name="user1", **options):
+        config = Config()
+        config.SwarmSpawner.images = [
+            {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"}
+        ]
+        config.SwarmSpawner.docker_read_cache_ttl = 0
+        for option, value in options.items():
+            setattr(config.SwarmSpawner, option, value)
+        return SwarmSpawner(config=config, user=DryRunUser(name), hub=DryRunHub())
+
+    return make_spawner
@@ -0,0 +1,574 @@
+"""
+An in-process stand-in for the subset of the Docker Engine API that the
+SwarmSpawner uses, i.e. services, tasks, configs, volumes, nodes and
+events, such that the spawner can be exercised and load tested without
+a Docker Swarm.
+
+    with FakeSwarm(latency=0.005) as swarm:
+        os.environ["DOCKER_HOST"] = swarm.url
+        ...
+
+Each service gets a single task, which progresses through the task_states
+as time passes. A fraction of the tasks can be rejected instead. A task is
+placed on a node that satisfies the node.id constraints of its service, and
+is rejected if there is no such node that isn't one of the full_nodes.
+
+The state can be served by several managers, each on its own port, of
+which the leader is the one that is reported as such by /nodes.
+"""
+
+import copy
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_VERSION = "1.43"
+
+# The state of a new task and the seconds after which it reaches each state
+DEFAULT_TASK_STATES = [
+    ("new", 0),
+    ("pending", 0),
+    ("assigned", 0),
+    ("preparing", 0),
+    ("starting", 0),
+    ("running", 0),
+]
+
+VERSION_PREFIX = re.compile(r"^/v\d+\.\d+")
+
+
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).isoformat()
+
+
+def parse_filters(query):
+    filters = query.get("filters")
+    if not filters:
+        return {}
+    filters = json.loads(filters[0])
+    # Filters can either be lists or dictionaries of values
+    return {
+        key: list(values) if isinstance(values, (list, dict)) else [values]
+        for key, values in filters.items()
+    }
+
+
+def match_labels(labels, label_filters):
+    labels = labels or {}
+    for label_filter in label_filters:
+        key, _, value = label_filter.partition("=")
+        if key not in labels:
+            return False
+        if value and labels[key] != value:
+            return False
+    return True
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeSwarm:
+    """The state of the fake swarm and the HTTP server that exposes it"""
+
+    def __init__(
+        self,
+        latency=0,
+        latencies=None,
+        task_states=None,
+        reject_ratio=0,
+        nodes=("node-1",),
+        seed=None,
+        managers=1,
+        leader=0,
+        manager_latencies=None,
+    ):
+        # Seconds that every request, or each "<METHOD> <resource>", is delayed
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.task_states = task_states or DEFAULT_TASK_STATES
+        self.reject_ratio = reject_ratio
+        self.nodes = list(nodes)
+        # The nodes that are ready, but have no resources left for a task
+        self.full_nodes = set()
+        self.managers = managers
+        self.leader = leader
+        # Seconds that every request to each manager index is delayed
+        self.manager_latencies = manager_latencies or {}
+        self.manager_requests = {}
+        self.random = random.Random(seed)
+        self.services = {}
+        self.tasks = {}
+        self.task_listings = 0
+        self.configs = {}
+        self.volumes = {}
+        self.events = []
+        self.images = {}
+        self.requests = {}
+        self.lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._servers = []
+
+    def new_id(self, kind):
+        return hashlib.sha256(
+            "{}-{}".format(kind, next(self._ids)).encode()
+        ).hexdigest()[:25]
+
+    @property
+    def urls(self):
+        """The URL of each manager"""
+        return [
+            "tcp://{}:{}".format(*server.server_address[:2]) for server in self._servers
+        ]
+
+    @property
+    def url(self):
+        return self.urls[0]
+
+    def start(self):
+        for manager in range(self.managers):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSwarmHandler)
+            server.daemon_threads = True
+            server.swarm = self
+            server.manager = manager
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def delay(self, method, resource, manager=0):
+        latency = self.latencies.get(
+            "{} {}".format(method, resource), self.latencies.get(resource)
+        )
+        if latency is None:
+            latency = self.latency
+        latency += self.manager_latencies.get(manager, 0)
+        if latency:
+            time.sleep(latency)
+
+    def record(self, method, resource, manager=0):
+        key = "{} {}".format(method, resource)
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.manager_requests[manager] = self.manager_requests.get(manager, 0) + 1
+
+    def add_event(self, _type, action, _id, attributes=None):
+        now = time.time()
+        self.events.append(
+            {
+                "Type": _type,
+                "Action": action,
+                "Actor": {"ID": _id, "Attributes": attributes or {}},
+                "scope": "swarm",
+                "time": int(now),
+                "timeNano": int(now * 1e9),
+            }
+        )
+
+    # Services
+    def find_service(self, name_or_id):
+        if name_or_id in self.services:
+            return self.services[name_or_id]
+        for service in self.services.values():
+            if service["Spec"]["Name"] == name_or_id:
+                return service
+            if service["ID"].startswith(name_or_id):
+                return service
+        raise NotFound("service {} not found".format(name_or_id))
+
+    def normalize_spec(self, spec):
+        """Docker decodes the keys of a spec case-insensitively,
+        e.g. docker-py's ServiceMode is {"replicated": {"Replicas": 1}}"""
+        spec = {key: value for key, value in spec.items() if value is not None}
+        if spec.get("Mode"):
+            spec["Mode"] = {
+                key[0].upper() + key[1:]: value for key, value in spec["Mode"].items()
+            }
+        return spec
+
+    def replicas(self, spec):
+        mode = spec.get("Mode") or {}
+        return (mode.get("Replicated") or {}).get("Replicas", 1)
+
+    def create_task(self, service):
+        now = time.time()
+        task_id = self.new_id("task")
+        rejected = self.random.random() < self.reject_ratio
+        placement = service["Spec"]["TaskTemplate"].get("Placement") or {}
+        node_ids = [
+            constraint.split("==", 1)[1].strip()
+            for constraint in placement.get("Constraints") or []
+            if constraint.replace(" ", "").startswith("node.id==")
+        ]
+        candidates = [
+            node
+            for node in self.nodes
+            if node not in self.full_nodes and all(node == id for id in node_ids)
+        ]
+        self.tasks[task_id] = {
+            "ID": task_id,
+            "ServiceID": service["ID"],
+            "NodeID": self.random.choice(candidates or self.nodes),
+            "Slot": 1,
+            "CreatedAt": timestamp(now),
+            "UpdatedAt": timestamp(now),
+            "Spec": copy.deepcopy(service["Spec"]["TaskTemplate"]),
+            "DesiredState": "running",
+            "Status": {"State": "new", "Timestamp": timestamp(now)},
+            "_created": now,
+            "_rejected": rejected or not candidates,
+            "_shutdown": None,
+        }
+
+    def shutdown_tasks(self, service_id):
+        for task in self.tasks.values():
+            if task["ServiceID"] == service_id and task["_shutdown"] is None:
+                task["_shutdown"] = time.time()
+                task["DesiredState"] = "shutdown"
+
+    def task_state(self, task):
+        """The state of the task, based on how long ago it was created"""
+        if task["_shutdown"] is not None:
+            return {"State": "shutdown", "Timestamp": timestamp(task["_shutdown"])}
+        elapsed = time.time() - task["_created"]
+        state, reached = self.task_states[0][0], task["_created"]
+        for next_state, seconds in self.task_states:
+            if elapsed < seconds:
+                break
+            state, reached = next_state, task["_created"] + seconds
+            if task["_rejected"] and next_state == "assigned":
+                status = {"State": "rejected", "Timestamp": timestamp(reached)}
+                status["Err"] = "no suitable node"
+                return status
+        return {"State": state, "Timestamp": timestamp(reached)}
+
+    def render_task(self, task):
+        rendered = {key: value for key, value in task.items() if key[0] != "_"}
+        rendered["Status"] = self.task_state(task)
+        rendered["UpdatedAt"] = rendered["Status"]["Timestamp"]
+        return rendered
+
+    def create_service(self, spec):
+        if any(
+            service["Spec"]["Name"] == spec.get("Name")
+            for service in self.services.values()
+        ):
+            raise ValueError("name conflicts with an existing object")
+        now = time.time()
+        service_id = self.new_id("service")
+        spec = self.normalize_spec(spec)
+        service = {
+            "ID": service_id,
+            "Version": {"Index": next(self._ids)},
+            "CreatedAt": timestamp(now),
+            "UpdatedAt": timestamp(now),
+            "Spec": spec,
+        }
+        self.services[service_id] = service
+        if self.replicas(spec) > 0:
+            self.create_task(service)
+        self.add_event("service", "create", service_id, {"name": spec["Name"]})
+        return {"ID": service_id}
+
+    def update_service(self, name_or_id, version, spec):
+        service = self.find_service(name_or_id)
+        if int(version) != service["Version"]["Index"]:
+            raise ValueError("update out of sequence")
+        spec = self.normalize_spec(spec)
+        previous = service["Spec"]
+        service["Spec"] = spec
+        service["Version"] = {"Index": next(self._ids)}
+        service["UpdatedAt"] = timestamp(time.time())
+        if self.replicas(spec) == 0:
+            self.shutdown_tasks(service["ID"])
+        elif (
+            spec.get("TaskTemplate") != previous.get("TaskTemplate")
+            or self.replicas(previous) == 0
+        ):
+            self.shutdown_tasks(service["ID"])
+            self.create_task(service)
+        self.add_event("service", "update", service["ID"], {"name": spec["Name"]})
+        return {"Warnings": []}
+
+    def remove_service(self, name_or_id):
+        service = self.find_service(name_or_id)
+        del self.services[service["ID"]]
+        for task_id in [
+            task_id
+            for task_id, task in self.tasks.items()
+            if task["ServiceID"] == service["ID"]
+        ]:
+            del self.tasks[task_id]
+        self.add_event(
+            "service", "remove", service["ID"], {"name": service["Spec"]["Name"]}
+        )
+
+    def list_services(self, filters):
+        services = []
+        for service in self.services.values():
+            if "id" in filters and not any(
+                service["ID"].startswith(_id) for _id in filters["id"]
+            ):
+                continue
+            if "name" in filters and service["Spec"]["Name"] not in filters["name"]:
+                continue
+            if "label" in filters and not match_labels(
+                service["Spec"].get("Labels"), filters["label"]
+            ):
+                continue
+            services.append(service)
+        return services
+
+    def list_tasks(self, filters):
+        self.task_listings += 1
+        service_ids = None
+        if "service" in filters:
+            service_ids = set()
+            for name_or_id in filters["service"]:
+                try:
+                    service_ids.add(self.find_service(name_or_id)["ID"])
+                except NotFound:
+                    continue
+        tasks = []
+        for task in self.tasks.values():
+            if service_ids is not None and task["ServiceID"] not in service_ids:
+                continue
+            if "id" in filters and task["ID"] not in filters["id"]:
+                continue
+            if "node" in filters and task["NodeID"] not in filters["node"]:
+                continue
+            rendered = self.render_task(task)
+            if (
+                "desired-state" in filters
+                and rendered["DesiredState"] not in filters["desired-state"]
+            ):
+                continue
+            tasks.append(rendered)
+        return tasks
+
+
+class FakeSwarmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def swarm(self):
+        return self.server.swarm
+
+    def respond(self, status, body=None):
+        if isinstance(body, bytes):
+            # Streamed responses, e.g. events, are chunked
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for line in body.splitlines(keepends=True):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        content = b""
+        if body is not None:
+            content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def route(self, method):
+        url = urlparse(self.path)
+        path = VERSION_PREFIX.sub("", url.path).rstrip("/")
+        query = parse_qs(url.query)
+        parts = path.strip("/").split("/")
+        resource = parts[0]
+        self.swarm.record(method, resource, self.server.manager)
+        self.swarm.delay(method, resource, self.server.manager)
+        body = self.read_body() if method == "POST" else {}
+        try:
+            with self.swarm.lock:
+                status, response = self.dispatch(
+                    method, parts, query, body, self.server.manager
+                )
+        except NotFound as err:
+            status, response = 404, {"message": str(err)}
+        except ValueError as err:
+            status, response = 409, {"message": str(err)}
+        self.respond(status, response)
+
+    def dispatch(self, method, parts, query, body, manager=0):
+        swarm = self.swarm
+        resource, rest = parts[0], parts[1:]
+        if resource in ("version", "_ping"):
+            return 200, {
+                "ApiVersion": API_VERSION,
+                "MinAPIVersion": "1.24",
+                "Version": "fake",
+            }
+
+        if resource == "info":
+            return 200, {
+                "Swarm": {
+                    "NodeID": "manager-{}".format(manager),
+                    "ControlAvailable": True,
+                }
+            }
+
+        if resource == "services":
+            if method == "GET" and not rest:
+                return 200, swarm.list_services(parse_filters(query))
+            if method == "POST" and rest == ["create"]:
+                return 201, swarm.create_service(body)
+            if method == "GET":
+                return 200, swarm.find_service(rest[0])
+            if method == "POST" and rest[1:] == ["update"]:
+                version = query.get("version", ["0"])[0]
+                return 200, swarm.update_service(rest[0], version, body)
+            if method == "DELETE":
+                swarm.remove_service(rest[0])
+                return 200, None
+
+        if resource == "tasks":
+            if not rest:
+                return 200, swarm.list_tasks(parse_filters(query))
+            if rest[0] not in swarm.tasks:
+                raise NotFound("task {} not found".format(rest[0]))
+            return 200, swarm.render_task(swarm.tasks[rest[0]])
+
+        if resource == "configs":
+            if method == "GET" and not rest:
+                return 200, list(swarm.configs.values())
+            if method == "POST" and rest == ["create"]:
+                if any(
+                    config["Spec"]["Name"] == body["Name"]
+                    for config in swarm.configs.values()
+                ):
+                    raise ValueError("config {} already exists".format(body["Name"]))
+                config_id = swarm.new_id("config")
+                swarm.configs[config_id] = {"ID": config_id, "Spec": body}
+                return 201, {"ID": config_id}
+            for config_id, config in list(swarm.configs.items()):
+                if rest[0] in (config_id, config["Spec"]["Name"]):
+                    if method == "DELETE":
+                        del swarm.configs[config_id]
+                        return 204, None
+                    return 200, config
+            raise NotFound("config {} not found".format(rest[0]))
+
+        if resource == "volumes":
+            if method == "GET" and not rest:
+                label_filters = parse_filters(query).get("label", [])
+                volumes = [
+                    volume
+                    for volume in swarm.volumes.values()
+                    if match_labels(volume["Labels"], label_filters)
+                ]
+                return 200, {"Volumes": volumes, "Warnings": []}
+            if method == "POST" and rest == ["create"]:
+                name = body.get("Name") or swarm.new_id("volume")
+                volume = swarm.volumes.setdefault(
+                    name,
+                    {
+                        "Name": name,
+                        "Driver": body.get("Driver") or "local",
+                        "Labels": body.get("Labels") or {},
+                        "Options": body.get("DriverOpts") or {},
+                        "Scope": "local",
+                    },
+                )
+                return 201, volume
+            if rest[0] not in swarm.volumes:
+                raise NotFound("volume {} not found".format(rest[0]))
+            if method == "DELETE":
+                del swarm.volumes[rest[0]]
+                return 204, None
+            return 200, swarm.volumes[rest[0]]
+
+        if resource == "nodes":
+            nodes = [
+                {
+                    "ID": node,
+                    "Spec": {"Availability": "active", "Role": "worker"},
+                    "Status": {"State": "ready"},
+                }
+                for node in swarm.nodes
+            ] + [
+                {
+                    "ID": "manager-{}".format(index),
+                    "Spec": {"Availability": "drain", "Role": "manager"},
+                    "Status": {"State": "ready"},
+                    "ManagerStatus": {"Leader": index == swarm.leader},
+                }
+                for index in range(swarm.managers)
+            ]
+            if not rest:
+                return 200, nodes
+            for node in nodes:
+                if node["ID"] == rest[0]:
+                    return 200, node
+            raise NotFound("node {} not found".format(rest[0]))
+
+        if resource == "distribution":
+            image = "/".join(rest[:-1])
+            digest = swarm.images.get(image) or "sha256:{}".format(
+                hashlib.sha256(image.encode()).hexdigest()
+            )
+            return 200, {
+                "Descriptor": {
+                    "MediaType": "application/vnd.oci.image.index.v1+json",
+                    "Digest": digest,
+                    "Size": 1024,
+                },
+                "Platforms": [{"architecture": "amd64", "os": "linux"}],
+            }
+
+        if resource == "events":
+            since = float(query.get("since", ["0"])[0])
+            until = float(query.get("until", [str(time.time())])[0])
+            # Events are streamed as consecutive JSON objects
+            return 200, b"".join(
+                json.dumps(event).encode() + b"\n"
+                for event in swarm.events
+                if since <= event["time"] <= until
+            )
+
+        raise NotFound("page not found: /{}".format("/".join(parts)))
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
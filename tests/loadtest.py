@@ -0,0 +1,152 @@
+"""
+Drive simulated spawn, poll and stop cycles of the SwarmSpawner against
+a FakeSwarm and report the throughput and the latency percentiles of
+each operation.
+
+    python tests/loadtest.py --users 1000 --concurrency 50 --latency 0.002
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from traitlets.config import Config
+from fakeswarm import FakeSwarm
+from jhub.dryrun import DryRunHub, DryRunUser, load_config, summarize
+from jhub.swarmspawner import SwarmSpawner
+
+
+def default_config():
+    config = Config()
+    config.SwarmSpawner.jupyterhub_service_name = "jupyterhub"
+    config.SwarmSpawner.networks = ["jupyterhub_default"]
+    config.SwarmSpawner.images = [
+        {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"}
+    ]
+    return config
+
+
+async def spawn_cycle(config, hub, name, polls, poll_interval, latencies):
+    spawner = SwarmSpawner(config=config, user=DryRunUser(name), hub=hub)
+
+    async def timed(operation, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        latencies.setdefault(operation, []).append(time.perf_counter() - started)
+        return result
+
+    await timed("start", spawner.start())
+    for _ in range(polls):
+        await asyncio.sleep(poll_interval)
+        await timed("poll", spawner.poll())
+    await timed("stop", spawner.stop())
+
+
+async def run_cycles(config, users, concurrency, polls, poll_interval, user_prefix):
+    hub = DryRunHub()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = {}, []
+
+    async def limited(name):
+        async with semaphore:
+            try:
+                await spawn_cycle(config, hub, name, polls, poll_interval, latencies)
+            except Exception as err:
+                errors.append("{}: {}".format(name, err))
+
+    await asyncio.gather(
+        *[limited("{}{}".format(user_prefix, index)) for index in range(users)]
+    )
+    return latencies, errors
+
+
+def load_test(
+    config=None,
+    users=100,
+    concurrency=10,
+    polls=1,
+    poll_interval=0,
+    user_prefix="user",
+    swarm=None,
+):
+    """Returns a JSON serializable report of the load test"""
+    if config is None:
+        config = default_config()
+    if swarm is None:
+        swarm = FakeSwarm()
+
+    previous_host = os.environ.get("DOCKER_HOST")
+    with swarm:
+        os.environ["DOCKER_HOST"] = swarm.url
+        try:
+            started = time.perf_counter()
+            latencies, errors = asyncio.run(
+                run_cycles(
+                    config, users, concurrency, polls, poll_interval, user_prefix
+                )
+            )
+            seconds = time.perf_counter() - started
+        finally:
+            if previous_host is None:
+                os.environ.pop("DOCKER_HOST", None)
+            else:
+                os.environ["DOCKER_HOST"] = previous_host
+
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "cycles_per_second": users / seconds if seconds else 0,
+        "operations": {
+            operation: summarize(values) for operation, values in latencies.items()
+        },
+        "requests": dict(sorted(swarm.requests.items())),
+        "errors": errors,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--config", help="Path to a jupyterhub_config.py file")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--polls", type=int, default=1, help="Polls per cycle")
+    parser.add_argument("--poll-interval", type=float, default=0)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to each request"
+    )
+    parser.add_argument(
+        "--running-after",
+        type=float,
+        default=0,
+        help="Seconds before a new task is running",
+    )
+    parser.add_argument(
+        "--reject-ratio", type=float, default=0, help="Fraction of rejected tasks"
+    )
+    parsed_args = parser.parse_args(args)
+
+    config = None
+    if parsed_args.config:
+        config = load_config(parsed_args.config)
+    swarm = FakeSwarm(
+        latency=parsed_args.latency,
+        task_states=[("pending", 0), ("running", parsed_args.running_after)],
+        reject_ratio=parsed_args.reject_ratio,
+    )
+    report = load_test(
+        config=config,
+        users=parsed_args.users,
+        concurrency=parsed_args.concurrency,
+        polls=parsed_args.polls,
+        poll_interval=parsed_args.poll_interval,
+        swarm=swarm,
+    )
+    print(json.dumps(report, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
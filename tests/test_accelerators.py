@@ -0,0 +1,410 @@
+import asyncio
+import os
+import weakref
+from prometheus_client import REGISTRY
+import pytest
+from jhub.accelerators import (
+    AcceleratorPool,
+    AcceleratorQueueFull,
+    AcceleratorUsage,
+    parse_accelerator_ids,
+    slice_accelerator_ids,
+    SPREAD,
+)
+
+CLAIMS_TOTAL = "swarmspawner_accelerator_claims_total"
+
+
+def test_parse_accelerator_ids():
+    assert parse_accelerator_ids("0,1\n2\n\n1, 3") == ["0", "1", "2", "3"]
+
+
+def test_slice_accelerator_ids():
+    assert slice_accelerator_ids(["0", "1"], 2) == ["0:0", "0:1", "1:0", "1:1"]
+
+
+def test_accelerator_claim_release(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool("gpu", False, ids=[0, 1], ledger_path=ledger_path)
+
+    first = pool.aquire("jupyter-user1-1")
+    second = pool.aquire("jupyter-user2-1")
+    assert first.ids + second.ids == ["0", "1"]
+    assert first.constraints == []
+    assert pool.aquire("jupyter-user3-1") is None
+
+    assert pool.release("jupyter-user1-1")
+    assert pool.claims() == {("", "1"): ["jupyter-user2-1"]}
+    assert pool.aquire("jupyter-user3-1").ids == ["0"]
+
+
+def test_accelerator_claims_are_in_memory(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool("gpu", False, ids=["0", "1"], ledger_path=ledger_path)
+    assert pool.aquire("jupyter-user1-1").ids == ["0"]
+    assert pool.release("jupyter-user1-1")
+    assert not os.path.exists(ledger_path)
+
+    # Another pool doesn't see the claims
+    pool.aquire("jupyter-user1-1")
+    other_pool = AcceleratorPool("gpu", False, ids=["0", "1"], ledger_path=ledger_path)
+    assert other_pool.claims() == {}
+
+
+def test_accelerator_claims_are_persisted(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu", False, ids=["0", "1"], ledger_path=ledger_path, shared=True
+    )
+    claimed = pool.aquire("jupyter-user1-1")
+
+    # A restarted hub sees the existing claim
+    restarted_pool = AcceleratorPool(
+        "gpu", False, ids=["0", "1"], ledger_path=ledger_path, shared=True
+    )
+    assert restarted_pool.claims() == {("", "0"): ["jupyter-user1-1"]}
+    assert restarted_pool.aquire("jupyter-user2-1").ids != claimed.ids
+    assert restarted_pool.aquire("jupyter-user3-1") is None
+
+    # The first pool notices the claims made by the other process
+    pool.release("jupyter-user1-1")
+    assert restarted_pool.claims() == {("", "1"): ["jupyter-user2-1"]}
+
+
+def test_accelerator_reconcile(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool("gpu", False, ids=["0", "1", "2"], ledger_path=ledger_path)
+    pool.aquire("jupyter-user1-1")
+    pool.aquire("jupyter-user2-1")
+
+    # user1's service is gone, user2 and user3 have running services,
+    # "7" is not part of the pool
+    pool.reconcile(
+        {
+            "jupyter-user2-1": [("", "1")],
+            "jupyter-user3-1": [("", "2"), ("", "7")],
+        },
+        owners=["jupyter-user1-1"],
+    )
+    assert pool.claims() == {
+        ("", "1"): ["jupyter-user2-1"],
+        ("", "2"): ["jupyter-user3-1"],
+    }
+    assert pool.aquire("jupyter-user4-1").ids == ["0"]
+
+
+def test_accelerator_reconcile_keeps_unknown_owners(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu", False, ids=["0", "1", "2"], ledger_path=ledger_path, shared=True
+    )
+    # E.g. claimed by another hub that shares the ledger
+    pool.aquire("jupyter-user1-1")
+
+    restarted_pool = AcceleratorPool(
+        "gpu", False, ids=["0", "1", "2"], ledger_path=ledger_path, shared=True
+    )
+    restarted_pool.reconcile({"jupyter-user2-1": [("", "1")]})
+    assert restarted_pool.claims() == {
+        ("", "0"): ["jupyter-user1-1"],
+        ("", "1"): ["jupyter-user2-1"],
+    }
+    assert restarted_pool.aquire("jupyter-user3-1").ids == ["2"]
+
+
+def test_accelerator_node_placement(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    nodes = {"node-a": ["0", "1", "2", "3"], "node-b": ["0", "1"]}
+    pool = AcceleratorPool(
+        "gpu",
+        False,
+        nodes=nodes,
+        ledger_path=ledger_path,
+        generic_resource="NVIDIA-GPU",
+    )
+
+    # Best fit packs the small request onto the node with the fewest free devices
+    claim = pool.aquire("jupyter-user1-1")
+    assert claim.node == "node-b"
+    assert claim.constraints == ["node.id==node-b"]
+    assert claim.generic_resources == {"NVIDIA-GPU": 1}
+
+    # Which keeps node-a whole for a larger request
+    claim = pool.aquire("jupyter-user2-1", count=4)
+    assert claim.node == "node-a"
+    assert claim.ids == ["0", "1", "2", "3"]
+
+    assert pool.aquire("jupyter-user3-1", count=2) is None
+    assert pool.aquire("jupyter-user3-1", node="node-a") is None
+    assert pool.aquire("jupyter-user3-1", node="node-b").ids == ["1"]
+
+
+def test_accelerator_spread_placement(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    nodes = {"node-a": ["0", "1", "2"], "node-b": ["0", "1"]}
+    pool = AcceleratorPool(
+        "gpu", False, nodes=nodes, ledger_path=ledger_path, policy=SPREAD
+    )
+    assert pool.aquire("jupyter-user1-1").node == "node-a"
+    assert pool.aquire("jupyter-user2-1").node == "node-b"
+
+
+def test_accelerator_oversubscription(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu", True, ids=["0", "1"], shares={"0": 2, "1": 1}, ledger_path=ledger_path
+    )
+    # The least loaded accelerator is always selected
+    assert pool.aquire("jupyter-user1-1").ids == ["0"]
+    assert pool.aquire("jupyter-user2-1").ids == ["1"]
+    assert pool.aquire("jupyter-user3-1").ids == ["0"]
+    assert pool.aquire("jupyter-user4-1") is None
+    assert pool.claims() == {
+        ("", "0"): ["jupyter-user1-1", "jupyter-user3-1"],
+        ("", "1"): ["jupyter-user2-1"],
+    }
+
+    pool.release("jupyter-user1-1")
+    assert pool.aquire("jupyter-user4-1").ids == ["0"]
+
+    # Shares are ignored when the pool is not oversubscribed
+    exclusive_pool = AcceleratorPool(
+        "exclusive-gpu", False, ids=["0"], shares=4, ledger_path=ledger_path
+    )
+    assert exclusive_pool.aquire("jupyter-user1-1").ids == ["0"]
+    assert exclusive_pool.aquire("jupyter-user2-1") is None
+
+
+def test_accelerator_slices(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "mig",
+        True,
+        nodes={"node-a": ["0"]},
+        slices=2,
+        shares=2,
+        ledger_path=ledger_path,
+    )
+    claims = [pool.aquire("jupyter-user{}-1".format(i)) for i in range(4)]
+    assert sorted(claim.ids[0] for claim in claims) == ["0:0", "0:0", "0:1", "0:1"]
+    assert all(claim.constraints == ["node.id==node-a"] for claim in claims)
+    assert pool.aquire("jupyter-user4-1") is None
+
+    # A multi accelerator claim gets distinct slices
+    pool.release("jupyter-user0-1")
+    pool.release("jupyter-user1-1")
+    assert sorted(pool.aquire("jupyter-user5-1", count=2).ids) == ["0:0", "0:1"]
+
+
+def test_accelerator_usage():
+    usage = AcceleratorUsage()
+    device = ("node-a", "0")
+    usage.update(device, 0, 2, now=0)
+    usage.update(device, 2, 2, now=10)
+    usage.update(device, 1, 2, now=20)
+    # 10s idle, 10s fully claimed and 10s half claimed
+    assert usage.utilization(device, now=30) == 0.5
+
+
+def test_accelerator_status(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu", True, nodes={"node-a": ["0", "1"]}, shares=2, ledger_path=ledger_path
+    )
+    pool.aquire("jupyter-user1-1")
+    status = pool.status()
+    assert status["type"] == "gpu"
+    assert status["nodes"] == {"node-a": {"free": 2, "claimed": 1}}
+    assert [accelerator["users"] for accelerator in status["accelerators"]] == [
+        ["jupyter-user1-1"],
+        [],
+    ]
+    assert pool in AcceleratorPool.pools()
+
+
+def test_accelerator_claim_queue(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu",
+        False,
+        ids=["0"],
+        priorities={"staff": 0, "students": 1},
+        default_priority=2,
+        ledger_path=ledger_path,
+    )
+
+    async def queue():
+        first = await pool.claim("jupyter-user1-1")
+        assert first.ids == ["0"]
+        # Without a timeout the claim fails immediately
+        assert await pool.claim("jupyter-user2-1") is None
+
+        positions = {}
+
+        def on_wait(user):
+            return lambda position: positions.setdefault(user, position)
+
+        waiters = [
+            asyncio.ensure_future(
+                pool.claim(user, groups=groups, timeout=10, on_wait=on_wait(user))
+            )
+            for user, groups in [
+                ("jupyter-user2-1", ["students"]),
+                ("jupyter-user3-1", []),
+                ("jupyter-user4-1", ["staff", "students"]),
+                ("jupyter-user5-1", ["students"]),
+            ]
+        ]
+        await asyncio.sleep(0)
+        assert pool.waiting == 4
+
+        # Released accelerators are handed out by group priority, then FIFO
+        served = []
+        for _ in waiters:
+            pool.release(served[-1] if served else "jupyter-user1-1")
+            await asyncio.sleep(0.01)
+            served.extend(
+                waiter.result().owner
+                for waiter in waiters
+                if waiter.done() and waiter.result().owner not in served
+            )
+        assert served == [
+            "jupyter-user4-1",
+            "jupyter-user2-1",
+            "jupyter-user5-1",
+            "jupyter-user3-1",
+        ]
+        assert positions["jupyter-user4-1"] == 1
+
+    asyncio.run(queue())
+
+
+def test_accelerator_claim_timeout(tmp_path):
+    ledger_path = os.path.join(tmp_path, "accelerators.db")
+    pool = AcceleratorPool(
+        "gpu", False, ids=["0"], max_waiters=1, ledger_path=ledger_path
+    )
+
+    async def timeout():
+        assert await pool.claim("jupyter-user1-1")
+        waiter = asyncio.ensure_future(pool.claim("jupyter-user2-1", timeout=0.2))
+        await asyncio.sleep(0)
+        # The queue is full
+        labels = {"type": "gpu", "result": "queue_full"}
+        queue_full = REGISTRY.get_sample_value(CLAIMS_TOTAL, labels) or 0
+        with pytest.raises(AcceleratorQueueFull):
+            await pool.claim("jupyter-user3-1", timeout=1)
+        assert REGISTRY.get_sample_value(CLAIMS_TOTAL, labels) == queue_full + 1
+        assert await waiter is None
+        assert pool.waiting == 0
+
+    asyncio.run(timeout())
+
+
+def test_spawner_reconciles_each_pool_separately(tmp_path, monkeypatch):
+    from traitlets.config import Config
+    from fakeswarm import FakeSwarm
+    from jhub.dryrun import DryRunHub, DryRunUser
+    from jhub.swarmspawner import SwarmSpawner, get_accelerators_label
+
+    def make_spawner(name, pools):
+        config = Config()
+        config.SwarmSpawner.images = [
+            {
+                "name": "Base Notebook",
+                "image": "ucphhpc/base-notebook:latest",
+                "accelerators": pools,
+            }
+        ]
+        return SwarmSpawner(config=config, user=DryRunUser(name), hub=DryRunHub())
+
+    def make_pools():
+        return [
+            AcceleratorPool("gpu", False, ids=["0", "1"], ledger_path=str(tmp_path)),
+            AcceleratorPool("fpga", False, ids=["0", "1"], ledger_path=str(tmp_path)),
+        ]
+
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner("user1", make_pools())
+        asyncio.run(spawner.start())
+        labels = swarm.services[spawner.service_id]["Spec"]["Labels"]
+        assert labels[get_accelerators_label("gpu")] == "0"
+        assert labels[get_accelerators_label("fpga")] == "0"
+
+        # A restarted hub recovers the claim of each pool from its own label
+        restarted = make_spawner("user2", make_pools())
+        asyncio.run(restarted.start())
+        for pool in restarted.accelerator_pools:
+            assert pool.claims() == {
+                ("", "0"): [spawner.service_name],
+                ("", "1"): [restarted.service_name],
+            }
+
+
+def test_spawner_releases_claims_of_missing_services(tmp_path, monkeypatch):
+    from traitlets.config import Config
+    from fakeswarm import FakeSwarm
+    from jhub import swarmspawner
+    from jhub.dryrun import DryRunHub, DryRunUser
+
+    config = Config()
+    config.SwarmSpawner.images = [
+        {
+            "name": "Base Notebook",
+            "image": "ucphhpc/base-notebook:latest",
+            "accelerators": [AcceleratorPool("gpu", False, ids=["0"])],
+        }
+    ]
+
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = swarmspawner.SwarmSpawner(
+            config=config, user=DryRunUser("user1"), hub=DryRunHub()
+        )
+        pool = spawner.accelerator_pools[0]
+
+        # The service is already gone when it is stopped
+        asyncio.run(spawner.start())
+        with swarm.lock:
+            del swarm.services[spawner.service_id]
+        asyncio.run(spawner.stop())
+        assert pool.claims() == {}
+
+        # The service couldn't be created
+        run_docker_async = swarmspawner.run_docker_async
+
+        async def failing_run_docker_async(method, *args, **kwargs):
+            if method == "create_service":
+                raise Exception("create_service failed")
+            return await run_docker_async(method, *args, **kwargs)
+
+        monkeypatch.setattr(swarmspawner, "run_docker_async", failing_run_docker_async)
+        with pytest.raises(Exception, match="create_service failed"):
+            asyncio.run(spawner.start())
+        assert pool.claims() == {}
+
+
+def test_accelerator_metrics_of_each_pool():
+    import gc
+
+    first = AcceleratorPool("metrics-gpu", False, ids=["0"])
+    second = AcceleratorPool("metrics-gpu", False, ids=["0"])
+    assert first.name != second.name
+    assert asyncio.run(first.claim("user1"))
+    assert second.claims() == {}
+
+    labels = {"pool": first.name, "type": "metrics-gpu", "node": ""}
+    assert REGISTRY.get_sample_value("swarmspawner_accelerators_claimed", labels) == 1
+    labels["pool"] = second.name
+    assert REGISTRY.get_sample_value("swarmspawner_accelerators_claimed", labels) == 0
+
+    # The metrics don't keep the pools alive
+    labels["pool"] = first.name
+    pool = weakref.ref(first)
+    del first
+    gc.collect()
+    assert pool() is None
+    assert (
+        REGISTRY.get_sample_value("swarmspawner_accelerators_claimed", labels) is None
+    )
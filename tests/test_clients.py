@@ -0,0 +1,204 @@
+import asyncio
+import docker
+import time
+import pytest
+from requests.exceptions import Timeout
+from traitlets.config import Config
+from fakeswarm import FakeSwarm
+from jhub.clients import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DockerClientPool,
+    CLOSED,
+    LEAST_LATENCY,
+    OPEN,
+    configure_client_pool,
+)
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.swarmspawner import SwarmSpawner
+
+
+def warm_up(pool, swarm):
+    for endpoint in pool.endpoints:
+        pool.client(endpoint)
+    pool.leader()
+    swarm.manager_requests = {}
+
+
+def test_reads_are_distributed_and_writes_sent_to_leader():
+    with FakeSwarm(managers=2, leader=1) as swarm:
+        pool = DockerClientPool(swarm.urls)
+        assert pool.leader() == swarm.urls[1]
+        warm_up(pool, swarm)
+
+        for _ in range(4):
+            pool.call("services")
+        assert swarm.manager_requests == {0: 2, 1: 2}
+
+        swarm.manager_requests = {}
+        pool.call("create_config", "config-1", b"data")
+        assert swarm.manager_requests == {1: 1}
+        pool.close()
+
+
+def test_least_latency_reads():
+    with FakeSwarm(managers=2, manager_latencies={0: 0.05}) as swarm:
+        pool = DockerClientPool(swarm.urls, strategy=LEAST_LATENCY)
+        warm_up(pool, swarm)
+        for _ in range(5):
+            pool.call("tasks")
+        # Only the first read is sent to the slow manager
+        assert swarm.manager_requests == {0: 1, 1: 4}
+        pool.close()
+
+
+def test_slow_reads_are_hedged():
+    with FakeSwarm(managers=2, manager_latencies={0: 1}) as swarm:
+        pool = DockerClientPool(swarm.urls, hedge_reads=True, hedge_min_samples=5)
+        warm_up(pool, swarm)
+        for _ in range(5):
+            pool._record("services", swarm.urls[1], 0.01)
+
+        started = time.perf_counter()
+        # The first read is sent to the slow manager, and hedged to the other
+        assert pool.call("services") == []
+        assert time.perf_counter() - started < 0.5
+        assert swarm.manager_requests == {0: 1, 1: 1}
+        pool.close()
+
+
+def test_writes_are_sent_to_leader_past_an_unreachable_manager():
+    with FakeSwarm(managers=2, leader=1) as swarm:
+        dead = "tcp://127.0.0.1:1"
+        pool = DockerClientPool([dead] + swarm.urls)
+        assert pool.leader() == swarm.urls[1]
+        swarm.manager_requests = {}
+        pool.call("create_config", "config-1", b"data")
+        assert swarm.manager_requests == {1: 1}
+        pool.close()
+
+
+def test_reads_fail_over_from_an_unreachable_manager():
+    with FakeSwarm() as swarm:
+        dead = "tcp://127.0.0.1:1"
+        pool = DockerClientPool([dead, swarm.url], failure_threshold=2)
+        # The client of the dead manager can't negotiate its API version
+        for _ in range(4):
+            assert pool.call("services") == []
+        assert pool.breaker(dead).state == OPEN
+        assert swarm.requests["GET services"] == 4
+        pool.close()
+
+
+def test_client_pool_is_shared():
+    pool = configure_client_pool(["tcp://manager1:2376"])
+    assert configure_client_pool(["tcp://manager1:2376"]) is pool
+
+    other_pool = configure_client_pool(["tcp://manager1:2376"], hedge_reads=True)
+    assert other_pool is not pool
+    assert other_pool.endpoints == ["tcp://manager1:2376"]
+    # Back to the DOCKER_HOST of the environment
+    configure_client_pool()
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("manager1", failure_threshold=2, recovery_timeout=0.05)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.05)
+    # A single probe is let through once the circuit is recovering
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == CLOSED
+
+
+def test_circuit_opens_on_timeouts():
+    with FakeSwarm(latencies={"tasks": 0.5}) as swarm:
+        pool = DockerClientPool(
+            [swarm.url], timeouts={"tasks": 0.1}, failure_threshold=2
+        )
+        for _ in range(2):
+            with pytest.raises(Timeout):
+                pool.call("tasks")
+        with pytest.raises(CircuitOpenError):
+            pool.call("tasks")
+        assert swarm.requests["GET tasks"] == 2
+        pool.close()
+
+
+def test_poll_reuses_the_last_status(monkeypatch):
+    config = Config()
+    config.SwarmSpawner.images = [
+        {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"}
+    ]
+    config.SwarmSpawner.docker_timeout = 1
+    config.SwarmSpawner.docker_read_cache_ttl = 0
+
+    swarm = FakeSwarm().start()
+    monkeypatch.setenv("DOCKER_HOST", swarm.url)
+    try:
+        spawner = SwarmSpawner(config=config, user=DryRunUser("user1"), hub=DryRunHub())
+        assert spawner.client_pool.endpoints == [swarm.url]
+        asyncio.run(spawner.start())
+        assert asyncio.run(spawner.poll()) is None
+
+        swarm.stop()
+        assert asyncio.run(spawner.poll()) is None
+    finally:
+        swarm.stop()
+
+
+def test_concurrent_reads_are_coalesced():
+    with FakeSwarm(latency=0.1) as swarm:
+        pool = DockerClientPool([swarm.url], read_cache_ttl=60)
+        pool.client()
+
+        async def read(count):
+            return await asyncio.gather(
+                *[
+                    pool.call_async("tasks", {"service": "service1"})
+                    for _ in range(count)
+                ]
+            )
+
+        responses = asyncio.run(read(10))
+        assert responses == [[]] * 10
+        assert swarm.requests["GET tasks"] == 1
+        # Each caller is given its own copy
+        responses[0].append("task")
+        assert responses[1] == []
+
+        # The cached response is reused until a service is written
+        asyncio.run(pool.call_async("create_config", "config-1", b"data"))
+        asyncio.run(read(1))
+        assert swarm.requests["GET tasks"] == 1
+        with pytest.raises(docker.errors.NotFound):
+            asyncio.run(pool.call_async("remove_service", "service2"))
+        asyncio.run(read(1))
+        assert swarm.requests["GET tasks"] == 2
+        pool.close()
+
+
+def test_replaced_client_pool_is_closed(monkeypatch):
+    with FakeSwarm(latency=0.2) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        pool = configure_client_pool()
+        assert configure_client_pool() is pool
+        pool.client()
+
+        async def replace():
+            # The pool is closed once its call in progress is done
+            read = asyncio.ensure_future(pool.call_async("services"))
+            await asyncio.sleep(0.1)
+            assert configure_client_pool(read_cache_ttl=0) is not pool
+            assert pool._clients
+            assert await read == []
+            assert not pool._clients
+
+        asyncio.run(replace())
+    configure_client_pool()
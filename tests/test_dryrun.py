@@ -0,0 +1,60 @@
+import json
+import os
+from jhub.dryrun import dry_run, load_config, main
+
+config_content = """
+c = get_config()
+c.SwarmSpawner.jupyterhub_service_name = "jupyterhub"
+c.SwarmSpawner.networks = ["jupyterhub_default"]
+c.SwarmSpawner.user_format_attributes = ["name"]
+c.SwarmSpawner.configs = [{"config_name": "notebook-config"}]
+c.SwarmSpawner.images = [
+    {
+        "name": "Base Notebook",
+        "image": "ucphhpc/base-notebook:latest",
+        "mounts": [
+            {"type": "volume", "source": "data-{name}", "target": "/home/jovyan"}
+        ],
+    }
+]
+"""
+
+
+def test_dry_run(tmp_path):
+    config_path = os.path.join(tmp_path, "jupyterhub_config.py")
+    with open(config_path, "w") as _file:
+        _file.write(config_content)
+
+    report = dry_run(load_config(config_path), users=3, include_specs="all")
+    assert report["users"] == 3
+    assert set(report["phases"]) >= {"image", "mounts", "env", "service"}
+    sources = [
+        spec["task_template"]["ContainerSpec"]["Mounts"][0]["Source"]
+        for spec in report["specs"]
+    ]
+    assert sources == ["data-user0", "data-user1", "data-user2"]
+    # Configs are referenced by their name
+    configs = report["specs"][0]["task_template"]["ContainerSpec"]["Configs"]
+    assert configs[0]["ConfigID"] == "notebook-config"
+
+    output_path = os.path.join(tmp_path, "report.json")
+    assert main([config_path, "--users", "2", "--output", output_path]) == 0
+    with open(output_path) as _file:
+        assert len(json.load(_file)["specs"]) == 1
+
+
+def test_dry_run_user_options(tmp_path):
+    config_path = os.path.join(tmp_path, "jupyterhub_config.py")
+    with open(config_path, "w") as _file:
+        _file.write(config_content)
+    config = load_config(config_path)
+    config.SwarmSpawner.use_user_options = True
+
+    # Every user is spawned with the same user_options
+    user_options = {"resource_spec": {"cpu_limit": 1000000000}}
+    report = dry_run(config, users=2, user_options=user_options, include_specs="all")
+    limits = [
+        spec["task_template"]["Resources"]["Limits"]["NanoCPUs"]
+        for spec in report["specs"]
+    ]
+    assert limits == [1000000000, 1000000000]
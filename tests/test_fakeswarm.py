@@ -0,0 +1,13 @@
+from fakeswarm import FakeSwarm
+from loadtest import load_test
+
+
+def test_fake_swarm_load():
+    swarm = FakeSwarm()
+    report = load_test(users=3, concurrency=3, polls=2, swarm=swarm)
+    assert report["errors"] == []
+    assert set(report["operations"]) == {"start", "poll", "stop"}
+    assert report["requests"]["POST services"] == 3
+    # Every service is removed when its server is stopped
+    assert swarm.services == {}
+    assert [event["Action"] for event in swarm.events].count("remove") == 3
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import pytest
+from requests.exceptions import Timeout
+from traitlets.config import Config
+from fakeswarm import FakeSwarm
+from jhub.clients import configure_client_pool
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.images import ImageDigests
+from jhub.swarmspawner import SwarmSpawner
+
+IMAGE = "ucphhpc/base-notebook:latest"
+DIGEST = "sha256:{}".format("1" * 64)
+NEW_DIGEST = "sha256:{}".format("2" * 64)
+
+
+@pytest.fixture(autouse=True)
+def image_digests():
+    ImageDigests._instance = None
+    yield
+    ImageDigests._instance = None
+
+
+def test_digests_are_cached_and_refreshed(monkeypatch):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        configure_client_pool(read_cache_ttl=0)
+        swarm.images[IMAGE] = DIGEST
+        digests = ImageDigests(ttl=60, refresh_interval=0.05)
+
+        async def resolve():
+            assert await digests.resolve(IMAGE) == "{}@{}".format(IMAGE, DIGEST)
+            assert await digests.resolve(IMAGE) == "{}@{}".format(IMAGE, DIGEST)
+            assert swarm.requests["GET distribution"] == 1
+
+            # The digests are refreshed in the background
+            with swarm.lock:
+                swarm.images[IMAGE] = NEW_DIGEST
+            await asyncio.sleep(0.2)
+            assert digests.digests == {IMAGE: NEW_DIGEST}
+
+        asyncio.run(resolve())
+    configure_client_pool()
+
+
+def test_stale_digest_is_used_while_unresolvable(monkeypatch):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        configure_client_pool(read_cache_ttl=0, timeouts={"inspect_distribution": 0.1})
+        swarm.images[IMAGE] = DIGEST
+        digests = ImageDigests(ttl=0, refresh_interval=0)
+        assert asyncio.run(digests.resolve(IMAGE)) == "{}@{}".format(IMAGE, DIGEST)
+
+        # The registry is slow
+        swarm.latencies["distribution"] = 0.5
+        assert asyncio.run(digests.resolve(IMAGE)) == "{}@{}".format(IMAGE, DIGEST)
+        with pytest.raises(Timeout):
+            asyncio.run(digests.resolve("ucphhpc/other-notebook:latest"))
+    configure_client_pool()
+
+
+def test_spawned_image_is_pinned(monkeypatch):
+    config = Config()
+    config.SwarmSpawner.images = [{"name": "Base Notebook", "image": IMAGE}]
+    config.SwarmSpawner.pin_image_digests = True
+    config.SwarmSpawner.docker_read_cache_ttl = 0
+
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        swarm.images[IMAGE] = DIGEST
+        spawner = SwarmSpawner(config=config, user=DryRunUser("user1"), hub=DryRunHub())
+
+        async def lifecycle():
+            await spawner.start()
+            service = swarm.services[spawner.service_id]
+            image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+            assert image == "{}@{}".format(IMAGE, DIGEST)
+            assert spawner.image_digests.digests == {IMAGE: DIGEST}
+
+            # The service is updated once the tag refers to a new digest
+            spawner.image_digests.forget(IMAGE)
+            with swarm.lock:
+                swarm.images[IMAGE] = NEW_DIGEST
+            await spawner.start()
+            service = swarm.services[spawner.service_id]
+            image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+            assert image == "{}@{}".format(IMAGE, NEW_DIGEST)
+
+        asyncio.run(lifecycle())
+
+
+def test_digests_are_bounded_and_only_used_ones_refreshed(monkeypatch):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        configure_client_pool(read_cache_ttl=0)
+        images = ["ucphhpc/notebook-{}:latest".format(index) for index in range(3)]
+        for image in images:
+            swarm.images[image] = DIGEST
+        digests = ImageDigests(ttl=60, refresh_interval=0, max_images=2)
+
+        async def resolve():
+            for image in images:
+                await digests.resolve(image)
+
+        asyncio.run(resolve())
+        # The least recently used digest is forgotten
+        assert list(digests.digests) == images[1:]
+        assert digests.recently_used(now=time.monotonic() + 30) == images[1:]
+        assert digests.recently_used(now=time.monotonic() + 120) == []
+    configure_client_pool()
+
+
+def test_service_digest_is_kept_while_unresolvable(monkeypatch):
+    config = Config()
+    config.SwarmSpawner.images = [{"name": "Base Notebook", "image": IMAGE}]
+    config.SwarmSpawner.pin_image_digests = True
+    config.SwarmSpawner.docker_read_cache_ttl = 0
+    config.SwarmSpawner.docker_timeouts = {"inspect_distribution": 0.1}
+
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        swarm.images[IMAGE] = DIGEST
+        spawner = SwarmSpawner(config=config, user=DryRunUser("user1"), hub=DryRunHub())
+        asyncio.run(spawner.start())
+        version = swarm.services[spawner.service_id]["Version"]["Index"]
+
+        # The hub is restarted while the registry is slow
+        ImageDigests._instance = None
+        swarm.latencies["distribution"] = 0.5
+        restarted = SwarmSpawner(
+            config=config, user=DryRunUser("user1"), hub=DryRunHub()
+        )
+        asyncio.run(restarted.start())
+        assert restarted.service_id == spawner.service_id
+        assert swarm.services[spawner.service_id]["Version"]["Index"] == version
+    configure_client_pool()
@@ -0,0 +1,178 @@
+import asyncio
+import copy
+import pytest
+from jhub import SwarmSpawner
+from jhub.swarmspawner import IMAGE_LABEL
+from jhub.mount import Mounter, SSHFSMounter, VolumeMounter, get_volume_mounter
+from jhub.util import recursive_format
+from jhub.volumes import WarmVolumePool, WARM_POOL_LABEL
+
+sshfs_config = {
+    "type": "volume",
+    "driver_config": {
+        "name": "ucphhpc/sshfs:latest",
+        "options": {
+            "sshcmd": "{username}@{targetHost}:{targetPath}",
+            "id_rsa": "{privateKey}",
+            "port": "{port}",
+            "allow_other": "",
+        },
+    },
+    "source": "sshvolume-user-{name}",
+    "target": "/home/jovyan/work",
+}
+
+format_kwargs = {
+    "mount_data": {
+        "username": "mountuser",
+        "targetHost": "mount_target",
+        "targetPath": "",
+        "privateKey": "key",
+        "port": "22",
+    },
+    "name": {"name": "user1"},
+}
+
+
+def test_mount_matches_recursive_format():
+    mounter = SSHFSMounter(sshfs_config)
+    mount = asyncio.run(mounter.create(**format_kwargs))
+
+    expected = copy.deepcopy(sshfs_config)
+    for value in format_kwargs.values():
+        recursive_format(expected, value)
+    assert mount["Source"] == expected["source"] == "sshvolume-user-user1"
+    assert (
+        mount["VolumeOptions"]["DriverConfig"]["Options"]
+        == expected["driver_config"]["options"]
+    )
+    # The passed in config is not changed
+    assert sshfs_config["source"] == "sshvolume-user-{name}"
+
+
+def test_warm_sshfs_mount():
+    pool = WarmVolumePool("warm-sshfs")
+    config = copy.deepcopy(sshfs_config)
+    config["driver_config"]["options"]["ephemeral"] = "True"
+    config["labels"] = {"autoremove": "True"}
+    mount = asyncio.run(SSHFSMounter(config, warm_pool=pool).create(**format_kwargs))
+    assert "ephemeral" not in mount["VolumeOptions"]["DriverConfig"]["Options"]
+    assert mount["VolumeOptions"]["Labels"] == {WARM_POOL_LABEL: "warm-sshfs"}
+
+
+def test_mount_is_cached():
+    mounter = VolumeMounter(
+        {"type": "volume", "source": "{name}-data", "target": "/data"}, cache_size=1
+    )
+    first = asyncio.run(mounter.create(name={"name": "user1"}))
+    first["Target"] = "/changed"
+    second = asyncio.run(mounter.create(name={"name": "user1"}))
+    assert second["Source"] == "user1-data"
+    assert second["Target"] == "/data"
+    assert len(mounter._mounts) == 1
+
+    # The least recently used mount is evicted
+    assert asyncio.run(mounter.create(name={"name": "user2"}))["Source"] == (
+        "user2-data"
+    )
+    assert list(mounter._mounts) == [("user2-data",)]
+
+
+def test_mount_keys_are_validated_once():
+    with pytest.raises(KeyError):
+        VolumeMounter({"type": "volume", "target": "/data"})
+
+
+def test_volume_mounter_is_reused():
+    config = {"type": "volume", "source": "{name}-data", "target": "/data"}
+    assert get_volume_mounter(config) is get_volume_mounter(dict(config))
+
+
+class SlowMounter(Mounter):
+    active = 0
+    peak = 0
+
+    async def create(self, **format_mount_config_kwargs):
+        SlowMounter.active += 1
+        SlowMounter.peak = max(SlowMounter.peak, SlowMounter.active)
+        await asyncio.sleep(self.mount_config["delay"])
+        SlowMounter.active -= 1
+        return self.mount_config["target"]
+
+
+def test_mounts_are_prepared_concurrently():
+    spawner = SwarmSpawner(mount_concurrency=2)
+    mounts = [
+        SlowMounter({"target": str(i), "delay": 0.05 * (4 - i)}) for i in range(4)
+    ]
+    mounts.append({"type": "volume", "source": "{name}-data", "target": "/data"})
+    prepared = asyncio.run(spawner.prepare_mounts(mounts, name={"name": "user1"}))
+    # The order of the mounts is preserved
+    assert prepared[:4] == ["0", "1", "2", "3"]
+    assert prepared[4]["Source"] == "user1-data"
+    assert SlowMounter.peak == 2
+
+
+def test_mount_timeout():
+    spawner = SwarmSpawner(mount_timeout=1)
+    mounts = [SlowMounter({"target": "slow", "delay": 2})]
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(spawner.prepare_mounts(mounts))
+
+
+class ProvisioningMounter(VolumeMounter):
+    def __init__(self, mount_config):
+        VolumeMounter.__init__(self, mount_config)
+        self.prepared = []
+        self.cleaned = []
+
+    async def prepare(self, **format_mount_config_kwargs):
+        await asyncio.sleep(0.01)
+        self.prepared.append(format_mount_config_kwargs["name"]["name"])
+
+    async def cleanup(self, **format_mount_config_kwargs):
+        self.cleaned.append(format_mount_config_kwargs["name"]["name"])
+
+
+def test_mount_lifecycle():
+    mounter = ProvisioningMounter(
+        {"type": "volume", "source": "{name}-data", "target": "/data"}
+    )
+    spawner = SwarmSpawner()
+
+    async def spawn(name):
+        return await spawner.prepare_mounts([mounter], name={"name": name})
+
+    async def lifecycle():
+        # Concurrent and repeated spawns of a user only provision once
+        await asyncio.gather(spawn("user1"), spawn("user1"))
+        await spawn("user1")
+        await spawn("user2")
+        assert mounter.prepared == ["user1", "user2"]
+
+        await spawner.cleanup_mounts([mounter], name={"name": "user1"})
+        assert mounter.cleaned == ["user1"]
+
+        mounter.forget_provisioned(name={"name": "user1"})
+        await spawn("user1")
+        assert mounter.prepared == ["user1", "user2", "user1"]
+
+    asyncio.run(lifecycle())
+
+
+def test_service_mounts_without_labels():
+    mount = {"type": "volume", "source": "{name}-data", "target": "/data"}
+    spawner = SwarmSpawner(
+        images=[
+            {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"},
+            {
+                "name": "Data Notebook",
+                "image": "ucphhpc/data:latest",
+                "mounts": [mount],
+            },
+        ]
+    )
+    service = {"Spec": {"Labels": None}}
+    assert spawner.get_service_mounts(service) == []
+    service = {"Spec": {"Labels": {IMAGE_LABEL: "Data Notebook"}}}
+    assert spawner.get_service_mounts(service) == [mount]
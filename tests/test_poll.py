@@ -0,0 +1,93 @@
+import asyncio
+import time
+from fakeswarm import FakeSwarm
+
+
+async def timed_poll(spawner):
+    started = time.perf_counter()
+    status = await spawner.poll()
+    return status, time.perf_counter() - started
+
+
+def test_stale_while_revalidate_poll(monkeypatch, make_spawner):
+    with FakeSwarm(latencies={"tasks": 0.2}) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(poll_max_staleness=60, poll_refresh_after=0)
+
+        async def lifecycle():
+            await spawner.start()
+            requests = swarm.requests["GET tasks"]
+            # The first poll waits on Docker
+            status, seconds = await timed_poll(spawner)
+            assert status is None and seconds >= 0.2
+            assert swarm.requests["GET tasks"] == requests + 1
+
+            # The next returns the last status and refreshes it in the background
+            status, seconds = await timed_poll(spawner)
+            assert status is None and seconds < 0.1
+            await spawner._poll_refresh
+            assert swarm.requests["GET tasks"] == requests + 2
+
+            # The status of a stopped server isn't reused
+            await spawner.stop()
+            assert await spawner.poll() == 0
+
+        asyncio.run(lifecycle())
+
+
+def test_poll_max_staleness(monkeypatch, make_spawner):
+    with FakeSwarm(latencies={"tasks": 0.2}) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(poll_max_staleness=0.1, poll_refresh_after=60)
+
+        async def lifecycle():
+            await spawner.start()
+            await spawner.poll()
+            status, seconds = await timed_poll(spawner)
+            assert status is None and seconds < 0.1
+
+            # Older statuses are refreshed before poll returns
+            await asyncio.sleep(0.1)
+            status, seconds = await timed_poll(spawner)
+            assert status is None and seconds >= 0.2
+            await spawner.stop()
+
+        asyncio.run(lifecycle())
+
+
+def test_poll_inspects_the_current_task(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner()
+
+        async def lifecycle():
+            await spawner.start()
+            state = spawner.get_state()
+            assert state["task_id"] in swarm.tasks
+            assert state["node_id"] == swarm.tasks[state["task_id"]]["NodeID"]
+
+            # The tasks aren't listed while the current task is running
+            listings = swarm.task_listings
+            for _ in range(3):
+                assert await spawner.poll() is None
+            assert swarm.task_listings == listings
+
+            # A restored spawner continues from the persisted task
+            restored = make_spawner()
+            restored.load_state(state)
+            assert await restored.poll() is None
+            assert swarm.task_listings == listings
+
+            # The tasks are listed once the current task is replaced
+            with swarm.lock:
+                service = swarm.services[spawner.service_id]
+                swarm.shutdown_tasks(service["ID"])
+                swarm.create_task(service)
+            assert await spawner.poll() is None
+            assert swarm.task_listings == listings + 1
+            assert spawner.task_id != state["task_id"]
+
+            await spawner.stop()
+            assert "task_id" not in spawner.get_state()
+
+        asyncio.run(lifecycle())
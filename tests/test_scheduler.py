@@ -0,0 +1,70 @@
+import asyncio
+from traitlets.config import Config
+from fakeswarm import FakeSwarm
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.scheduler import PollScheduler, ScheduledPoll
+from jhub.swarmspawner import SwarmSpawner
+
+
+def test_scheduled_poll_interval():
+    scheduled_poll = ScheduledPoll(None, 10, min_interval=5, max_interval=20)
+    scheduled_poll.adapt(changed=False)
+    assert scheduled_poll.interval == 15
+    scheduled_poll.adapt(changed=False)
+    assert scheduled_poll.interval == 20
+    scheduled_poll.adapt(changed=True)
+    assert scheduled_poll.interval == 5
+    assert 4.5 <= scheduled_poll.next_delay() <= 5.5
+
+
+def test_poll_rate_is_limited():
+    started = []
+
+    async def poll():
+        started.append(asyncio.get_running_loop().time())
+        return False
+
+    async def run():
+        scheduler = PollScheduler.get(max_rate=100)
+        for index in range(20):
+            scheduler.schedule(index, ScheduledPoll(poll, 0.01, 0.01, 0.01, jitter=0))
+        await asyncio.sleep(0.3)
+        for index in range(20):
+            scheduler.unschedule(index)
+        assert scheduler.scheduled == 0
+
+    asyncio.run(run())
+    intervals = [after - before for before, after in zip(started, started[1:])]
+    assert 20 <= len(started) <= 31
+    assert min(intervals) >= 0.009
+
+
+def test_adaptive_polling(monkeypatch):
+    config = Config()
+    config.SwarmSpawner.images = [
+        {"name": "Base Notebook", "image": "ucphhpc/base-notebook:latest"}
+    ]
+    config.SwarmSpawner.adaptive_polling = True
+    config.SwarmSpawner.poll_min_interval = 0.05
+    config.SwarmSpawner.docker_read_cache_ttl = 0
+
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = SwarmSpawner(config=config, user=DryRunUser("user1"), hub=DryRunHub())
+        stopped = asyncio.Event()
+
+        async def run():
+            await spawner.start()
+            spawner.add_poll_callback(stopped.set)
+            spawner.start_polling()
+            polls = swarm.requests.get("GET tasks", 0)
+            await asyncio.sleep(0.2)
+            assert swarm.requests["GET tasks"] > polls
+
+            # JupyterHub is notified once the service is gone
+            with swarm.lock:
+                swarm.remove_service(spawner.service_id)
+            await asyncio.wait_for(stopped.wait(), 1)
+            assert spawner._poll_scheduler is None
+
+        asyncio.run(run())
@@ -0,0 +1,134 @@
+import asyncio
+from fakeswarm import FakeSwarm
+from jhub.swarmspawner import ACCELERATOR_ENV, SPEC_HASH_LABEL, SUSPENDED_LABEL
+
+
+def get_env(service):
+    envs = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"]
+    return dict(line.split("=", 1) for line in envs)
+
+
+def test_suspend_and_resume(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(suspend_on_stop=True)
+
+        async def lifecycle():
+            spawner.api_token = "token1"
+            await spawner.start()
+            service_id = spawner.service_id
+            assert SPEC_HASH_LABEL in swarm.services[service_id]["Spec"]["Labels"]
+
+            # The stopped service is scaled to 0 replicas
+            await spawner.stop()
+            service = swarm.services[service_id]
+            assert service["Spec"]["Mode"]["Replicated"]["Replicas"] == 0
+            assert SUSPENDED_LABEL in service["Spec"]["Labels"]
+            assert await spawner.poll() == 0
+
+            # And is scaled back with the new API token when it is started
+            spawner.api_token = "token2"
+            await spawner.start()
+            assert spawner.service_id == service_id
+            service = swarm.services[service_id]
+            assert service["Spec"]["Mode"]["Replicated"]["Replicas"] == 1
+            assert SUSPENDED_LABEL not in service["Spec"]["Labels"]
+            assert get_env(service)["JUPYTERHUB_API_TOKEN"] == "token2"
+            assert await spawner.poll() is None
+            assert swarm.requests["POST services"] == 3
+
+        asyncio.run(lifecycle())
+
+
+def test_suspended_server_is_updated_when_the_spec_changes(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(suspend_on_stop=True)
+
+        async def lifecycle():
+            await spawner.start()
+            service_id = spawner.service_id
+            await spawner.stop()
+
+            spawner.images[0]["env"] = {"NEW_ENV": "value"}
+            await spawner.start()
+            assert spawner.service_id == service_id
+            service = swarm.services[service_id]
+            assert service["Spec"]["Mode"]["Replicated"]["Replicas"] == 1
+            assert SUSPENDED_LABEL not in service["Spec"]["Labels"]
+            assert get_env(service)["NEW_ENV"] == "value"
+            assert await spawner.poll() is None
+
+        asyncio.run(lifecycle())
+
+
+def test_static_accelerator_env_is_suspended(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(suspend_on_stop=True)
+        # Set by the image config rather than claimed from a pool
+        spawner.images[0]["env"] = {ACCELERATOR_ENV: "all"}
+
+        async def lifecycle():
+            await spawner.start()
+            service_id = spawner.service_id
+            assert get_env(swarm.services[service_id])[ACCELERATOR_ENV] == "all"
+            await spawner.stop()
+            service = swarm.services[service_id]
+            assert service["Spec"]["Mode"]["Replicated"]["Replicas"] == 0
+
+        asyncio.run(lifecycle())
+
+
+def test_expired_suspensions_are_reaped(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(suspend_on_stop=True, suspend_ttl=60)
+
+        async def lifecycle():
+            await spawner.start()
+            service_id = spawner.service_id
+            await spawner.stop()
+            await spawner.reap_suspended_services()
+            assert service_id in swarm.services
+
+            with swarm.lock:
+                swarm.services[service_id]["Spec"]["Labels"][SUSPENDED_LABEL] = "0"
+            await spawner.reap_suspended_services()
+            assert service_id not in swarm.services
+
+        asyncio.run(lifecycle())
+
+
+def test_suspensions_are_reaped_without_stops(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner(suspend_on_stop=True, suspend_reap_interval=1)
+
+        async def lifecycle():
+            await spawner.start()
+            service_id = spawner.service_id
+            await spawner.stop()
+
+            # The suspended service has an uploaded config, and has expired
+            config_name = "{}-0".format(spawner.user_config_name_base)
+            with swarm.lock:
+                swarm.configs["config-upload"] = {
+                    "ID": "config-upload",
+                    "Spec": {"Name": config_name},
+                }
+                service = swarm.services[service_id]
+                service["Spec"]["TaskTemplate"]["ContainerSpec"]["Configs"] = [
+                    {"ConfigID": "config-upload", "ConfigName": config_name}
+                ]
+                service["Spec"]["Labels"][SUSPENDED_LABEL] = "0"
+
+            # It is reaped in the background while another server is running
+            other = make_spawner("user2", suspend_on_stop=True, suspend_reap_interval=1)
+            await other.start()
+            await asyncio.sleep(1.5)
+            assert service_id not in swarm.services
+            assert "config-upload" not in swarm.configs
+            assert other.service_id in swarm.services
+
+        asyncio.run(lifecycle())
@@ -0,0 +1,81 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from jhub.dryrun import DryRunHub, DryRunUser
+from jhub.mount import VolumeMounter
+from jhub.swarmspawner import SwarmSpawner, get_user_uid_gid
+from jhub.uids import UIDAllocator
+
+
+def test_uid_allocation(tmp_path):
+    path = os.path.join(tmp_path, "uids.db")
+    allocator = UIDAllocator(path=path, start_uid=10000)
+    assert allocator.get_uid("user1") is None
+    assert allocator.allocate("user1") == (10000, 10000)
+    assert allocator.allocate("user2") == (10001, 10001)
+    assert allocator.allocate("user1") == (10000, 10000)
+
+    # Another process sees the same assignments
+    other_allocator = UIDAllocator(path=path, start_uid=10000, gid=100)
+    assert other_allocator.preload() == 2
+    assert other_allocator.allocate("user2") == (10001, 100)
+    assert other_allocator.allocate("user3") == (10002, 100)
+    assert allocator.allocate("user4") == (10003, 10003)
+
+
+def test_concurrent_uid_allocation(tmp_path):
+    path = os.path.join(tmp_path, "uids.db")
+    allocators = [UIDAllocator(path=path) for _ in range(4)]
+    names = ["user{}".format(i % 10) for i in range(40)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        uids = list(
+            executor.map(
+                lambda i: allocators[i % 4].allocate_uid(names[i]), range(len(names))
+            )
+        )
+    assignments = dict(zip(names, uids))
+    assert sorted(assignments.values()) == list(range(10000, 10010))
+    assert all(assignments[name] == uid for name, uid in zip(names, uids))
+
+
+def test_uid_gid_format_values():
+    values = {"uid": "10000", "gid": "100"}
+    assert get_user_uid_gid({"uid_gid": "{uid}:{gid}"}, format_values=values) == (
+        "10000",
+        "100",
+    )
+    assert get_user_uid_gid({"uid_gid": "1000:100"}) == ("1000", "100")
+
+
+class RecordingMounter(VolumeMounter):
+    def __init__(self, mount_config):
+        VolumeMounter.__init__(self, mount_config)
+        self.format_kwargs = []
+
+    async def create(self, **format_mount_config_kwargs):
+        self.format_kwargs.append(format_mount_config_kwargs)
+        return await VolumeMounter.create(self, **format_mount_config_kwargs)
+
+
+def test_mounts_are_formatted_with_the_allocated_uid(tmp_path):
+    mounter = RecordingMounter(
+        {"type": "volume", "source": "data-{uid}", "target": "/data"}
+    )
+    spawner = SwarmSpawner(
+        images=[
+            {
+                "name": "Base Notebook",
+                "image": "ucphhpc/base-notebook:latest",
+                "mounts": [mounter],
+            }
+        ],
+        uid_allocator=UIDAllocator(
+            path=os.path.join(tmp_path, "uids.db"), start_uid=10000
+        ),
+        user_format_attributes=["uid"],
+        user=DryRunUser("user1"),
+        hub=DryRunHub(),
+    )
+    spawner.dry_run = True
+    asyncio.run(spawner.build_service_spec({}))
+    assert mounter.format_kwargs == [{"uid": {"uid": "10000"}}]
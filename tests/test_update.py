@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+from docker.errors import APIError
+from fakeswarm import FakeSwarm
+from jhub import swarmspawner
+from jhub.accelerators import AcceleratorPool
+from jhub.swarmspawner import (
+    ACCELERATOR_ENV,
+    SPEC_HASH_LABEL,
+    run_docker_async,
+    spec_hash,
+)
+
+
+def test_unchanged_spec_is_reused(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner()
+
+        async def lifecycle():
+            spawner.api_token = "token1"
+            await spawner.start()
+            version = swarm.services[spawner.service_id]["Version"]["Index"]
+
+            # E.g. the hub restarted without the state of the server
+            restarted = make_spawner()
+            restarted.api_token = "token2"
+            await restarted.start()
+            assert restarted.service_id == spawner.service_id
+            assert restarted.api_token == "token1"
+            assert swarm.services[spawner.service_id]["Version"]["Index"] == version
+            assert swarm.requests["POST services"] == 1
+
+        asyncio.run(lifecycle())
+
+
+def test_changed_spec_is_updated_in_place(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner()
+
+        async def lifecycle():
+            await spawner.start()
+            service = swarm.services[spawner.service_id]
+            spec_hash = service["Spec"]["Labels"][SPEC_HASH_LABEL]
+
+            restarted = make_spawner()
+            restarted.images[0]["image"] = "ucphhpc/base-notebook:edge"
+            await restarted.start()
+            assert restarted.service_id == spawner.service_id
+            service = swarm.services[spawner.service_id]
+            assert service["Spec"]["Labels"][SPEC_HASH_LABEL] != spec_hash
+            image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+            assert image == "ucphhpc/base-notebook:edge"
+            assert swarm.requests["POST services"] == 2
+            assert await restarted.poll() is None
+
+        asyncio.run(lifecycle())
+
+
+def test_spec_hash_of_the_submitted_spec(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        pool = AcceleratorPool("gpu", False, ids=["0", "1"])
+        spawner = make_spawner()
+        spawner.images[0]["accelerators"] = [pool]
+
+        async def lifecycle():
+            await spawner.start()
+            service = swarm.services[spawner.service_id]
+            # The claimed accelerators are left out of the hash
+            assert service["Spec"]["Labels"][SPEC_HASH_LABEL] == spec_hash(
+                service["Spec"]["TaskTemplate"], ignored_env=(ACCELERATOR_ENV,)
+            )
+
+            # Such that the service isn't replaced when it is started again
+            await spawner.start()
+            assert swarm.requests["POST services"] == 1
+            assert pool.claims() == {("", "0"): [spawner.service_name]}
+
+        asyncio.run(lifecycle())
+
+
+def test_service_without_spec_hash_is_reused(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_spawner()
+
+        async def lifecycle():
+            await spawner.start()
+            with swarm.lock:
+                del swarm.services[spawner.service_id]["Spec"]["Labels"][
+                    SPEC_HASH_LABEL
+                ]
+
+            restarted = make_spawner()
+            restarted.images[0]["env"] = {"NEW_ENV": "value"}
+            await restarted.start()
+            assert restarted.service_id == spawner.service_id
+            assert swarm.requests["POST services"] == 1
+
+        asyncio.run(lifecycle())
+
+
+def test_failed_update_releases_accelerators(monkeypatch, make_spawner):
+    with FakeSwarm() as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        pool = AcceleratorPool("gpu", False, ids=["0"])
+        spawner = make_spawner()
+
+        async def lifecycle():
+            await spawner.start()
+
+            # The new spec claims an accelerator, but is rejected by Docker
+            updates = []
+
+            async def failing_run_docker_async(method, *args, **kwargs):
+                if method == "update_service":
+                    updates.append(args)
+                    raise APIError("invalid spec")
+                return await run_docker_async(method, *args, **kwargs)
+
+            monkeypatch.setattr(
+                swarmspawner, "run_docker_async", failing_run_docker_async
+            )
+            restarted = make_spawner()
+            restarted.images[0]["image"] = "ucphhpc/base-notebook:edge"
+            restarted.images[0]["accelerators"] = [pool]
+            with pytest.raises(APIError, match="invalid spec"):
+                await restarted.start()
+            # Which isn't retried as a concurrent update
+            assert len(updates) == 1
+            assert pool.claims() == {}
+
+        asyncio.run(lifecycle())
@@ -0,0 +1,140 @@
+import asyncio
+import pytest
+from fakeswarm import FakeSwarm, NotFound
+from jhub.mount import SSHFSMounter
+from jhub.volumes import WarmVolumePool, WARM_POOL_LABEL, get_keeper_name
+
+
+def test_warm_volume_pool():
+    pool = WarmVolumePool("test-sshfs", idle_timeout=60)
+    assert WarmVolumePool.get("test-sshfs") is pool
+    assert pool.checkout("sshvolume-user-user1") is None
+    assert pool.expired(now=1000) == []
+
+    # The next spawn is placed on the node where the volume was mounted
+    pool.checkin("sshvolume-user-user1", node="node-a", now=0)
+    assert pool.expired(now=30) == []
+    assert pool.checkout("sshvolume-user-user1") == "node-a"
+    assert pool.expired(now=1000) == []
+
+    # A failed spawn drops the node affinity until the volume is healthy again
+    pool.checkin("sshvolume-user-user1", healthy=False, now=0)
+    assert pool.checkout("sshvolume-user-user1") is None
+    pool.checkin("sshvolume-user-user1", now=0)
+    assert pool.status()["sshvolume-user-user1"]["healthy"]
+
+    assert pool.expired(now=61) == ["sshvolume-user-user1"]
+    pool.forget("sshvolume-user-user1")
+    assert pool.volumes == {}
+
+
+def make_warm_spawner(make_spawner, pool, name="user1"):
+    config = {
+        "type": "volume",
+        "driver_config": {
+            "name": "ucphhpc/sshfs:latest",
+            "options": {"sshcmd": "mountuser@mount_target:", "allow_other": ""},
+        },
+        "source": "sshvolume-user-{name}",
+        "target": "/home/jovyan/work",
+    }
+    return make_spawner(
+        name,
+        user_format_attributes=["name"],
+        container_spec={"mounts": [SSHFSMounter(config, warm_pool=pool)]},
+    )
+
+
+def get_constraints(service):
+    placement = service["Spec"]["TaskTemplate"].get("Placement") or {}
+    return placement.get("Constraints") or []
+
+
+def test_warm_volume_is_kept_mounted_between_spawns(monkeypatch, make_spawner):
+    pool = WarmVolumePool("test-keeper")
+    keeper_name = get_keeper_name("sshvolume-user-user1")
+    with FakeSwarm(nodes=("node-1", "node-2")) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_warm_spawner(make_spawner, pool)
+
+        async def lifecycle():
+            await spawner.start()
+            node = spawner.node_id
+            await spawner.stop()
+            assert pool.node("sshvolume-user-user1") == node
+
+            # The idle volume is held on its node by a keeper service
+            keeper = swarm.find_service(keeper_name)
+            assert get_constraints(keeper) == ["node.id=={}".format(node)]
+            mounts = keeper["Spec"]["TaskTemplate"]["ContainerSpec"]["Mounts"]
+            assert [mount["Source"] for mount in mounts] == ["sshvolume-user-user1"]
+
+            # Which hands it over to the next spawn on the same node
+            await spawner.start()
+            assert spawner.node_id == node
+            service = swarm.services[spawner.service_id]
+            assert "node.id=={}".format(node) in get_constraints(service)
+            with pytest.raises(NotFound):
+                swarm.find_service(keeper_name)
+            await spawner.stop()
+
+        asyncio.run(lifecycle())
+
+
+def test_warm_placement_falls_back_to_another_node(monkeypatch, make_spawner):
+    pool = WarmVolumePool("test-fallback", placement_timeout=1)
+    with FakeSwarm(nodes=("node-1", "node-2")) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        spawner = make_warm_spawner(make_spawner, pool)
+
+        async def lifecycle():
+            await spawner.start()
+            node = spawner.node_id
+            await spawner.stop()
+
+            # The node of the warm volume has no resources left
+            swarm.full_nodes.add(node)
+            await spawner.start()
+            other_node = spawner.node_id
+            assert other_node not in ("", node)
+            service = swarm.services[spawner.service_id]
+            assert "node.id=={}".format(node) not in get_constraints(service)
+            assert await spawner.poll() is None
+            await spawner.stop()
+            assert pool.node("sshvolume-user-user1") == other_node
+
+        asyncio.run(lifecycle())
+
+
+def test_warm_volumes_are_restored_and_reaped_on_their_node(monkeypatch, make_spawner):
+    with FakeSwarm(nodes=("node-1", "node-2")) as swarm:
+        monkeypatch.setenv("DOCKER_HOST", swarm.url)
+        # The volumes of a previous hub process
+        for user in ("user1", "user2"):
+            name = "sshvolume-user-{}".format(user)
+            swarm.volumes[name] = {
+                "Name": name,
+                "Driver": "ucphhpc/sshfs:latest",
+                "Labels": {WARM_POOL_LABEL: "test-restore"},
+                "Options": {},
+                "Scope": "local",
+            }
+        pool = WarmVolumePool(
+            "test-restore", idle_timeout=0, node_endpoints={"node-2": swarm.url}
+        )
+        spawner = make_warm_spawner(make_spawner, pool, name="user2")
+
+        async def lifecycle():
+            await spawner.start()
+            status = pool.status()
+            assert status["sshvolume-user-user1"]["node"] == "node-2"
+            assert not status["sshvolume-user-user1"]["in_use"]
+            assert status["sshvolume-user-user2"]["in_use"]
+
+            # The idle volume is removed via the endpoint of its node
+            await spawner.reap_warm_volumes()
+            assert "sshvolume-user-user1" not in swarm.volumes
+            assert "sshvolume-user-user2" in swarm.volumes
+            assert list(pool.volumes) == ["sshvolume-user-user2"]
+
+        asyncio.run(lifecycle())